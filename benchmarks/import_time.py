@@ -0,0 +1,45 @@
+#! /usr/bin/env python
+"""
+import_time.py
+Measures the time it takes to 'import flow' in a fresh interpreter.
+The flow module must be importable (installed or on PYTHONPATH).
+usage:
+./import_time.py [runs]
+"""
+
+import sys
+import json
+import subprocess
+
+_IMPORT_SCRIPT = (
+    "import time; start = time.time(); import flow; "
+    "print(time.time() - start)"
+)
+
+
+def measure_import(runs):
+    """Returns a list with the 'import flow' times (in seconds)
+    of 'runs' fresh interpreters.
+    """
+    times = []
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, "-c", _IMPORT_SCRIPT])
+        times.append(float(output.decode().strip()))
+    return times
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    times = sorted(measure_import(runs))
+    print(json.dumps(dict(
+        benchmark="import_time",
+        runs=runs,
+        min=times[0],
+        median=times[len(times) // 2],
+        max=times[-1],
+    ), indent=2))
+
+
+if __name__ == "__main__":
+    main()
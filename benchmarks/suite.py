@@ -0,0 +1,398 @@
+#! /usr/bin/env python
+"""
+suite.py
+Benchmarks of the client hot paths, run against the in-memory fake
+backend (flow.fakeglue): start-up time, API round trips, notification
+throughput and dispatch latency, memory growth, and the memory of
+the flow.models records vs. plain dicts.
+The flow module must be importable (installed or on PYTHONPATH).
+Results are printed (or written with --output) as JSON, and two result
+files can be compared; compare exits with status 1 on regressions.
+usage:
+./suite.py run [--output FILE] [--only NAME ...] [--quick]
+./suite.py compare OLD NEW [--threshold PERCENT]
+"""
+
+import argparse
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from flow import Flow, fakeglue, models
+
+# Monotonic clock when available (Python 3.3+)
+_clock = getattr(time, "monotonic", time.time)
+
+# Message sizes (bytes) of the API round trip benchmark
+PAYLOAD_SIZES = (0, 1024, 16 * 1024, 256 * 1024)
+
+# Messages per notification burst
+BURST_SIZE = 64
+
+
+def percentile(values, pct):
+    """Returns the 'pct' percentile (nearest rank) of sorted 'values'."""
+    if not values:
+        return None
+    index = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def summarize(values):
+    """Returns a dict with the min, p50, p99 and max of 'values'."""
+    values = sorted(values)
+    return dict(
+        min=values[0],
+        p50=percentile(values, 50),
+        p99=percentile(values, 99),
+        max=values[-1],
+    )
+
+
+class FakeFlow(object):
+    """Context manager that starts a Flow object on the fake backend,
+    with its own temporary directories.
+    """
+
+    def __init__(self, username="bench", **flow_args):
+        self.username = username
+        self.flow_args = flow_args
+        self.flow = None
+        self._dir = None
+
+    def __enter__(self):
+        self._dir = tempfile.mkdtemp(prefix="flow-bench-")
+        self.flow = Flow(
+            username=self.username,
+            flowappglue=fakeglue.get_path(),
+            db_dir=self._dir,
+            schema_dir=self._dir,
+            attachment_dir=self._dir,
+            **self.flow_args
+        )
+        return self.flow
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flow.terminate()
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+
+def _new_channel(flow):
+    """Creates an org and a channel, returns (OrgID, ChannelID)."""
+    org = flow.new_org("bench", False)
+    return org["id"], flow.new_channel(org["id"], "bench")
+
+
+def bench_cold_start(runs):
+    """Time of Flow.__init__ (backend spawn, config and start-up)."""
+    totals = []
+    phases = {}
+    for _ in range(runs):
+        start = _clock()
+        with FakeFlow() as flow:
+            totals.append(_clock() - start)
+            for phase, duration in flow.startup_times.items():
+                phases.setdefault(phase, []).append(duration)
+    result = dict(runs=runs, seconds=summarize(totals))
+    result["phases"] = dict(
+        (phase, summarize(durations)[
+            "p50"]) for phase, durations in phases.items())
+    return result
+
+
+def bench_rpc(calls):
+    """API round trips per second and latency, by payload size."""
+    result = {}
+    with FakeFlow() as flow:
+        for size in PAYLOAD_SIZES:
+            payload = "x" * size
+            fakeglue.echo(flow, payload)  # warm-up
+            latencies = []
+            start = _clock()
+            for _ in range(calls):
+                call_start = _clock()
+                fakeglue.echo(flow, payload)
+                latencies.append(_clock() - call_start)
+            elapsed = _clock() - start
+            result[str(size)] = dict(
+                calls=calls,
+                callsPerSec=calls / elapsed,
+                latency=summarize(latencies),
+            )
+    return result
+
+
+def _dispatch(flow, oid, cid, count, latencies):
+    """Delivers 'count' messages and processes them, returns the
+    seconds from the delivery until the last callback.
+    Messages are delivered in bursts smaller than the notification
+    queue bound of the session, so that none is dropped.
+    """
+    elapsed = 0.0
+    while count > 0:
+        burst = min(count, BURST_SIZE)
+        count -= burst
+        expected = len(latencies) + burst
+        start = _clock()
+        fakeglue.notification_burst(flow, oid, cid, burst)
+        while len(latencies) < expected:
+            if not flow.process_one_notification(timeout_secs=5):
+                raise RuntimeError("Notifications were lost.")
+        elapsed += _clock() - start
+    return elapsed
+
+
+def _latency_callback(latencies):
+    """Returns a message callback that appends the dispatch latency of
+    the messages (from their creation on the backend) to 'latencies'.
+    """
+    def on_message(notif_type, data):
+        now = time.time()
+        for message in data["regularMessages"]:
+            latencies.append(now - message["creationTime"])
+    return on_message
+
+
+def bench_notifications(count, rounds):
+    """Notification throughput and end-to-end dispatch latency."""
+    latencies = []
+    elapsed = 0.0
+    with FakeFlow() as flow:
+        flow.register_callback(
+            Flow.MESSAGE_NOTIFICATION, _latency_callback(latencies))
+        oid, cid = _new_channel(flow)
+        _dispatch(flow, oid, cid, count, latencies)  # warm-up
+        del latencies[:]
+        for _ in range(rounds):
+            elapsed += _dispatch(flow, oid, cid, count, latencies)
+        stats = flow.get_notification_stats()
+    return dict(
+        notifications=len(latencies),
+        dropped=stats["dropped"],
+        notificationsPerSec=len(latencies) / elapsed,
+        latency=summarize(latencies),
+    )
+
+
+def bench_memory(count, rounds):
+    """Growth of the memory allocated by Python over a long run
+    of notifications and API calls (needs tracemalloc).
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        return dict(skipped="tracemalloc not available")
+    latencies = []
+    samples = []
+    with FakeFlow() as flow:
+        flow.register_callback(
+            Flow.MESSAGE_NOTIFICATION, _latency_callback(latencies))
+        oid, cid = _new_channel(flow)
+        _dispatch(flow, oid, cid, count, latencies)  # warm-up
+        tracemalloc.start()
+        try:
+            for _ in range(rounds):
+                del latencies[:]
+                _dispatch(flow, oid, cid, count, latencies)
+                fakeglue.echo(flow, "x" * 1024)
+                samples.append(tracemalloc.get_traced_memory()[0])
+        finally:
+            tracemalloc.stop()
+    return dict(
+        rounds=rounds,
+        notificationsPerRound=count,
+        startBytes=samples[0],
+        endBytes=samples[-1],
+        growthBytes=samples[-1] - samples[0],
+        growthBytesPerRound=(samples[-1] - samples[0]) / float(
+            max(len(samples) - 1, 1)),
+    )
+
+
+def _message_payload(count):
+    """Returns the JSON of 'count' messages, in 10 channels
+    of one org, from 50 senders.
+    """
+    return json.dumps([
+        dict(
+            id="%032x" % index,
+            orgId="%032x" % 1,
+            channelId="%032x" % (index % 10),
+            senderAccountId="%032x" % (1000 + index % 50),
+            text="message %d" % index,
+            otherData=None,
+            attachments=[],
+            creationTime=time.time(),
+        )
+        for index in range(count)
+    ])
+
+
+def _traced_size(tracemalloc, build):
+    """Returns the bytes allocated by Python for the objects
+    returned by 'build' (they are kept alive while measuring).
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        objects = build()
+        size = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del objects
+    return size
+
+
+def bench_models(count):
+    """Memory of 'count' decoded messages as plain dicts vs. as
+    flow.models records (needs tracemalloc).
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        return dict(skipped="tracemalloc not available")
+    payload = _message_payload(count)
+    dicts = _traced_size(tracemalloc, lambda: json.loads(payload))
+    records = _traced_size(tracemalloc, lambda: list(models.RecordList(
+        json.loads(payload), models.Message)))
+    return dict(
+        messages=count,
+        dictBytesPerMessage=dicts / float(count),
+        recordBytesPerMessage=records / float(count),
+        recordToDictRatio=records / float(dicts),
+    )
+
+
+# Name -> (function, arguments, --quick arguments)
+BENCHMARKS = (
+    ("cold_start", bench_cold_start, (10,), (3,)),
+    ("rpc", bench_rpc, (2000,), (200,)),
+    ("notifications", bench_notifications, (1000, 10), (200, 3)),
+    ("memory", bench_memory, (200, 100), (50, 10)),
+    ("models", bench_models, (100000,), (10000,)),
+)
+
+
+def run(names=None, quick=False):
+    """Runs the benchmarks, returns the results dict."""
+    results = dict(
+        python=platform.python_version(),
+        implementation=platform.python_implementation(),
+        platform=platform.platform(),
+        timestamp=time.time(),
+        quick=quick,
+        benchmarks={},
+    )
+    for name, function, args, quick_args in BENCHMARKS:
+        if names and name not in names:
+            continue
+        sys.stderr.write("Running %s...\n" % name)
+        results["benchmarks"][name] = function(
+            *(quick_args if quick else args))
+    return results
+
+
+def _flatten(data, prefix=""):
+    """Returns a dict of dotted key -> number of a results dict."""
+    flat = {}
+    for key, value in data.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name + "."))
+        elif isinstance(value, (int, float)) \
+                and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def _higher_is_better(name):
+    return name.endswith("PerSec")
+
+
+def compare(old, new, threshold):
+    """Prints the change of each metric between two results dicts.
+    Returns the list of metrics that regressed by more than 'threshold'
+    percent (see _is_timing()).
+    """
+    old_flat = _flatten(old["benchmarks"])
+    new_flat = _flatten(new["benchmarks"])
+    regressions = []
+    print("%-50s %14s %14s %9s" % ("metric", "old", "new", "change"))
+    for name in sorted(set(old_flat) | set(new_flat)):
+        old_value = old_flat.get(name)
+        new_value = new_flat.get(name)
+        if old_value is None or new_value is None:
+            change = "n/a"
+        elif old_value == 0:
+            change = "0" if new_value == 0 else "n/a"
+        else:
+            pct = (new_value - old_value) * 100.0 / old_value
+            change = "%+.1f%%" % pct
+            worse = -pct if _higher_is_better(name) else pct
+            if _is_timing(name) and worse > threshold:
+                regressions.append(name)
+                change += " !"
+        print("%-50s %14s %14s %9s" % (
+            name, _format(old_value), _format(new_value), change))
+    return regressions
+
+
+def _is_timing(name):
+    """Whether a metric is checked for regressions: rates and
+    p50/p99 times (min and max are too noisy, and the rest, e.g.
+    amounts of calls or bytes, are not timings).
+    """
+    last = name.rsplit(".", 1)[-1]
+    return last.endswith("PerSec") or last in ("p50", "p99")
+
+
+def _format(value):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return "%.6g" % value
+    return str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    commands = parser.add_subparsers(dest="command")
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--output", help="JSON file, default stdout")
+    run_parser.add_argument(
+        "--only", nargs="+", choices=[name for name, _, _, _ in BENCHMARKS])
+    run_parser.add_argument(
+        "--quick", action="store_true", help="fewer iterations")
+    compare_parser = commands.add_parser(
+        "compare", help="compare two result files")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument(
+        "--threshold", type=float, default=10.0,
+        help="regression threshold, percent (default 10)")
+    args = parser.parse_args()
+    if args.command == "run":
+        results = json.dumps(run(args.only, args.quick), indent=2)
+        if args.output:
+            with open(args.output, "w") as output:
+                output.write(results + "\n")
+        else:
+            print(results)
+    elif args.command == "compare":
+        with open(args.old) as old, open(args.new) as new:
+            regressions = compare(json.load(old), json.load(new),
+                                  args.threshold)
+        if regressions:
+            print("\n%d regression(s) above %.1f%%: %s" % (
+                len(regressions), args.threshold, ", ".join(regressions)))
+            sys.exit(1)
+    else:
+        parser.print_help()
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
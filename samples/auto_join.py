@@ -27,17 +27,24 @@ flow.start_up()
 
 
 def accept(notif_type, notif_data):
-    for ojr in notif_data:
-        if ojr["orgId"] == team_id:
-            user_id = ojr["accountId"]
-            username = flow.get_peer_from_id(user_id)["username"]
-            # Add user to Team
-            flow.org_add_member(team_id, user_id, "m")
-            print("* user '%s' added to team." % username)
-            # Add user to all Channels within Team
-            for channel in flow.enumerate_channels(team_id):
-                flow.channel_add_member(team_id, channel["id"], user_id, "m")
-                print("  - also added to channel '%s'." % channel["name"])
+    user_ids = [ojr["accountId"] for ojr in notif_data
+                if ojr["orgId"] == team_id]
+    if not user_ids:
+        return
+    channels = flow.enumerate_channels(team_id)
+    # Desired state: users are members of the Team and all its Channels
+    desired = [(team_id, None, user_id, "m") for user_id in user_ids]
+    for channel in channels:
+        desired += [(team_id, channel["id"], user_id, "m")
+                    for user_id in user_ids]
+    # Only the missing memberships are added, concurrently
+    report = flow.reconcile_membership(desired)
+    for op in report["applied"]:
+        print("* %s: user '%s' added to '%s'." % (
+            op["op"], op["accountId"], op["channelId"] or op["orgId"]))
+    for op in report["failed"]:
+        print("# %s: user '%s' failed: %s" % (
+            op["op"], op["accountId"], op["error"]))
 
 # You can use 'register_callback' or just add the '@flow.org_join_request'
 # decorator to 'accept'
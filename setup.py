@@ -4,7 +4,10 @@ setup(name = "flow-python",
       version = "0.3",
       package_dir = { "flow": "src" },
       packages = [ "flow" ],
-      install_requires = [ "requests" ],
+      install_requires = [
+          "requests",
+          "futures; python_version < '3.2'",
+      ],
       keywords = [ "spideroak", "flow", "semaphor" ],
       author = "Lucas Manuel Rodriguez",
       author_email = "lucas@spideroak-inc.com",
@@ -0,0 +1,661 @@
+"""
+attachments.py
+Attachment helpers built on top of the Flow API.
+"""
+
+import os
+import collections
+import hashlib
+import json
+import mmap
+import threading
+import time
+from concurrent import futures
+
+from .flow import Flow, LOG
+
+# Monotonic clock when available (Python 3.3+)
+_clock = getattr(time, "monotonic", time.time)
+
+# Atomic rename when available (Python 3.3+)
+_replace = getattr(os, "replace", os.rename)
+
+
+def _event_items(data):
+    """Returns the data of an attachment notification
+    as a list of event dicts.
+    """
+    if isinstance(data, list):
+        return data
+    return [data] if data else []
+
+
+def _attachment_id(event):
+    """Returns the AttachmentID of an attachment event dict."""
+    return event.get("attachmentId") or event.get("id")
+
+
+def file_sha256(file_path):
+    """Returns the hex SHA-256 digest of the contents of a file.
+    The file is memory-mapped, so it's never loaded in memory.
+    """
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as file_obj:
+        # Empty files cannot be mapped
+        if os.fstat(file_obj.fileno()).st_size:
+            mapped = mmap.mmap(
+                file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                hasher.update(mapped)
+            finally:
+                mapped.close()
+    return hasher.hexdigest()
+
+
+class AttachmentIndex(object):
+    """Content-addressed index of uploaded attachments.
+    Attachments are indexed by OrgID and SHA-256 of the file contents,
+    so uploading the same contents twice to an org returns the
+    'Attachment' dict of the first upload instead of uploading again.
+    Uploads are indexed when their 'upload-complete-event' is received
+    (through notification listeners, so the notification loop of the
+    session must be running), failed uploads are not indexed.
+    The entries read from the persisted index are checked with the
+    backend (stored_attachment_path()) the first time they are used,
+    the ones it doesn't know (e.g. the index was written by another
+    backend) are dropped and uploaded again.
+    Usage:
+    index = AttachmentIndex(flow, path="/path/to/attachment_index.json")
+    attachment = index.new_attachment(oid, "/tmp/report.pdf")
+    flow.send_message(oid, cid, "report", attachments=[attachment])
+    index.close()
+    """
+
+    # Notification types of the upload outcomes
+    _NOTIFICATIONS = (
+        Flow.UPLOAD_COMPLETE_NOTIFICATION,
+        Flow.UPLOAD_ERROR_NOTIFICATION,
+    )
+
+    def __init__(self, flow, path=None):
+        """Arguments:
+        flow : Flow instance.
+        path : string, JSON file where the index is persisted,
+        if not provided the index is kept in memory only.
+        """
+        self.flow = flow
+        self.path = path
+        self._lock = threading.Lock()
+        self._index = {}  # OrgID -> {SHA-256 -> 'Attachment' dict}
+        # (OrgID, SHA-256) of the entries read from 'path'
+        # that were not checked with the backend yet
+        self._unverified = set()
+        # (OrgID, SHA-256) -> Future of the upload, it resolves on the
+        # upload outcome
+        self._pending = {}
+        # Registered uploads not complete yet,
+        # AttachmentID -> (OrgID, SHA-256, 'Attachment' dict)
+        self._uploading = {}
+        # Outcomes received while new_attachment() calls are pending,
+        # AttachmentID -> (notification type, event dict)
+        self._early_events = {}
+        self._registering = 0
+        self._sids = set()  # sessions with listeners
+        if path and os.path.exists(path):
+            with open(path) as index_file:
+                self._index = json.load(index_file)
+            self._unverified = set(
+                (oid, digest)
+                for oid, digests in self._index.items()
+                for digest in digests)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(digests) for digests in self._index.values())
+
+    def lookup(self, oid, file_path, sid=0, timeout=None):
+        """Returns the 'Attachment' dict of a file already uploaded to
+        the org with the same contents, or 'None' if there isn't any.
+        """
+        attachment = self._indexed(
+            oid, file_sha256(file_path), sid, timeout)
+        if attachment is None:
+            return None
+        return self._renamed(attachment, file_path)
+
+    def new_attachment(self, oid, file_path, sid=0, timeout=None):
+        """Same as Flow.new_attachment() but the upload is skipped if
+        a file with the same contents was already uploaded to the org.
+        If the same contents are being uploaded, then it waits (up to
+        'timeout' seconds) for that upload to complete, and raises
+        Flow.FlowError if it fails.
+        Returns an 'Attachment' dict ready to be used on send_message().
+        """
+        digest = file_sha256(file_path)
+        sid = self.flow._get_session_id(sid)
+        self._listen(sid)
+        attachment = self._indexed(oid, digest, sid, timeout)
+        with self._lock:
+            if attachment is None:
+                attachment = self._index.get(oid, {}).get(digest)
+            pending = self._pending.get((oid, digest))
+            upload = None
+            if attachment is None and pending is None:
+                upload = futures.Future()
+                self._pending[(oid, digest)] = upload
+                self._registering += 1
+        if attachment is not None:
+            return self._renamed(attachment, file_path)
+        if pending is not None:
+            # Same contents being uploaded by another call
+            try:
+                return self._renamed(pending.result(timeout), file_path)
+            except futures.TimeoutError:
+                raise Flow.FlowTimeoutError(
+                    "Upload of the same contents not complete after "
+                    "%s secs." % timeout)
+        try:
+            attachment = self.flow.new_attachment(
+                oid, file_path, sid=sid, timeout=timeout)
+            aid = attachment["id"]
+        except Exception as exception:
+            with self._lock:
+                del self._pending[(oid, digest)]
+                self._registering -= 1
+                self._drop_early_events()
+            upload.set_exception(exception)
+            raise
+        with self._lock:
+            self._registering -= 1
+            self._uploading[aid] = (oid, digest, attachment)
+            outcome = self._early_events.pop(aid, None)
+            self._drop_early_events()
+        if outcome is not None:
+            self._finish(aid, *outcome)
+        return attachment
+
+    def forget(self, oid, digest=None):
+        """Removes an entry (or all the entries of the org
+        if 'digest' is not provided) from the index.
+        """
+        with self._lock:
+            if digest is None:
+                self._index.pop(oid, None)
+            else:
+                self._index.get(oid, {}).pop(digest, None)
+            self._save()
+
+    def close(self):
+        """Removes the notification listeners. Uploads in progress
+        are not indexed after this, and the calls waiting for them
+        raise Flow.FlowError.
+        """
+        with self._lock:
+            sids = list(self._sids)
+            self._sids.clear()
+            uploads = list(self._pending.values())
+            self._pending.clear()
+            self._uploading.clear()
+        for sid in sids:
+            for notification_name in self._NOTIFICATIONS:
+                self.flow.remove_notification_listener(
+                    notification_name, self._on_event, sid=sid)
+        for upload in uploads:
+            if not upload.done():
+                upload.set_exception(
+                    Flow.FlowError("Attachment index closed."))
+
+    def _indexed(self, oid, digest, sid, timeout):
+        """Returns the indexed 'Attachment' dict of the contents, or
+        'None'. Entries read from 'path' are checked with the backend
+        first, they are dropped if it doesn't know the attachment.
+        """
+        with self._lock:
+            attachment = self._index.get(oid, {}).get(digest)
+            if attachment is None or (oid, digest) not in self._unverified:
+                return attachment
+        try:
+            self.flow.stored_attachment_path(
+                oid, attachment["id"], sid=sid, timeout=timeout)
+        except (Flow.FlowConnectionError, Flow.FlowTimeoutError):
+            raise
+        except Flow.FlowError as flow_err:
+            LOG.debug("Dropping attachment '%s' from the index: %s",
+                      attachment["id"], flow_err)
+            attachment = None
+        with self._lock:
+            self._unverified.discard((oid, digest))
+            if attachment is None:
+                self._index.get(oid, {}).pop(digest, None)
+                self._save()
+        return attachment
+
+    def _listen(self, sid):
+        """Adds the notification listeners to a session,
+        if they were not added yet.
+        """
+        with self._lock:
+            if sid in self._sids:
+                return
+            self._sids.add(sid)
+        for notification_name in self._NOTIFICATIONS:
+            self.flow.add_notification_listener(
+                notification_name, self._on_event, sid=sid)
+
+    def _drop_early_events(self):
+        """Forgets the buffered outcomes once no registration is pending,
+        they belong to attachments that are not uploaded here.
+        """
+        if not self._registering:
+            self._early_events.clear()
+
+    def _on_event(self, notification_name, data):
+        """Notification listener for the upload outcomes."""
+        for event in _event_items(data):
+            aid = _attachment_id(event)
+            with self._lock:
+                if aid not in self._uploading:
+                    if self._registering:
+                        self._early_events[aid] = (notification_name, event)
+                    continue
+            self._finish(aid, notification_name, event)
+
+    def _finish(self, aid, notification_name, event):
+        """Indexes a registered upload when it completes, or forgets it
+        when it fails, and resolves the calls waiting for it.
+        """
+        with self._lock:
+            entry = self._uploading.pop(aid, None)
+            if entry is None:
+                return
+            oid, digest, attachment = entry
+            upload = self._pending.pop((oid, digest), None)
+            completed = \
+                notification_name == Flow.UPLOAD_COMPLETE_NOTIFICATION
+            if completed:
+                self._index.setdefault(oid, {})[digest] = attachment
+                self._save()
+        if upload is None:
+            return
+        if completed:
+            upload.set_result(attachment)
+        else:
+            upload.set_exception(Flow.FlowError(
+                event.get("error") or
+                "Upload of '%s' failed." % attachment["filename"]))
+
+    @staticmethod
+    def _renamed(attachment, file_path):
+        """Returns a copy of the 'Attachment' dict
+        with the file name of 'file_path'.
+        """
+        return dict(attachment, filename=os.path.basename(file_path))
+
+    def _save(self):
+        """Writes the index to 'path' (if set) atomically."""
+        if not self.path:
+            return
+        tmp_path = "%s.tmp" % self.path
+        with open(tmp_path, "w") as index_file:
+            json.dump(self._index, index_file)
+        _replace(tmp_path, self.path)
+
+
+class _AttachmentManager(object):
+    """Base class for the managers that track attachment transfers
+    through notification listeners. Subclasses define the listener,
+    _on_event(notification_name, data), of the _NOTIFICATIONS types.
+    """
+
+    # Notification types handled by the manager
+    _NOTIFICATIONS = ()
+
+    def __init__(self, flow, max_workers, sid):
+        """Arguments:
+        flow : Flow instance.
+        max_workers : int, size of the thread pool used for API calls.
+        sid : int, SessionID.
+        """
+        self.flow = flow
+        self.sid = flow._get_session_id(sid)
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=max_workers or Flow._DEFAULT_MAX_WORKERS)
+        self._lock = threading.Lock()
+        for notification_name in self._NOTIFICATIONS:
+            flow.add_notification_listener(
+                notification_name, self._on_event, sid=self.sid)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self, wait=True):
+        """Removes the notification listeners and
+        shuts down the thread pool.
+        """
+        for notification_name in self._NOTIFICATIONS:
+            self.flow.remove_notification_listener(
+                notification_name, self._on_event, sid=self.sid)
+        self._executor.shutdown(wait=wait)
+
+
+class UploadManager(_AttachmentManager):
+    """Uploads many files concurrently and tracks each upload
+    to completion through the 'upload-*' notifications.
+    The notification loop of the session must be running
+    (see Flow.start_up()), the notifications are handled with
+    notification listeners so there is no need to register callbacks
+    or to call process_notifications() for the futures to resolve.
+    Usage:
+    with UploadManager(flow) as manager:
+        uploads = manager.upload(oid, ["/tmp/a.png", "/tmp/b.png"])
+        attachments = [upload.result() for upload in uploads]
+    flow.send_message(oid, cid, "files", attachments=attachments)
+    """
+
+    _NOTIFICATIONS = (
+        Flow.UPLOAD_START_NOTIFICATION,
+        Flow.UPLOAD_PROGRESS_NOTIFICATION,
+        Flow.UPLOAD_COMPLETE_NOTIFICATION,
+        Flow.UPLOAD_ERROR_NOTIFICATION,
+    )
+
+    def __init__(self, flow, max_workers=None, sid=0):
+        """Arguments:
+        flow : Flow instance.
+        max_workers : int, maximum number of concurrent
+        new_attachment() calls.
+        sid : int, SessionID.
+        """
+        super(UploadManager, self).__init__(flow, max_workers, sid)
+        self._uploads = {}  # AttachmentID -> upload dict
+        # Events received while new_attachment() calls are pending,
+        # AttachmentID -> list of (notification type, event dict)
+        self._early_events = {}
+        self._registering = 0
+        self._in_flight = 0
+        self._completed = 0
+        self._failed = 0
+        self._completed_bytes = 0
+        self._start_time = None
+
+    def submit(self, oid, file_path, timeout=None):
+        """Queues the upload of a file to an org.
+        file_path must be the absolute path.
+        Returns a future that resolves to the 'Attachment' dict when the
+        'upload-complete-event' is received, or fails with a
+        Flow.FlowError on 'upload-error-event' (or if the file
+        cannot be accessed).
+        """
+        future = futures.Future()
+        with self._lock:
+            self._in_flight += 1
+            self._registering += 1
+            if self._start_time is None:
+                self._start_time = _clock()
+        self._executor.submit(
+            self._start_upload, future, oid, file_path, timeout)
+        return future
+
+    def upload(self, oid, file_paths, timeout=None):
+        """Queues the upload of many files to an org.
+        Returns a list of futures, one per file (see submit()).
+        """
+        return [
+            self.submit(oid, file_path, timeout=timeout)
+            for file_path in file_paths
+        ]
+
+    def stats(self):
+        """Returns an 'UploadStats' dict with the amount of uploads
+        'inFlight', 'completed' and 'failed', the 'bytes' uploaded
+        and the aggregate 'throughput' in bytes per second.
+        """
+        with self._lock:
+            transferred = self._completed_bytes + sum(
+                upload["bytes"] for upload in self._uploads.values())
+            elapsed = _clock() - self._start_time \
+                if self._start_time is not None else 0
+            return dict(
+                inFlight=self._in_flight,
+                completed=self._completed,
+                failed=self._failed,
+                bytes=transferred,
+                throughput=transferred / elapsed if elapsed > 0 else 0.0,
+            )
+
+    def _start_upload(self, future, oid, file_path, timeout):
+        """Registers the attachment with new_attachment()."""
+        try:
+            Flow._check_file_exists(file_path)
+            size = os.path.getsize(file_path)
+            attachment = self.flow.new_attachment(
+                oid, file_path, sid=self.sid, timeout=timeout)
+            aid = attachment["id"]
+            upload = dict(future=future, attachment=attachment,
+                          size=size, bytes=0)
+        except Exception as exception:
+            with self._lock:
+                self._registering -= 1
+                self._in_flight -= 1
+                self._failed += 1
+                self._drop_early_events()
+            future.set_exception(exception)
+            return
+        with self._lock:
+            self._registering -= 1
+            self._uploads[aid] = upload
+            early_events = self._early_events.pop(aid, [])
+            self._drop_early_events()
+        for notification_name, event in early_events:
+            self._handle_event(upload, notification_name, event)
+
+    def _drop_early_events(self):
+        """Forgets the buffered events once no registration is pending,
+        they belong to attachments that are not managed here.
+        """
+        if not self._registering:
+            self._early_events.clear()
+
+    def _on_event(self, notification_name, data):
+        """Notification listener for the 'upload-*' notifications."""
+        for event in _event_items(data):
+            aid = _attachment_id(event)
+            with self._lock:
+                upload = self._uploads.get(aid)
+                if upload is None:
+                    if self._registering:
+                        self._early_events.setdefault(aid, []).append(
+                            (notification_name, event))
+                    continue
+            self._handle_event(upload, notification_name, event)
+
+    def _handle_event(self, upload, notification_name, event):
+        """Updates the upload state with an 'upload-*' event dict."""
+        if notification_name == Flow.UPLOAD_PROGRESS_NOTIFICATION:
+            transferred = event.get("bytes")
+            if isinstance(transferred, (int, float)):
+                with self._lock:
+                    upload["bytes"] = min(transferred, upload["size"])
+            return
+        if notification_name not in (Flow.UPLOAD_COMPLETE_NOTIFICATION,
+                                     Flow.UPLOAD_ERROR_NOTIFICATION):
+            return
+        with self._lock:
+            if self._uploads.pop(upload["attachment"]["id"], None) is None:
+                return
+            self._in_flight -= 1
+            if notification_name == Flow.UPLOAD_COMPLETE_NOTIFICATION:
+                self._completed += 1
+                self._completed_bytes += upload["size"]
+            else:
+                self._failed += 1
+        if notification_name == Flow.UPLOAD_COMPLETE_NOTIFICATION:
+            upload["future"].set_result(upload["attachment"])
+        else:
+            upload["future"].set_exception(Flow.FlowError(
+                event.get("error") or
+                "Upload of '%s' failed." % upload["attachment"]["filename"]))
+
+
+class DownloadManager(_AttachmentManager):
+    """Downloads many attachments keeping at most 'max_in_flight'
+    downloads started at the same time, the rest are queued.
+    Each download is tracked to completion through the 'download-*'
+    notifications (see UploadManager about the notification loop).
+    Usage:
+    with DownloadManager(flow, target_dir="/srv/archive") as manager:
+        download = manager.submit(aid, oid, cid, mid)
+        print(download.result())  # final path of the attachment
+    """
+
+    _NOTIFICATIONS = (
+        Flow.DOWNLOAD_COMPLETE_NOTIFICATION,
+        Flow.DOWNLOAD_ERROR_NOTIFICATION,
+    )
+
+    _DEFAULT_MAX_IN_FLIGHT = 4
+
+    def __init__(self, flow, max_in_flight=None,
+                 target_dir=None, max_workers=None, sid=0):
+        """Arguments:
+        flow : Flow instance.
+        max_in_flight : int, maximum number of started downloads.
+        target_dir : string, if provided the downloaded attachments
+        are moved to this directory with update_attachment_path(),
+        the backend moves the file so no extra copy is made.
+        max_workers : int, size of the thread pool used for API calls.
+        sid : int, SessionID.
+        """
+        super(DownloadManager, self).__init__(flow, max_workers, sid)
+        self.max_in_flight = max_in_flight or self._DEFAULT_MAX_IN_FLIGHT
+        self.target_dir = target_dir
+        self._pending = collections.deque()  # download dicts not started
+        self._downloads = {}  # AttachmentID -> download dict
+        self._in_flight = 0
+        self._completed = 0
+        self._failed = 0
+
+    def submit(self, aid, oid, cid, mid, target_dir=None,
+               filename=None, timeout=None):
+        """Queues the download of an attachment of a message.
+        Arguments:
+        target_dir : string, overrides the manager 'target_dir'.
+        filename : string, name of the file on 'target_dir',
+        by default it keeps the name of the stored attachment.
+        Returns a future that resolves to the final path of the attachment
+        when the 'download-complete-event' is received, or fails with a
+        Flow.FlowError on 'download-error-event'.
+        If the attachment is already queued or downloading, then
+        the future of that download is returned.
+        """
+        target_dir = target_dir or self.target_dir
+        if target_dir:
+            Flow._check_file_exists(target_dir, True)
+        with self._lock:
+            if aid in self._downloads:
+                return self._downloads[aid]["future"]
+            download = dict(
+                future=futures.Future(),
+                aid=aid,
+                oid=oid,
+                cid=cid,
+                mid=mid,
+                target_dir=target_dir,
+                filename=filename,
+                timeout=timeout,
+                started=False,
+            )
+            self._downloads[aid] = download
+            self._pending.append(download)
+        self._start_pending()
+        return download["future"]
+
+    def stats(self):
+        """Returns a 'DownloadStats' dict with the amount of downloads
+        'queued', 'inFlight', 'completed' and 'failed'.
+        """
+        with self._lock:
+            return dict(
+                queued=len(self._pending),
+                inFlight=self._in_flight,
+                completed=self._completed,
+                failed=self._failed,
+            )
+
+    def _start_pending(self):
+        """Starts queued downloads while below 'max_in_flight'."""
+        to_start = []
+        with self._lock:
+            while self._pending and self._in_flight < self.max_in_flight:
+                self._in_flight += 1
+                download = self._pending.popleft()
+                download["started"] = True
+                to_start.append(download)
+        for download in to_start:
+            self._executor.submit(self._start_download, download)
+
+    def _start_download(self, download):
+        """Requests the download with start_attachment_download()."""
+        try:
+            self.flow.start_attachment_download(
+                download["aid"], download["oid"], download["cid"],
+                download["mid"], sid=self.sid, timeout=download["timeout"])
+        except Exception as exception:
+            self._finish(download, exception=exception)
+
+    def _complete_download(self, download):
+        """Resolves the final path of a completed download
+        and moves it to the target directory if needed.
+        """
+        try:
+            path = self.flow.stored_attachment_path(
+                download["oid"], download["aid"],
+                sid=self.sid, timeout=download["timeout"])
+            if download["target_dir"]:
+                new_path = os.path.join(
+                    download["target_dir"],
+                    download["filename"] or os.path.basename(path))
+                self.flow.update_attachment_path(
+                    download["aid"], new_path,
+                    sid=self.sid, timeout=download["timeout"])
+                path = new_path
+        except Exception as exception:
+            self._finish(download, exception=exception)
+        else:
+            self._finish(download, path=path)
+
+    def _finish(self, download, path=None, exception=None):
+        """Resolves the future of a download and starts the next one."""
+        with self._lock:
+            if self._downloads.pop(download["aid"], None) is None:
+                return
+            self._in_flight -= 1
+            if exception is None:
+                self._completed += 1
+            else:
+                self._failed += 1
+        if exception is None:
+            download["future"].set_result(path)
+        else:
+            download["future"].set_exception(exception)
+        self._start_pending()
+
+    def _on_event(self, notification_name, data):
+        """Notification listener for the 'download-*' notifications."""
+        for event in _event_items(data):
+            with self._lock:
+                download = self._downloads.get(_attachment_id(event))
+            # Queued downloads are not counted as in flight, their
+            # events come from downloads requested by others
+            if download is None or not download["started"]:
+                continue
+            if notification_name == Flow.DOWNLOAD_COMPLETE_NOTIFICATION:
+                # Don't block the notification thread with API calls
+                self._executor.submit(self._complete_download, download)
+            else:
+                self._finish(download, exception=Flow.FlowError(
+                    event.get("error") or
+                    "Download of '%s' failed." % download["aid"]))
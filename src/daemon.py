@@ -0,0 +1,96 @@
+"""
+daemon.py
+Keeps a configured flowappglue backend running, so that short-lived
+scripts can attach to it with Flow.from_daemon() instead of starting
+and configuring their own backend.
+usage:
+python -m flow.daemon [--state-file PATH] [--db-dir DIR] ...
+"""
+
+import os
+import json
+import signal
+import argparse
+import threading
+
+from . import definitions
+from .flow import Flow, LOG
+
+
+def write_state_file(path, flow):
+    """Writes the backend port and token of 'flow' to 'path'.
+    The file is only readable by the current user,
+    the token grants access to the backend.
+    """
+    state = json.dumps(dict(
+        port=flow._port,
+        token=flow._token,
+        pid=os.getpid(),
+    ))
+    tmp_path = "%s.tmp" % path
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as state_file:
+        state_file.write(state)
+    os.rename(tmp_path, path)
+
+
+def run(state_file=None, **flow_args):
+    """Starts the backend and blocks until SIGTERM/SIGINT
+    is received or the backend exits.
+    Arguments:
+    state_file : string, where the port and token are written,
+    defaults to definitions.get_default_daemon_state_path().
+    flow_args : kwargs, Flow() arguments.
+    """
+    state_file = state_file or definitions.get_default_daemon_state_path()
+    stop = threading.Event()
+
+    def on_signal(signum, frame):
+        """Stops the daemon."""
+        stop.set()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    flow = Flow(**flow_args)
+    try:
+        write_state_file(state_file, flow)
+        LOG.info("backend ready on port %s", flow._port)
+        while not stop.is_set() and not flow._backend_exited():
+            stop.wait(1)
+    finally:
+        if os.path.exists(state_file):
+            os.remove(state_file)
+        flow.terminate()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m flow.daemon",
+        description="Keeps a flowappglue backend running for "
+                    "Flow.from_daemon() clients.",
+    )
+    parser.add_argument("--state-file")
+    parser.add_argument("--flowappglue")
+    parser.add_argument("--db-dir")
+    parser.add_argument("--schema-dir")
+    parser.add_argument("--attachment-dir")
+    parser.add_argument("--host", default=definitions.DEFAULT_SERVER)
+    parser.add_argument("--port", default=definitions.DEFAULT_PORT)
+    parser.add_argument("--use-tls", default=definitions.DEFAULT_USE_TLS)
+    parser.add_argument("--server-uri", default=definitions.DEFAULT_URI)
+    args = parser.parse_args(argv)
+    run(
+        state_file=args.state_file,
+        flowappglue=args.flowappglue,
+        db_dir=args.db_dir,
+        schema_dir=args.schema_dir,
+        attachment_dir=args.attachment_dir,
+        host=args.host,
+        port=args.port,
+        use_tls=args.use_tls,
+        server_uri=args.server_uri,
+    )
+
+
+if __name__ == "__main__":
+    main()
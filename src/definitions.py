@@ -5,6 +5,7 @@ definitions.py
 import os
 import sys
 import time
+import threading
 
 
 # Sane default definitions
@@ -32,11 +33,16 @@ _DEFAULT_APP_WINDOWS_PATH = r"Semaphor\resources\app"
 
 # Default dirs and binaries
 _DEFAULT_ATTACHMENT_DIR = "downloads"
+_DEFAULT_DAEMON_STATE_FILE = "backend.json"
 _DEFAULT_SCHEMA_DIR = "schema"
 _EXE_EXT = ".exe" if sys.platform == "win32" else ""
 _DEFAULT_FLOWAPPGLUE_BINARY_DEV_NAME = "flowappglue%s" % _EXE_EXT
 _DEFAULT_FLOWAPPGLUE_BINARY_PROD_NAME = "semaphor-backend%s" % _EXE_EXT
 
+# Log filenames generated on the current second -> count
+_GLUE_OUT_COUNTS = {}
+_GLUE_OUT_LOCK = threading.Lock()
+
 
 def _osx_app_path():
     """Returns the default application directory for OSX."""
@@ -125,12 +131,32 @@ def get_default_flowappglue_path():
     return flowappglue_path
 
 
-def get_default_glue_out_filename():
+def get_default_glue_out_filename(db_dir=None):
     """Returns a string with a default filename for the
-    flowappglue output log file.
-    Default Format: "semaphor_backend_%Y%m%d%H%M%S.log".
+    flowappglue output log file, under 'db_dir' (the default
+    db path if not provided).
+    Default Format: "semaphor_backend_%Y%m%d%H%M%S.log",
+    the following filenames generated by the process on the
+    same second get a "_N" suffix.
     """
+    filename = time.strftime("semaphor_backend_%Y%m%d%H%M%S")
+    with _GLUE_OUT_LOCK:
+        count = _GLUE_OUT_COUNTS.get(filename, 0)
+        # Only the current second is needed
+        _GLUE_OUT_COUNTS.clear()
+        _GLUE_OUT_COUNTS[filename] = count + 1
+    if count:
+        filename = "%s_%d" % (filename, count)
     return os.path.join(
-        get_default_db_path(),
-        time.strftime("semaphor_backend_%Y%m%d%H%M%S.log")
+        db_dir or get_default_db_path(),
+        "%s.log" % filename,
     )
+
+
+def get_default_daemon_state_path():
+    """Returns the default path of the file where the flow.daemon
+    module writes the port and token of its flowappglue.
+    E.g. on Linux it would be:
+    $HOME/.config/flow-python/backend.json.
+    """
+    return os.path.join(_get_config_path(), _DEFAULT_DAEMON_STATE_FILE)
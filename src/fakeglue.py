@@ -0,0 +1,725 @@
+#!/usr/bin/env python
+"""
+fakeglue.py
+Stand-in for the flowappglue backend, for offline testing and
+benchmarking. It speaks the same protocol: it prints a {"token", "port"}
+JSON line on startup and serves the JSON-RPC API on /rpc, keeping the
+accounts, orgs, channels, messages and attachments in memory.
+Latency and errors can be injected, and notification bursts generated
+(see set_faults(), deliver_message() and notification_burst()).
+usage:
+python -m flow.fakeglue [--latency SECS] [--error-rate RATE] [--strict]
+                        [PORT]
+Flow(flowappglue=flow.fakeglue.get_path())
+This module only depends on the standard library, so that it can also
+be executed directly as a script.
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+import uuid
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+
+def get_path():
+    """Returns the path of the fake backend executable, to be used as
+    the 'flowappglue' argument of Flow().
+    """
+    path = os.path.abspath(__file__)
+    if path.endswith(".pyc"):
+        path = path[:-1]
+    return path
+
+
+def _new_id():
+    """Returns a random hex id."""
+    return uuid.uuid4().hex
+
+
+class FakeError(Exception):
+    """Error returned in the 'error' field of the response."""
+    pass
+
+
+class FakeBackend(object):
+    """In-memory state and API methods of the fake backend.
+    API methods are the methods named 'rpc_<API method name>',
+    they receive the request params as keyword arguments.
+    """
+
+    def __init__(self, strict=False, latency=0.0, error_rate=0.0,
+                 seed=None):
+        """Arguments:
+        strict : bool, if False, then StartUp creates the local account
+        if it doesn't exist.
+        latency : float, seconds added to every API call
+        (except WaitForNotification).
+        error_rate : float, probability of an injected error.
+        seed : int, seed of the random generator of the errors.
+        """
+        self.strict = strict
+        self.latency = latency
+        self.error_rate = error_rate
+        self.fault_methods = None  # None means all the methods
+        # Method -> [list of canned responses, index of the next one]
+        self.canned = {}
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self.attachment_dir = None
+        self.accounts = {}  # Username -> account dict
+        self.local_accounts = []  # Usernames
+        self.sessions = {}  # SessionID -> session dict
+        self._next_sid = 1
+        self.orgs = collections.OrderedDict()  # OrgID -> org dict
+        self.org_members = {}  # OrgID -> {AccountID -> state}
+        self.channels = collections.OrderedDict()  # ChannelID -> dict
+        self.channel_members = {}  # ChannelID -> {AccountID -> state}
+        self.messages = {}  # ChannelID -> list of message dicts
+        self.attachments = {}  # AttachmentID -> attachment dict
+
+    # Helpers
+
+    def _session(self, sid):
+        if sid not in self.sessions:
+            raise FakeError("Unknown SessionID %s." % sid)
+        return self.sessions[sid]
+
+    def _account(self, sid):
+        """Returns the account started on a session."""
+        username = self._session(sid)["username"]
+        if username is None:
+            raise FakeError("No account started on session %s." % sid)
+        return self.accounts[username]
+
+    def _get_or_create_account(self, username, local=True):
+        account = self.accounts.get(username)
+        if account is None:
+            account = dict(
+                accountId=_new_id(),
+                username=username,
+                deviceId=_new_id(),
+            )
+            self.accounts[username] = account
+        if local and username not in self.local_accounts:
+            self.local_accounts.append(username)
+        return account
+
+    def _peer(self, account):
+        return dict(
+            accountId=account["accountId"],
+            username=account["username"],
+        )
+
+    def _account_by_id(self, account_id):
+        for account in self.accounts.values():
+            if account["accountId"] == account_id:
+                return account
+        raise FakeError("Unknown account '%s'." % account_id)
+
+    def _org(self, oid):
+        if oid not in self.orgs:
+            raise FakeError("Unknown org '%s'." % oid)
+        return self.orgs[oid]
+
+    def _channel(self, cid):
+        if cid not in self.channels:
+            raise FakeError("Unknown channel '%s'." % cid)
+        return self.channels[cid]
+
+    def notify(self, account_ids, notif_type, data):
+        """Queues a notification for the sessions of 'account_ids'."""
+        with self._lock:
+            for session in self.sessions.values():
+                account = self.accounts.get(session["username"])
+                if account is not None \
+                   and account["accountId"] in account_ids:
+                    session["changes"].append(
+                        dict(type=notif_type, data=data))
+                    session["cond"].notify_all()
+
+    # Fault injection
+
+    def inject_faults(self, method):
+        """Applies the configured latency and errors to a call."""
+        if method == "WaitForNotification":
+            return
+        if self.fault_methods is not None \
+           and method not in self.fault_methods:
+            return
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and self._random.random() < self.error_rate:
+            raise FakeError("Injected error on '%s'." % method)
+
+    def call(self, method, params):
+        """Executes an API method, returns its result."""
+        if method in self.canned:
+            self.inject_faults(method)
+            return self._canned_response(method)
+        handler = getattr(self, "rpc_%s" % method, None)
+        if handler is None:
+            raise FakeError(
+                "Method '%s' not supported by the fake backend." % method)
+        self.inject_faults(method)
+        return handler(**params)
+
+    def _canned_response(self, method):
+        """Returns the next canned response of a method (in a loop)."""
+        with self._lock:
+            responses = self.canned[method]
+            response = responses[0][responses[1]]
+            responses[1] = (responses[1] + 1) % len(responses[0])
+        if response.get("error"):
+            raise FakeError(response["error"])
+        return response.get("result")
+
+    # Control methods (not part of the flowappglue API)
+
+    def rpc_FakeSetFaults(self, Latency=0.0, ErrorRate=0.0, Methods=None,
+                          SessionID=None):
+        """Sets the latency and error rate of the API calls, for
+        all the methods or only the ones in 'Methods'.
+        """
+        with self._lock:
+            self.latency = Latency
+            self.error_rate = ErrorRate
+            self.fault_methods = set(Methods) if Methods else None
+
+    def rpc_FakeSetCannedResponses(self, Responses, SessionID=None):
+        """Sets the responses of API methods, instead of executing them.
+        'Responses' maps each method to a list of dicts with 'result'
+        or 'error', returned in a loop. An empty list removes the
+        canned responses of a method.
+        """
+        with self._lock:
+            for method, responses in Responses.items():
+                if responses:
+                    self.canned[method] = [responses, 0]
+                else:
+                    self.canned.pop(method, None)
+
+    def rpc_FakeNotify(self, SessionID, Changes):
+        """Queues notifications (dicts with 'type' and 'data')
+        for a session.
+        """
+        with self._lock:
+            session = self._session(SessionID)
+            session["changes"].extend(Changes)
+            session["cond"].notify_all()
+
+    def rpc_FakeEcho(self, Payload=None, SessionID=None):
+        """Returns 'Payload', to measure the API round trip."""
+        return Payload
+
+    def rpc_FakeDeliverMessage(self, OrgID, ChannelID, Text,
+                               SenderUsername="fake-peer",
+                               SessionID=None):
+        """Delivers a message from 'SenderUsername' (created
+        if it doesn't exist) to a channel.
+        """
+        with self._lock:
+            sender = self._get_or_create_account(SenderUsername, local=False)
+            return self._send_message(sender, OrgID, ChannelID, Text)
+
+    def rpc_FakeNotificationBurst(self, OrgID, ChannelID, Count,
+                                  SenderUsername="fake-peer",
+                                  SessionID=None):
+        """Delivers 'Count' messages to a channel at once."""
+        with self._lock:
+            for index in range(Count):
+                self.rpc_FakeDeliverMessage(
+                    OrgID, ChannelID, "burst %d" % index, SenderUsername)
+
+    # Backend and sessions
+
+    def rpc_Config(self, FlowLocalAttachmentDir=None, **params):
+        self.attachment_dir = FlowLocalAttachmentDir
+
+    def rpc_NewSession(self):
+        with self._lock:
+            sid = self._next_sid
+            self._next_sid += 1
+            self.sessions[sid] = dict(
+                username=None,
+                changes=[],
+                cond=threading.Condition(self._lock),
+            )
+            return dict(SessionID=sid)
+
+    def rpc_WaitForNotification(self, SessionID):
+        with self._lock:
+            session = self._session(SessionID)
+            while not session["changes"]:
+                session["cond"].wait()
+            changes = session["changes"]
+            session["changes"] = []
+        return changes
+
+    def rpc_EnumerateLocalAccounts(self):
+        with self._lock:
+            return [dict(username=username, accountId=self.accounts[
+                username]["accountId"]) for username in self.local_accounts]
+
+    def _start_account(self, sid, username):
+        with self._lock:
+            session = self._session(sid)
+            session["username"] = username
+
+    def rpc_StartUp(self, SessionID, Username, ServerURI=None):
+        with self._lock:
+            if Username not in self.local_accounts:
+                if self.strict:
+                    raise FakeError(
+                        "No local account for '%s'." % Username)
+                self._get_or_create_account(Username)
+            self._start_account(SessionID, Username)
+
+    def rpc_CreateAccount(self, SessionID, Username, **params):
+        with self._lock:
+            if Username in self.accounts:
+                raise FakeError("Username '%s' is taken." % Username)
+            self._get_or_create_account(Username)
+            self._start_account(SessionID, Username)
+
+    def rpc_CreateDevice(self, SessionID, Username, **params):
+        with self._lock:
+            if Username not in self.accounts:
+                raise FakeError("Unknown account '%s'." % Username)
+            self._get_or_create_account(Username)
+            self._start_account(SessionID, Username)
+
+    def rpc_AccountId(self, SessionID):
+        with self._lock:
+            return self._account(SessionID)["accountId"]
+
+    def rpc_DeviceId(self, SessionID):
+        with self._lock:
+            return self._account(SessionID)["deviceId"]
+
+    def rpc_Identifier(self, SessionID):
+        with self._lock:
+            account = self._account(SessionID)
+            return dict(
+                username=account["username"],
+                accountId=account["accountId"],
+                deviceId=account["deviceId"],
+            )
+
+    def rpc_BuildNumber(self, SessionID):
+        return "fakeglue"
+
+    def rpc_Pause(self, SessionID):
+        pass
+
+    def rpc_Resume(self, SessionID):
+        pass
+
+    # Peers
+
+    def rpc_GetPeer(self, SessionID, PeerUsername):
+        with self._lock:
+            if PeerUsername not in self.accounts:
+                raise FakeError("Unknown peer '%s'." % PeerUsername)
+            return self._peer(self.accounts[PeerUsername])
+
+    def rpc_GetPeerFromID(self, SessionID, PeerID):
+        with self._lock:
+            return self._peer(self._account_by_id(PeerID))
+
+    def rpc_EnumeratePeerAccounts(self, SessionID):
+        with self._lock:
+            own = self._account(SessionID)
+            return [self._peer(account) for account in self.accounts.values()
+                    if account is not own]
+
+    # Orgs
+
+    def rpc_NewOrg(self, SessionID, Name, Discoverable=False):
+        with self._lock:
+            account = self._account(SessionID)
+            org = dict(
+                id=_new_id(),
+                name=Name,
+                discoverable=Discoverable,
+                creatorAccountId=account["accountId"],
+            )
+            self.orgs[org["id"]] = org
+            self.org_members[org["id"]] = {account["accountId"]: "a"}
+            self.notify([account["accountId"]], "org", org)
+            return org
+
+    def rpc_EnumerateOrgs(self, SessionID):
+        with self._lock:
+            account_id = self._account(SessionID)["accountId"]
+            return [org for oid, org in self.orgs.items()
+                    if account_id in self.org_members[oid]]
+
+    def rpc_GetOrgData(self, SessionID, OrgID):
+        with self._lock:
+            return self._org(OrgID)
+
+    def rpc_EnumerateOrgMembers(self, SessionID, OrgID):
+        with self._lock:
+            self._org(OrgID)
+            return [dict(orgId=OrgID, accountId=account_id, state=state)
+                    for account_id, state
+                    in self.org_members[OrgID].items()]
+
+    def _set_org_member(self, OrgID, MemberAccountID, MemberState):
+        with self._lock:
+            self._org(OrgID)
+            self._account_by_id(MemberAccountID)
+            members = self.org_members[OrgID]
+            members[MemberAccountID] = MemberState
+            self.notify(set(members), "org-member-event", dict(
+                orgId=OrgID,
+                accountId=MemberAccountID,
+                state=MemberState,
+            ))
+
+    def rpc_OrgAddMember(self, SessionID, OrgID, MemberAccountID,
+                         MemberState):
+        self._set_org_member(OrgID, MemberAccountID, MemberState)
+
+    def rpc_NewOrgMemberState(self, SessionID, OrgID, MemberAccountID,
+                              MemberState):
+        self._set_org_member(OrgID, MemberAccountID, MemberState)
+
+    def rpc_SetOrgMemberState(self, SessionID, OrgID, MemberAccountID,
+                              MemberState):
+        self._set_org_member(OrgID, MemberAccountID, MemberState)
+
+    # Channels
+
+    def rpc_NewChannel(self, SessionID, OrgID, Name):
+        with self._lock:
+            account = self._account(SessionID)
+            self._org(OrgID)
+            channel = dict(
+                id=_new_id(),
+                orgId=OrgID,
+                name=Name,
+                creatorAccountId=account["accountId"],
+            )
+            self.channels[channel["id"]] = channel
+            self.channel_members[channel["id"]] = {account["accountId"]: "a"}
+            self.messages[channel["id"]] = []
+            self.notify([account["accountId"]], "channel", channel)
+            return channel["id"]
+
+    def rpc_EnumerateChannels(self, SessionID, OrgID):
+        with self._lock:
+            account_id = self._account(SessionID)["accountId"]
+            return [channel for cid, channel in self.channels.items()
+                    if channel["orgId"] == OrgID
+                    and account_id in self.channel_members[cid]]
+
+    def rpc_GetChannel(self, SessionID, ChannelID):
+        with self._lock:
+            return self._channel(ChannelID)
+
+    def rpc_DeleteChannel(self, SessionID, OrgID, ChannelID):
+        with self._lock:
+            self._channel(ChannelID)
+            del self.channels[ChannelID]
+            del self.channel_members[ChannelID]
+            del self.messages[ChannelID]
+
+    def rpc_EnumerateChannelMembers(self, SessionID, ChannelID):
+        with self._lock:
+            self._channel(ChannelID)
+            return [dict(channelId=ChannelID, accountId=account_id,
+                         state=state)
+                    for account_id, state
+                    in self.channel_members[ChannelID].items()]
+
+    def _set_channel_member(self, OrgID, ChannelID, MemberAccountID,
+                            MemberState):
+        with self._lock:
+            self._channel(ChannelID)
+            self._account_by_id(MemberAccountID)
+            members = self.channel_members[ChannelID]
+            members[MemberAccountID] = MemberState
+            self.notify(set(members), "channel-member-event", dict(
+                orgId=OrgID,
+                channelId=ChannelID,
+                accountId=MemberAccountID,
+                state=MemberState,
+            ))
+
+    def rpc_ChannelAddMember(self, SessionID, OrgID, ChannelID,
+                             MemberAccountID, MemberState):
+        self._set_channel_member(
+            OrgID, ChannelID, MemberAccountID, MemberState)
+
+    def rpc_NewChannelMemberState(self, SessionID, OrgID, ChannelID,
+                                  MemberAccountID, MemberState):
+        self._set_channel_member(
+            OrgID, ChannelID, MemberAccountID, MemberState)
+
+    def rpc_NewDirectConversation(self, SessionID, OrgID, MemberID):
+        with self._lock:
+            cid = self.rpc_NewChannel(SessionID, OrgID, "direct")
+            self.channel_members[cid][MemberID] = "a"
+            return cid
+
+    # Messages
+
+    def _send_message(self, sender, oid, cid, text, other_data=None,
+                      attachments=None):
+        with self._lock:
+            self._channel(cid)
+            message = dict(
+                id=_new_id(),
+                orgId=oid,
+                channelId=cid,
+                senderAccountId=sender["accountId"],
+                text=text,
+                otherData=other_data,
+                attachments=attachments or [],
+                creationTime=time.time(),
+            )
+            self.messages[cid].append(message)
+            self.notify(set(self.channel_members[cid]), "message", dict(
+                regularMessages=[message],
+                channelMessages=[],
+            ))
+            return message["id"]
+
+    def rpc_SendMessage(self, SessionID, OrgID, ChannelID, Text,
+                        OtherData=None, Attachments=None):
+        with self._lock:
+            sender = self._account(SessionID)
+            if sender["accountId"] not in self.channel_members.get(
+                    ChannelID, {}):
+                raise FakeError("Not a member of channel '%s'." % ChannelID)
+            return self._send_message(
+                sender, OrgID, ChannelID, Text, OtherData, Attachments)
+
+    def rpc_EnumerateMessages(self, SessionID, OrgID, ChannelID,
+                              Filters=None):
+        with self._lock:
+            self._channel(ChannelID)
+            return list(self.messages[ChannelID])
+
+    def rpc_GetUnreadCount(self, SessionID, OrgID, ChannelID):
+        with self._lock:
+            self._channel(ChannelID)
+            return len(self.messages[ChannelID])
+
+    def rpc_SetChannelReadHWM(self, SessionID, OrgID, ChannelID, MessageID):
+        pass
+
+    # Attachments
+
+    def rpc_NewAttachment(self, SessionID, OrgID, FilePath):
+        with self._lock:
+            account = self._account(SessionID)
+            if not os.path.isfile(FilePath):
+                raise FakeError("Cannot access '%s'." % FilePath)
+            size = os.path.getsize(FilePath)
+            aid = _new_id()
+            path = FilePath
+            if self.attachment_dir:
+                # The backend keeps its own copy of the file
+                path = os.path.join(self.attachment_dir, aid)
+                shutil.copyfile(FilePath, path)
+            self.attachments[aid] = dict(
+                id=aid,
+                orgId=OrgID,
+                filename=os.path.basename(FilePath),
+                size=size,
+                path=path,
+            )
+            # Upload events, after the response
+            event = dict(attachmentId=aid, bytes=size)
+            threading.Timer(0, self._notify_events, args=(
+                [account["accountId"]],
+                ["upload-start-event", "upload-progress-event",
+                 "upload-complete-event"],
+                event,
+            )).start()
+            return aid
+
+    def _notify_events(self, account_ids, notif_types, data):
+        for notif_type in notif_types:
+            self.notify(account_ids, notif_type, data)
+
+    def rpc_StartAttachmentDownload(self, SessionID, AttachmentID, OrgID,
+                                    ChannelID, MessageID):
+        with self._lock:
+            account = self._account(SessionID)
+            attachment = self.attachments.get(AttachmentID)
+            if attachment is None:
+                raise FakeError("Unknown attachment '%s'." % AttachmentID)
+            if self.attachment_dir:
+                path = os.path.join(self.attachment_dir, AttachmentID)
+                if attachment["path"] != path:
+                    shutil.copyfile(attachment["path"], path)
+                    attachment["path"] = path
+            event = dict(attachmentId=AttachmentID, path=attachment["path"])
+            threading.Timer(0, self._notify_events, args=(
+                [account["accountId"]],
+                ["download-start-event", "download-complete-event"],
+                event,
+            )).start()
+
+    def rpc_StoredAttachmentPath(self, SessionID, OrgID, AttachmentID):
+        with self._lock:
+            attachment = self.attachments.get(AttachmentID)
+            if attachment is None:
+                raise FakeError("Unknown attachment '%s'." % AttachmentID)
+            return attachment["path"]
+
+    def rpc_UpdateAttachmentPath(self, SessionID, AttachmentID, NewPath):
+        with self._lock:
+            attachment = self.attachments.get(AttachmentID)
+            if attachment is None:
+                raise FakeError("Unknown attachment '%s'." % AttachmentID)
+            shutil.move(attachment["path"], NewPath)
+            attachment["path"] = NewPath
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_server(backend, port=0, token=None, host="127.0.0.1"):
+    """Returns an HTTP server that serves the API of 'backend' on /rpc.
+    Its 'token' attribute holds the token of the requests.
+    """
+    token = token or _new_id()
+
+    class RPCHandler(BaseHTTPRequestHandler):
+        """Serves the JSON-RPC requests."""
+
+        # Keep-alive connections, the headers and body are written
+        # separately so Nagle's algorithm would delay the responses
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            result = None
+            error = ""
+            try:
+                request = json.loads(self.rfile.read(length).decode("utf-8"))
+                if request.get("token") != token:
+                    raise FakeError("Invalid token.")
+                params = (request.get("params") or [{}])[0]
+                result = backend.call(request["method"], params)
+            except FakeError as fake_err:
+                error = str(fake_err)
+            except Exception as exception:
+                error = "%s: %s" % (type(exception).__name__, exception)
+            body = json.dumps(dict(result=result, error=error))
+            body = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = _ThreadingHTTPServer((host, port), RPCHandler)
+    server.token = token
+    return server
+
+
+def set_faults(flow, latency=0.0, error_rate=0.0, methods=None, sid=0):
+    """Sets the latency (seconds) and error rate of the API calls of a
+    Flow object running on the fake backend, for all the methods or only
+    the ones in 'methods'.
+    """
+    return flow._run(
+        method="FakeSetFaults",
+        SessionID=flow._get_session_id(sid),
+        Latency=latency,
+        ErrorRate=error_rate,
+        Methods=methods,
+    )
+
+
+def echo(flow, payload, sid=0):
+    """Sends 'payload' to the fake backend, which returns it."""
+    return flow._run(
+        method="FakeEcho",
+        SessionID=flow._get_session_id(sid),
+        Payload=payload,
+    )
+
+
+def deliver_message(flow, oid, cid, text, sender="fake-peer", sid=0):
+    """Delivers a message from the 'sender' username (created if it
+    doesn't exist) to a channel. Returns the MessageID.
+    """
+    return flow._run(
+        method="FakeDeliverMessage",
+        SessionID=flow._get_session_id(sid),
+        OrgID=oid,
+        ChannelID=cid,
+        Text=text,
+        SenderUsername=sender,
+    )
+
+
+def notification_burst(flow, oid, cid, count, sender="fake-peer", sid=0):
+    """Delivers 'count' messages to a channel at once."""
+    return flow._run(
+        method="FakeNotificationBurst",
+        SessionID=flow._get_session_id(sid),
+        OrgID=oid,
+        ChannelID=cid,
+        Count=count,
+        SenderUsername=sender,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="fakeglue",
+        description="In-memory stand-in for the flowappglue backend.",
+    )
+    parser.add_argument("port", nargs="?", type=int, default=0)
+    # Accepted for compatibility with flowappglue
+    parser.add_argument("--decrement-file")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--strict", action="store_true")
+    args = parser.parse_args(argv)
+    backend = FakeBackend(
+        strict=args.strict,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    server = make_server(backend, args.port)
+    sys.stdout.write(json.dumps(dict(
+        token=server.token,
+        port=server.server_address[1],
+    )) + "\n")
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
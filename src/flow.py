@@ -5,9 +5,11 @@ All Flow API responses are represented with Python dicts.
 
 import sys
 import subprocess
-import platform as platform_module
 import json
 import threading
+import contextlib
+import collections
+import itertools
 
 try:
     import Queue
@@ -20,13 +22,35 @@ import random
 import logging
 import time
 
-import requests
-
 from . import definitions
+from . import metrics
+from . import models
+from . import throttle
+from .scheduler import Scheduler
 
 LOG = logging.getLogger("flow")
 LOG.addHandler(logging.NullHandler())
 
+# Monotonic clock when available (Python 3.3+)
+_clock = getattr(time, "monotonic", time.time)
+
+# 'requests' is slow to import, it's imported on the first API call
+requests = None
+
+
+def _import_requests():
+    """Imports the 'requests' module on first use and returns it."""
+    global requests
+    if requests is None:
+        import requests
+    return requests
+
+
+def _default_os_release():
+    """Returns the OS release, 'platform' is imported on first use."""
+    import platform
+    return platform.release()
+
 
 class Flow(object):
     """Class to interact with the Flow API.
@@ -73,17 +97,31 @@ class Flow(object):
     FULL_LOCK = 1
     LDAP_LOCK = 2
 
+    # Default size of the thread pools used by the bulk APIs
+    _DEFAULT_MAX_WORKERS = 8
+
+    # Ids of the Flow objects of the process, see set_metrics()
+    _instance_ids = itertools.count()
+
     def _make_notification_decorator(name):
         """Generates decorator functions for all notifications.
         E.g. the 'message' notification decorator usage:
         @flow.message
         def my_message_callback(notif_type, data):
             # do something...
+        The decorators also accept the register_callback() options:
+        @flow.message(executor="process")
         """
 
-        def notification_decorator(self, func):
+        def notification_decorator(self, func=None, **options):
             """Decorator to register the event callback."""
-            self.register_callback(name, func)
+            if func is None:
+                def decorator(func):
+                    """Registers 'func' with 'options'."""
+                    self.register_callback(name, func, **options)
+                    return func
+                return decorator
+            self.register_callback(name, func, **options)
             return func
         notification_decorator.__doc__ = "Decorator to register a '%s' " \
             "notification callback." % name
@@ -138,12 +176,19 @@ class Flow(object):
             flow : Flow instance
             sid : int, SessionID
             """
-            self.flowappglue = flow._flowappglue
             self.sid = sid
+            # SessionID on the backend, it changes if the
+            # backend is restarted (see Flow(auto_restart=True))
+            self.backend_sid = sid
+            # Account started on this session, if any
+            self.username = None
             self.flow = flow
             self.callbacks = {}  # Notification Name -> Function Object
+            # Notification Name -> list of Function Objects
+            self.listeners = {}
             self.notification_queue = Queue.Queue()
             self.error_queue = Queue.Queue()
+            self.stats = metrics.NotificationStats()
             self.listen_notifications = threading.Event()
             self.notification_thread = threading.Thread(
                 target=self._notification_loop,
@@ -151,8 +196,13 @@ class Flow(object):
             self.notification_thread.daemon = True
             self.callback_lock = threading.Lock()
 
-        def start_notification_loop(self):
-            """Starts the thread that polls for notifications."""
+        def start_notification_loop(self, username=""):
+            """Starts the thread that polls for notifications.
+            Arguments:
+            username : string, account started on this session, empty
+            for the first local account.
+            """
+            self.username = username
             self.listen_notifications.set()
             self.notification_thread.start()
 
@@ -175,6 +225,48 @@ class Flow(object):
             self.callbacks[notification_name] = callback
             self.callback_lock.release()
 
+        def add_listener(self, notification_name, listener):
+            """Adds a listener for a notification type.
+            Listeners are executed on the notification thread as soon as
+            the notification is received, before it is queued for
+            the callbacks.
+            Arguments:
+            notification_name : string, type of the notification.
+            listener : function object, same signature as the callbacks.
+            """
+            self.callback_lock.acquire()
+            self.listeners.setdefault(notification_name, []).append(listener)
+            self.callback_lock.release()
+
+        def remove_listener(self, notification_name, listener):
+            """Removes a listener added with add_listener()."""
+            self.callback_lock.acquire()
+            listeners = self.listeners.get(notification_name, [])
+            if listener in listeners:
+                listeners.remove(listener)
+            if not listeners:
+                self.listeners.pop(notification_name, None)
+            self.callback_lock.release()
+
+        def _notify_listeners(self, changes):
+            """Executes the listeners of the received changes.
+            Arguments:
+            changes : Change dict/s returned by wait_for_notification.
+            """
+            if not isinstance(changes, list):
+                changes = [changes]
+            for change in changes:
+                if not change or "type" not in change:
+                    continue
+                self.callback_lock.acquire()
+                listeners = list(self.listeners.get(change["type"], []))
+                self.callback_lock.release()
+                for listener in listeners:
+                    try:
+                        listener(change["type"], change["data"])
+                    except Exception as exception:
+                        LOG.debug("Listener error: %s", str(exception))
+
         def _queue_error(self, error):
             """Queues the notification error.
             Arguments:
@@ -182,13 +274,15 @@ class Flow(object):
             """
             # This check should leave the queue with
             # an approximate size of _MAX_QUEUE_SIZE
-            if self.error_queue.qsize() > self._MAX_QUEUE_SIZE:
+            dropped = self.error_queue.qsize() > self._MAX_QUEUE_SIZE
+            if dropped:
                 ignored_error = self.error_queue.get()
                 LOG.warn(
                     "Error queue is full: ignoring error '%s'",
                     ignored_error,
                 )
             self.error_queue.put(error)
+            self.stats.record_error(dropped)
 
         def _queue_changes(self, changes):
             """Queues the changes of registered change types.
@@ -203,26 +297,62 @@ class Flow(object):
                    and change["type"] in self.callbacks:
                     # This check should leave the queue with
                     # an approximate size of _MAX_QUEUE_SIZE
-                    if self.notification_queue.qsize() > self._MAX_QUEUE_SIZE:
+                    if self.notification_queue.qsize() > \
+                            self._MAX_QUEUE_SIZE:
                         notification = self.notification_queue.get()
                         LOG.warn(
                             "Notification queue is full: "
                             "ignoring notification '%s'",
                             notification["data"])
+                        self.stats.record_dropped(
+                            "callback" in notification)
+                    if self.flow._response_models:
+                        # The hooks and listeners keep the plain dict
+                        change = dict(change, data=models.wrap_notification(
+                            change["type"], change["data"]))
+                    # To measure the dispatch lag
+                    change["queuedAt"] = _clock()
                     self.notification_queue.put(change)
+                    self.stats.record_queued()
+
+        # Seconds between failed WaitForNotification calls,
+        # doubled after each consecutive error up to the max.
+        _ERROR_BACKOFF = 0.05
+        _ERROR_BACKOFF_MAX = 2.0
 
         def _notification_loop(self):
             """Loops calling WaitForNotification on this session."""
+            backoff = 0
             while self.listen_notifications.is_set():
+                generation = self.flow._backend_generation
                 try:
                     changes = self.flow.wait_for_notification(sid=self.sid)
                 except Exception as flow_err:
-                    # Check whether flowappglue finished execution
-                    if self.flowappglue.poll() is not None:
-                        break
-                    else:
-                        self._queue_error(str(flow_err))
+                    self.stats.record_wait(error=flow_err)
+                    # Errors of a backend that finished execution or is
+                    # being restarted are not reported, keep listening
+                    # once it's restarted
+                    if self.flow._backend_lost(generation, flow_err):
+                        if not self.flow._wait_backend_restart(generation):
+                            break
+                        continue
+                    self._queue_error(str(flow_err))
+                    backoff = min(backoff * 2 or self._ERROR_BACKOFF,
+                                  self._ERROR_BACKOFF_MAX)
+                    self.flow._terminating.wait(backoff)
                 else:
+                    backoff = 0
+                    self.stats.record_wait(
+                        len(changes) if isinstance(changes, list)
+                        else int(bool(changes)))
+                    if self.flow._hooks:
+                        for change in (changes if isinstance(changes, list)
+                                       else [changes]):
+                            if change:
+                                self.flow._call_hooks(
+                                    "on_notification", self.sid, change)
+                    if self.listeners:
+                        self._notify_listeners(changes)
                     self.callback_lock.acquire()
                     self._queue_changes(changes)
                     self.callback_lock.release()
@@ -247,43 +377,86 @@ class Flow(object):
                 notification = \
                     self.notification_queue.get(
                         block=True, timeout=timeout_secs)
+                hooks = self.flow._hooks
+                if hooks:
+                    self.flow._call_hooks(
+                        "on_callback", self.sid, notification)
+                start = _clock()
+                error = None
                 try:
                     self.callback_lock.acquire()
-                    if notification["type"] not in self.callbacks:
+                    if "callback" in notification:
+                        # Completion queued with queue_completion()
+                        notification["callback"](*notification["data"])
+                    elif notification["type"] not in self.callbacks:
                         raise Exception(
                             "Notification of type '%s' not supported.",
                             notification["type"],
                         )
-                    self.callbacks[notification["type"]](
-                        notification["type"], notification["data"])
+                    else:
+                        self.callbacks[notification["type"]](
+                            notification["type"], notification["data"])
                 except Exception as exception:
+                    error = exception
                     LOG.debug("Error: %s", str(exception))
                 finally:
                     self.callback_lock.release()
+                duration = _clock() - start
+                self.stats.record_dispatch(
+                    start - notification.get("queuedAt", start),
+                    duration,
+                    error,
+                    "callback" in notification,
+                )
+                if hooks:
+                    self.flow._call_hooks(
+                        "after_callback", self.sid, notification,
+                        duration, error)
                 notification_consumed = True
             except Queue.Empty:
                 notification_consumed = False
             return notification_consumed
 
+        def queue_completion(self, callback, args):
+            """Queues the execution of 'callback' with 'args' so that it
+            runs on the thread that consumes the notifications.
+            """
+            self.notification_queue.put(dict(
+                type=None,
+                callback=callback,
+                data=args,
+                queuedAt=_clock(),
+            ))
+            self.stats.record_queued(completion=True)
+
         def close(self):
             """Closes the session by terminating the listener thread."""
             self.listen_notifications.clear()
-            if self.notification_thread.is_alive():
+            # An attached backend keeps running, so the thread may stay
+            # blocked on WaitForNotification (it is a daemon thread).
+            if self.flow._flowappglue is not None \
+               and self.notification_thread.is_alive():
                 self.notification_thread.join()
 
     def __init__(
             self,
             username="",
             server_uri=definitions.DEFAULT_URI,
-            flowappglue=definitions.get_default_flowappglue_path(),
+            flowappglue=None,
             host=definitions.DEFAULT_SERVER,
             port=definitions.DEFAULT_PORT,
-            db_dir=definitions.get_default_db_path(),
-            schema_dir=definitions.get_default_schema_path(),
-            attachment_dir=definitions.get_default_attachment_path(),
+            db_dir=None,
+            schema_dir=None,
+            attachment_dir=None,
             use_tls=definitions.DEFAULT_USE_TLS,
-            glue_out_filename=definitions.get_default_glue_out_filename(),
-            decrement_file=None):
+            glue_out_filename=None,
+            decrement_file=None,
+            backend_port=None,
+            backend_token=None,
+            backend_sid=None,
+            spare_sessions=0,
+            warm_caches=False,
+            auto_restart=False):
         """Initializes the Flow object. It starts and configures
         flowappglue local server as a subprocess.
         It also starts a new session so that you can start using
@@ -293,21 +466,236 @@ class Flow(object):
         Arguments:
         flowappglue : string, path to the flowappglue binary,
         if empty, then it tries to determine the location.
+        db_dir, schema_dir, attachment_dir : string, if empty, then the
+        platform defaults are used (see definitions module).
+        glue_out_filename : string, flowappglue output log file, if empty,
+        then a new timestamped file is created under 'db_dir'.
+        backend_port, backend_token : if provided, then no flowappglue
+        is started, the object attaches to the already running and
+        configured flowappglue listening on 'backend_port' (e.g. the one
+        of the flow.daemon module, see Flow.from_daemon()).
+        backend_sid : int, with backend_port, the object uses this
+        existing session of the backend (as its current session)
+        instead of creating one, e.g. to make API calls on behalf of an
+        account started by another process.
+        spare_sessions : int, amount of extra sessions to create during
+        startup, new_session() returns them before creating new ones.
+        warm_caches : bool, if True, then the orgs and channels of the
+        account are fetched in the background right after StartUp.
+        The startup steps that are independent run concurrently
+        (e.g. the directories are checked while flowappglue boots, the
+        spare sessions are created while the account starts up). The
+        duration of each startup phase is stored in 'startup_times'.
+        auto_restart : bool, if True, then flowappglue is restarted
+        (with backoff) when it exits unexpectedly, and its configuration,
+        sessions and started accounts are restored. The SessionIDs
+        returned by this object remain valid after a restart. API calls
+        made while the backend is down raise FlowConnectionError.
         """
         self.server_uri = server_uri
         self.api_timeout = None
+        self._scheduler = None
+        self._http_session = None
+        self._response_models = False
+        # Hook name -> tuple of functions, see add_hook()
+        self._hooks = {}
+        self._hooks_lock = threading.Lock()
+        # API request metrics, see set_metrics()
+        self._instance_id = next(Flow._instance_ids)
+        self.metrics = None
+        self.set_metrics(metrics.RPCMetrics())
+        self._process_pool = None
+        self._own_process_pool = False
+        self._process_pool_lock = threading.Lock()
+        self.sessions = {}  # SessionID -> _Session
+        self._peer_cache = {}  # AccountID -> 'Peer' dict
+        self._peer_cache_lock = threading.Lock()
+        self._loop_process_notifications = False
+        self._sessions_lock = threading.Lock()
+        self._spare_sessions = []
+        self._spare_sessions_lock = threading.Lock()
+        self.glue_log_file = None
+        self._flowappglue = None
+        self._supervisor_thread = None
+        self._auto_restart = auto_restart
+        self._terminating = threading.Event()
+        # Incremented on each backend restart
+        self._backend_generation = 0
+        # Whether the backend exited and is being restarted
+        self._backend_restarting = False
+        self._backend_cond = threading.Condition()
+        self.backend_restarts = 0
+        # Startup phase name -> seconds
+        self.startup_times = collections.OrderedDict()
+        start = time.time()
+        if backend_port is not None:
+            self._token = backend_token
+            self._port = backend_port
+        else:
+            # Defaults are resolved here and not at import time,
+            # they probe the filesystem.
+            db_dir = db_dir or definitions.get_default_db_path()
+            schema_dir = schema_dir or definitions.get_default_schema_path()
+            attachment_dir = attachment_dir or \
+                definitions.get_default_attachment_path()
+            # Kept to restart the backend
+            self._glue_args = (
+                flowappglue or definitions.get_default_flowappglue_path(),
+                db_dir,
+                glue_out_filename or
+                definitions.get_default_glue_out_filename(db_dir),
+                decrement_file,
+            )
+            self._config_args = (
+                host, port, db_dir, schema_dir, attachment_dir, use_tls)
+            with self._startup_phase("spawn"):
+                self._start_flowappglue(*self._glue_args)
+            # flowappglue is booting meanwhile
+            with self._startup_phase("checkDirs"):
+                self._check_file_exists(schema_dir)
+                self._check_file_exists(attachment_dir, True)
+            with self._startup_phase("backendReady"):
+                self._read_backend_address()
+            self._supervisor_thread = threading.Thread(
+                target=self._supervise_flowappglue)
+            self._supervisor_thread.daemon = True
+            self._supervisor_thread.start()
+        try:
+            self._start(username, spare_sessions, backend_sid)
+        except Exception:
+            # The backend is not left running (or restarting)
+            self._terminating.set()
+            self._stop_process(self._flowappglue)
+            raise
+        self.startup_times["total"] = time.time() - start
+        LOG.debug("startup phases: %s", dict(self.startup_times))
+        if username and warm_caches:
+            warm_thread = threading.Thread(
+                target=self._timed_startup_phase(
+                    "warmCaches", self._warm_caches))
+            warm_thread.daemon = True
+            warm_thread.start()
+
+    def _start(self, username, spare_sessions, backend_sid=None):
+        """Configures the backend (if it's a subprocess), creates the
+        session (or uses 'backend_sid') and starts the account and the
+        spare sessions.
+        """
+        if self._flowappglue is not None:
+            with self._startup_phase("config"):
+                self._config(*self._config_args)
+        # Create the session
+        with self._startup_phase("session"):
+            if backend_sid is not None:
+                self._current_session = self._add_session(backend_sid)
+            else:
+                self._current_session = self._create_session()
+        # Start the account (if username available) and
+        # create the spare sessions concurrently
+        calls = []
+        if username:
+            calls.append((
+                self._timed_startup_phase("startUp", self.start_up),
+                (username,), {}))
+        if spare_sessions:
+            calls.append((
+                self._timed_startup_phase(
+                    "spareSessions", self._create_spare_sessions),
+                (spare_sessions,), {}))
+        for _, exception in self._call_concurrently(calls, len(calls)):
+            if exception is not None:
+                raise exception
+
+    @contextlib.contextmanager
+    def _startup_phase(self, name):
+        """Context manager that stores the duration
+        of the 'name' startup phase in 'startup_times'.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.startup_times[name] = time.time() - start
+
+    def _timed_startup_phase(self, name, func):
+        """Returns 'func' wrapped to store its duration
+        as the 'name' startup phase.
+        """
+        def timed(*args, **kwargs):
+            """Executes 'func' within the startup phase."""
+            with self._startup_phase(name):
+                return func(*args, **kwargs)
+        return timed
+
+    def _create_spare_sessions(self, count):
+        """Creates 'count' sessions to be returned by new_session()."""
+        calls = [(self._create_session, (), {}) for _ in range(count)]
+        results = self._call_concurrently(calls, count)
+        for _, exception in results:
+            if exception is not None:
+                raise exception
+        with self._spare_sessions_lock:
+            self._spare_sessions.extend(sid for sid, _ in results)
+
+    def _warm_caches(self):
+        """Fetches the orgs and channels of the started account so
+        that flowappglue has them loaded for the first API calls.
+        """
+        try:
+            orgs = self.enumerate_orgs(priority=Scheduler.BACKGROUND)
+            calls = [
+                (self.enumerate_channels, (org["id"],),
+                 dict(priority=Scheduler.BACKGROUND))
+                for org in orgs
+            ]
+            self._call_concurrently(calls)
+        except Flow.FlowError as flow_err:
+            LOG.debug("Error warming caches: %s", flow_err)
+
+    @classmethod
+    def from_daemon(cls, state_file=None, **kwargs):
+        """Returns a Flow object attached to the flowappglue kept running
+        by the flow.daemon module (python -m flow.daemon).
+        Arguments:
+        state_file : string, file where the daemon writes the backend
+        port and token, see definitions.get_default_daemon_state_path().
+        kwargs : other Flow() arguments, e.g. 'username'.
+        """
+        state_file = state_file or \
+            definitions.get_default_daemon_state_path()
+        try:
+            with open(state_file) as state:
+                backend = json.load(state)
+        except (IOError, OSError, ValueError) as err:
+            raise Flow.FlowConnectionError(
+                "Cannot read daemon state file '%s': %s" % (state_file, err))
+        return cls(
+            backend_port=backend["port"],
+            backend_token=backend["token"],
+            **kwargs
+        )
+
+    def _start_flowappglue(self, flowappglue, db_dir,
+                           glue_out_filename, decrement_file):
+        """Starts flowappglue as a subprocess, its token and port are
+        read with _read_backend_address().
+        """
         self._check_file_exists(flowappglue)
         self._check_file_exists(db_dir, True)
         glue = [flowappglue, "0"]
         if decrement_file is not None:
             glue = [flowappglue, "--decrement-file", decrement_file, "0"]
-        self.glue_log_file = open(glue_out_filename, "w")
+        # On restarts the log of the previous run is kept
+        if self.glue_log_file is None:
+            self.glue_log_file = open(glue_out_filename, "w")
         self._flowappglue = subprocess.Popen(
             glue,
             stdout=subprocess.PIPE,
             stderr=self.glue_log_file,
         )
 
+    def _read_backend_address(self):
+        """Blocks until flowappglue prints its token and port."""
         _line = self._flowappglue.stdout.readline()
         try:
             token_port_line = json.loads(_line)
@@ -316,17 +704,156 @@ class Flow(object):
 
         self._token = token_port_line["token"]
         self._port = token_port_line["port"]
-        self.sessions = {}  # SessionID -> _Session
-        # Configure flowappglue and create the session
-        self._config(host, port, db_dir, schema_dir, attachment_dir, use_tls)
-        self._current_session = self.new_session()
-        self._loop_process_notifications = False
-        # If username available then start the session
-        if username:
-            self.start_up(username)
+
+    def _backend_exited(self, error=None):
+        """Returns whether the flowappglue backend finished execution.
+        Arguments:
+        error : exception raised by the last API call, if any. It's
+        used when attached to a backend that is not a subprocess.
+        """
+        if self._flowappglue is not None:
+            return self._flowappglue.poll() is not None
+        return isinstance(error, Flow.FlowConnectionError)
+
+    # Seconds between restart attempts: doubled after each failed
+    # attempt, up to the max. The first restart is immediate unless
+    # the backend was up for less than _RESTART_BACKOFF_RESET seconds.
+    _RESTART_BACKOFF = 0.5
+    _RESTART_BACKOFF_MAX = 30
+    _RESTART_BACKOFF_RESET = 60
+
+    def _supervise_flowappglue(self):
+        """Supervisor thread: drains the flowappglue stdout (so that
+        the pipe never fills up), waits for its exit and restarts it
+        if 'auto_restart' is enabled.
+        """
+        attempts = 0
+        try:
+            while True:
+                process = self._flowappglue
+                started = time.time()
+                for line in iter(process.stdout.readline, b""):
+                    LOG.debug("semaphor-backend: %s", line.rstrip())
+                returncode = process.wait()
+                if self._terminating.is_set() or not self._auto_restart:
+                    return
+                with self._backend_cond:
+                    self._backend_restarting = True
+                    self._backend_cond.notify_all()
+                LOG.warn("semaphor-backend exited with code %s", returncode)
+                if time.time() - started > self._RESTART_BACKOFF_RESET:
+                    attempts = 0
+                while True:
+                    delay = 0 if not attempts else min(
+                        self._RESTART_BACKOFF * 2 ** (attempts - 1),
+                        self._RESTART_BACKOFF_MAX)
+                    attempts += 1
+                    if self._terminating.wait(delay):
+                        return
+                    try:
+                        self._restart_flowappglue()
+                        break
+                    except Exception as restart_err:
+                        LOG.warn(
+                            "semaphor-backend restart failed: %s",
+                            restart_err)
+                        self._stop_process(self._flowappglue)
+                if self._terminating.is_set():
+                    self._stop_process(self._flowappglue)
+        finally:
+            with self._backend_cond:
+                self._supervisor_thread = None
+                self._backend_restarting = False
+                self._backend_cond.notify_all()
+
+    def _restart_flowappglue(self):
+        """Starts a new flowappglue and restores the
+        configuration, sessions and started accounts.
+        """
+        self._start_flowappglue(*self._glue_args)
+        self._read_backend_address()
+        self._config(*self._config_args)
+        for sid, session in list(self.sessions.items()):
+            response = self._run(method="NewSession")
+            session.backend_sid = response["SessionID"]
+            if session.username is None:
+                continue
+            username = session.username
+            if not username:
+                local_accounts = self.enumerate_local_accounts()
+                if local_accounts:
+                    username = local_accounts[0]["username"]
+            self._run(
+                method="StartUp",
+                SessionID=sid,
+                Username=username,
+                ServerURI=self.server_uri,
+            )
+        with self._backend_cond:
+            self._backend_generation += 1
+            self._backend_restarting = False
+            self.backend_restarts += 1
+            self._backend_cond.notify_all()
+        LOG.info("semaphor-backend restarted")
+
+    def _backend_replaced(self, generation):
+        """Returns whether the backend that was running at 'generation'
+        was restarted or is being restarted.
+        """
+        with self._backend_cond:
+            return self._backend_restarting \
+                or self._backend_generation != generation
+
+    # Seconds a connection error waits for the supervisor to notice
+    # the exit of the backend, see _backend_lost()
+    _EXIT_GRACE = 1.0
+
+    def _backend_lost(self, generation, error):
+        """Returns whether an API error was caused by the exit or the
+        restart of the backend that was running at 'generation'.
+        The connections of a killed backend are closed before its
+        process is reaped, so with 'auto_restart' connection errors wait
+        up to _EXIT_GRACE seconds for the supervisor to notice the exit.
+        """
+        if self._backend_exited(error) or self._backend_replaced(generation):
+            return True
+        if self._flowappglue is None or not self._auto_restart \
+                or not isinstance(error, Flow.FlowConnectionError):
+            return False
+        deadline = time.time() + self._EXIT_GRACE
+        with self._backend_cond:
+            while not self._backend_restarting \
+                    and self._backend_generation == generation:
+                remaining = deadline - time.time()
+                if remaining <= 0 or self._supervisor_thread is None:
+                    return False
+                self._backend_cond.wait(remaining)
+            return True
+
+    def _wait_backend_restart(self, generation):
+        """Blocks until the backend that was running at 'generation'
+        is replaced by a restarted one.
+        Returns False if the backend is not going to be restarted.
+        """
+        with self._backend_cond:
+            while self._backend_generation == generation \
+                    and self._supervisor_thread is not None:
+                self._backend_cond.wait()
+            return self._backend_generation != generation
+
+    @staticmethod
+    def _stop_process(process):
+        """Sends SIGTERM to 'process' if it's running."""
+        if process is not None and process.poll() is None:
+            try:
+                process.terminate()
+            except OSError:
+                pass
 
     def clear_glue_log(self):
         """Clears the flowappglue stderr log file."""
+        if self.glue_log_file is None:
+            return
         self.glue_log_file.seek(0)
         self.glue_log_file.truncate()
 
@@ -337,30 +864,35 @@ class Flow(object):
         if the process does not finish the execution,
         it will wait 'timeout_secs' before sending SIGKILL
         to the semaphor-backend process.
+        If the object is attached to a running backend (see
+        Flow.from_daemon()), then the backend is left running.
         """
         # TODO: call 'Close' flowapp API here as soon as it is supported
-        self.glue_log_file.close()
-        start = time.time()
+        self._terminating.set()
+        if self._own_process_pool:
+            self._process_pool.shutdown(wait=False)
 
         # Terminate the flowappglue process
-        if self._flowappglue and self._flowappglue.poll() is None:
-            self._flowappglue.terminate()
-
-        # Wait for process termination
-        if self._flowappglue:
-            while self._flowappglue.poll() is None:
-                time.sleep(1)
-                if (time.time() - start) > timeout_secs:
-                    LOG.warn(
-                        "semaphor-backend %d secs. timeout reached, "
-                        "sending SIGKILL to process",
-                        timeout_secs,
-                    )
-                    try:
-                        self._flowappglue.kill()
-                    except OSError:
-                        pass
-                    break
+        self._stop_process(self._flowappglue)
+
+        # Wait for process termination, the supervisor
+        # thread finishes as soon as the process exits
+        supervisor_thread = self._supervisor_thread
+        if supervisor_thread is not None:
+            supervisor_thread.join(timeout_secs)
+            if supervisor_thread.is_alive():
+                LOG.warn(
+                    "semaphor-backend %d secs. timeout reached, "
+                    "sending SIGKILL to process",
+                    timeout_secs,
+                )
+                try:
+                    self._flowappglue.kill()
+                except OSError:
+                    pass
+                supervisor_thread.join(timeout_secs)
+        if self.glue_log_file is not None:
+            self.glue_log_file.close()
 
         # Close all sessions
         sids = list(self.sessions.keys())
@@ -380,6 +912,139 @@ class Flow(object):
         """
         return sid if sid else self._current_session
 
+    def set_scheduler(self, scheduler):
+        """Sets the scheduler for all API requests
+        (except WaitForNotification), a flow.scheduler.Scheduler instance.
+        The 'priority' argument of the API methods is the priority class
+        of the request. Use scheduler=None to remove the scheduler.
+        """
+        self._scheduler = scheduler
+
+    def set_http_session(self, http_session):
+        """Sets the requests.Session used for all API requests, so
+        that the connections to flowappglue are kept alive and can be
+        shared by many Flow objects. Use http_session=None to send each
+        request on a new connection (the default).
+        """
+        self._http_session = http_session
+
+    def set_response_models(self, enabled=True):
+        """Sets whether the API methods return Org, Channel, Message,
+        Peer and Member records (see flow.models) instead of plain
+        dicts, also for the messages of the 'message' notifications
+        passed to the callbacks. Records use less memory and are
+        mappings with dict-style access, but not dicts: encode them with
+        json.dumps(result, default=flow.models.json_default), or convert
+        them with to_dict() (records) and to_list() (lists of records).
+        The notification listeners and the
+        'on_notification' hooks receive plain dicts, the 'on_callback'
+        and 'after_callback' hooks receive the change with the records
+        passed to the callback.
+        """
+        self._response_models = enabled
+
+    # Hooks, see add_hook()
+    HOOKS = (
+        "before_request",
+        "after_response",
+        "on_error",
+        "on_notification",
+        "on_callback",
+        "after_callback",
+    )
+
+    def add_hook(self, name, hook):
+        """Adds a function to be executed on an event:
+        - before_request(method, params): before an API request.
+        - after_response(method, params, result, latency): after a
+        successful API request, 'latency' in seconds. 'result' is a
+        memoryview of the response body for raw=True requests.
+        - on_error(method, params, error, latency): after a failed API
+        request, 'error' is the exception to be raised.
+        - on_notification(sid, change): on the notification thread, for
+        each change received ('type' and 'data' dict).
+        - on_callback(sid, change): before executing the callback of a
+        change, on the same thread.
+        - after_callback(sid, change, duration, error): after executing
+        the callback of a change, 'error' is the exception it raised.
+        The same 'change' dict is passed to the notification and callback
+        hooks, so they can annotate it. Hooks must return quickly, their
+        exceptions are logged and ignored. There is no cost when no hooks
+        are added.
+        """
+        if name not in self.HOOKS:
+            raise ValueError("Unknown hook '%s'." % name)
+        with self._hooks_lock:
+            # Copy on write, the readers don't lock
+            hooks = dict(self._hooks)
+            hooks[name] = hooks.get(name, ()) + (hook,)
+            self._hooks = hooks
+
+    def remove_hook(self, name, hook):
+        """Removes a hook added with add_hook()."""
+        with self._hooks_lock:
+            hooks = dict(self._hooks)
+            remaining = tuple(h for h in hooks.get(name, ()) if h != hook)
+            if remaining:
+                hooks[name] = remaining
+            else:
+                hooks.pop(name, None)
+            self._hooks = hooks
+
+    def _call_hooks(self, name, *args):
+        """Executes the hooks of event 'name'."""
+        for hook in self._hooks.get(name, ()):
+            try:
+                hook(*args)
+            except Exception as exception:
+                LOG.debug("Hook error: %s", str(exception))
+
+    def set_metrics(self, rpc_metrics):
+        """Sets the flow.metrics.RPCMetrics instance where the API
+        requests are recorded (available as the 'metrics' attribute),
+        e.g. to share it among many Flow objects.
+        Use rpc_metrics=None to stop recording metrics.
+        The notification stats of the sessions (see
+        get_notification_stats()) are exported along with them, labelled
+        by 'sid' and 'flow' (an id of the Flow object in the process, so
+        that the series of Flow objects that share rpc_metrics don't
+        collide).
+        """
+        if self.metrics is not None:
+            self.metrics.remove_collector(self._notification_samples)
+        self.metrics = rpc_metrics
+        if rpc_metrics is not None:
+            rpc_metrics.add_collector(self._notification_samples)
+
+    def get_notification_stats(self, sid=0):
+        """Returns a dict with the stats of the notification pipeline of
+        a session: 'waitCalls' and 'waitErrors' (WaitForNotification),
+        'batches' and 'changes' received, 'maxBatchSize', 'queued' and
+        'dropped' changes, 'errors' and 'errorsDropped', 'queueDepth',
+        'dispatched' changes, 'completions' of the "process" callbacks
+        queued, 'completionsDropped' and 'completionsDispatched',
+        'dispatchLagSum', 'dispatchLagMax' and
+        'lastDispatchLag' (seconds from enqueue to dispatch),
+        'callbackErrors', 'callbackTimeSum' and 'callbackTimeMax'.
+        Arguments:
+        sid : int, SessionID.
+        """
+        sid = self._get_session_id(sid)
+        session = self.sessions[sid]
+        return session.stats.snapshot(session.notification_queue.qsize())
+
+    def _notification_samples(self):
+        """Metrics collector of the notification stats of all
+        the sessions (see flow.metrics.RPCMetrics.add_collector()).
+        """
+        samples = []
+        for sid, session in list(self.sessions.items()):
+            samples.extend(metrics.NotificationStats.samples(
+                session.stats.snapshot(session.notification_queue.qsize()),
+                dict(flow=str(self._instance_id), sid=str(sid)),
+            ))
+        return samples
+
     def set_api_timeout(self, timeout):
         """Sets the default timeout (in seconds) for all API
         requests (except WaitForNotification).
@@ -392,7 +1057,7 @@ class Flow(object):
         request_data: dict, data to send to the backend.
         """
         rand_debug_req_id = None
-        if LOG.getEffectiveLevel() == logging.DEBUG:
+        if LOG.isEnabledFor(logging.DEBUG):
             rand_debug_req_id = self.gen_rand_req_id()
             LOG.debug(
                 "request: id=%s, %s",
@@ -413,7 +1078,7 @@ class Flow(object):
         http_response: requests.Response object.
         response_data: dict, parsed dict response.
         """
-        if LOG.getEffectiveLevel() == logging.DEBUG:
+        if LOG.isEnabledFor(logging.DEBUG):
             LOG.debug(
                 "response: id=%s, %s, HTTP=%s, lat=%.2fs, %s",
                 req_id,
@@ -423,52 +1088,146 @@ class Flow(object):
                 response_data,
             )
 
-    def _run(self, method, timeout=None, **params):
+    # Empty error of the flowappglue responses, see _raw_response_ok()
+    _RAW_NO_ERROR = (b'"error":""', b'"error": ""')
+    _RAW_ERROR_WINDOW = 32
+
+    @classmethod
+    def _raw_response_ok(cls, content):
+        """Returns True if the response body 'content' (bytes) has an
+        empty top-level error, as its first or last key, without
+        decoding it. Returns False when it is not known.
+        """
+        if b'"Error"' in content:
+            # Top-level 'Error' key, see _run()
+            return False
+        window = cls._RAW_ERROR_WINDOW
+        head = content[:window].lstrip()
+        tail = content[-window:]
+        for marker in cls._RAW_NO_ERROR:
+            if head.startswith(b"{") and head[1:].lstrip().startswith(marker):
+                return True
+            position = tail.rfind(marker)
+            if position != -1 \
+               and tail[position + len(marker):].strip() == b"}":
+                return True
+        return False
+
+    def _run(self, method, timeout=None, priority=None, raw=False,
+             **params):
         """Performs the HTTP JSON POST against
         the flowappglue server on localhost.
         Arguments:
         method : string, API method name.
+        priority : string, priority class hint for the scheduler
+        (see set_scheduler()), ignored if there's no scheduler.
+        raw : bool, return the undecoded response body.
         params : kwargs, request parameters.
         Returns a dict with the response received from the flowappglue,
         it returns the 'result' part of the response.
-        """
+        With raw=True, it returns the whole response body (JSON with
+        'result' and 'error') as a memoryview of the received bytes, for
+        callers that relay it. Errors still raise Flow.FlowError: the
+        body is only decoded when an empty error is not found at its
+        start or end.
+        """
+        session = self.sessions.get(params.get("SessionID"))
+        if session is not None:
+            params["SessionID"] = session.backend_sid
         request_data = dict(
             method=method,
             params=[params],
             token=self._token,
         )
         rand_debug_req_id = self._log_request(request_data)
+        # WaitForNotification is a long poll, it must not take a slot
+        scheduler = self._scheduler \
+            if method != "WaitForNotification" else None
+        requests = _import_requests()
+        rpc_metrics = self.metrics
+        hooks = self._hooks
+        request_body = json.dumps(request_data).encode("utf-8")
+        if hooks:
+            self._call_hooks("before_request", method, params)
+        # Nothing that can raise between acquire() and the try/finally,
+        # or the slot would never be released
+        if scheduler is not None:
+            scheduler.acquire(priority)
+        start = _clock()
         try:
-            request_str = json.dumps(request_data)
             req_timeout = timeout or \
                 (self.api_timeout if method != "WaitForNotification" else None)
-            response = requests.post(
+            http = self._http_session or requests
+            response = http.post(
                 "http://127.0.0.1:%s/rpc" %
                 self._port,
                 headers={"Content-type": "application/json"},
                 timeout=req_timeout,
-                data=request_str,
+                data=request_body,
             )
         except (requests.ConnectionError, requests.Timeout) as requests_err:
             if isinstance(requests_err, requests.ConnectionError):
-                raise Flow.FlowConnectionError(requests_err)
+                error = Flow.FlowConnectionError(requests_err)
             else:
-                raise Flow.FlowTimeoutError(requests_err)
+                error = Flow.FlowTimeoutError(requests_err)
+            latency = _clock() - start
+            if rpc_metrics is not None:
+                rpc_metrics.record(
+                    method, latency, len(request_body), 0, error)
+            if hooks:
+                self._call_hooks("on_error", method, params, error, latency)
+            raise error
+        finally:
+            if scheduler is not None:
+                scheduler.release(priority)
+        latency = _clock() - start
 
-        response_data = json.loads(response.text, encoding="utf-8")
+        try:
+            if raw and self._raw_response_ok(response.content):
+                response_data = {}
+            elif raw:
+                response_data = json.loads(response.content.decode("utf-8"))
+            else:
+                response_data = json.loads(response.text)
+        except ValueError as decode_err:
+            if rpc_metrics is not None:
+                rpc_metrics.record(
+                    method, latency, len(request_body),
+                    len(response.content), decode_err)
+            if hooks:
+                self._call_hooks(
+                    "on_error", method, params, decode_err, latency)
+            raise
 
         self._log_response(method, rand_debug_req_id, response, response_data)
 
+        error = None
         if "error" in response_data.keys() and len(response_data["error"]) > 0:
-            raise Flow.FlowError(response_data["error"])
+            error = Flow.FlowError(response_data["error"])
         # These happen on certain scenarios on flowappglue,
         # e.g. if executing an API when no local account has started.
-        if "Error" in response_data.keys() and len(response_data["Error"]) > 0:
-            raise Flow.FlowError(response_data["Error"])
-        if "result" in response_data.keys():
-            return response_data["result"]
+        elif "Error" in response_data.keys() \
+                and len(response_data["Error"]) > 0:
+            error = Flow.FlowError(response_data["Error"])
+        if rpc_metrics is not None:
+            rpc_metrics.record(
+                method, latency, len(request_body),
+                len(response.content), error)
+        if error is not None:
+            if hooks:
+                self._call_hooks("on_error", method, params, error, latency)
+            raise error
+        if raw:
+            result = memoryview(response.content)
+        elif "result" in response_data.keys():
+            result = response_data["result"]
         else:
-            return response_data
+            result = response_data
+        if hooks:
+            self._call_hooks("after_response", method, params, result, latency)
+        if self._response_models and not raw:
+            result = models.wrap_response(method, result)
+        return result
 
     @staticmethod
     def _check_file_exists(path, create_if_non_existent=False):
@@ -483,6 +1242,39 @@ class Flow(object):
                     "Cannot access '%s', no such file or directory." % path)
             os.makedirs(path, 0o700)
 
+    @classmethod
+    def _call_concurrently(cls, calls, max_workers=None):
+        """Executes the (function, args, kwargs) tuples in 'calls'
+        on a pool of at most 'max_workers' threads.
+        Returns a list with a (result, exception) tuple per call,
+        in the same order as 'calls'.
+        """
+        results = []
+        if len(calls) == 1:
+            # No need for a thread pool
+            func, args, kwargs = calls[0]
+            try:
+                results.append((func(*args, **kwargs), None))
+            except Exception as exception:
+                results.append((None, exception))
+        if len(calls) <= 1:
+            return results
+        # Imported here to keep 'import flow' fast
+        from concurrent import futures
+        max_workers = min(
+            max_workers or cls._DEFAULT_MAX_WORKERS, len(calls))
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = [
+                executor.submit(func, *args, **kwargs)
+                for func, args, kwargs in calls
+            ]
+            for future in pending:
+                try:
+                    results.append((future.result(), None))
+                except Exception as exception:
+                    results.append((None, exception))
+        return results
+
     def _config(
             self,
             host,
@@ -497,9 +1289,6 @@ class Flow(object):
         If arguments are empty, then it will try to determine the
         configuration.
         """
-        self._check_file_exists(schema_dir)
-        self._check_file_exists(db_dir, True)
-        self._check_file_exists(attachment_dir, True)
         self._run(
             method="Config",
             FlowServHost=host,
@@ -512,7 +1301,8 @@ class Flow(object):
         )
 
     def register_callback(self, notification_name,
-                          callback, sid=0):
+                          callback, sid=0, executor=None, on_complete=None,
+                          timeout=None, max_in_flight=None):
         """Registers a callback to be executed for
         a specific notification type.
         Arguments:
@@ -521,10 +1311,112 @@ class Flow(object):
         callback : function object that receives a string as argument.
         Upon callback execution, the string argument of the callback
         will contain the "data" section of the notification.
-        """
-        sid = self._get_session_id(sid)
+        executor : string, use "process" to execute the callback on a
+        process pool (see set_process_pool()) instead of blocking the
+        notification processing. The callback and the data must be
+        picklable (e.g. the callback must be a module-level function).
+        The following arguments only apply to "process" callbacks:
+        on_complete : function object, it receives the notification type,
+        the value returned by the callback and the exception raised (or
+        None). It runs on the thread that processes the notifications.
+        timeout : float, seconds after which on_complete() receives a
+        FlowTimeoutError, the late result is ignored (the task is not
+        cancelled, it keeps its process until it finishes).
+        max_in_flight : int, max. amount of tasks of this callback on the
+        process pool, when reached, the notification processing blocks
+        until a task finishes.
+        """
+        sid = self._get_session_id(sid)
+        if executor == "process":
+            callback = self._process_callback(
+                sid, callback, on_complete, timeout, max_in_flight)
+        elif executor is not None:
+            raise ValueError("Unknown executor '%s'." % executor)
         self.sessions[sid].register_callback(notification_name, callback)
 
+    def set_process_pool(self, process_pool):
+        """Sets the executor of the callbacks registered with
+        executor="process", a concurrent.futures executor.
+        By default a ProcessPoolExecutor with a process per CPU
+        is created on first use.
+        """
+        self._process_pool = process_pool
+
+    def _get_process_pool(self):
+        """Returns the process pool, it's created on first use."""
+        with self._process_pool_lock:
+            if self._process_pool is None:
+                # Imported here to keep 'import flow' fast
+                from concurrent import futures
+                self._process_pool = futures.ProcessPoolExecutor()
+                self._own_process_pool = True
+            return self._process_pool
+
+    def _process_callback(self, sid, callback, on_complete,
+                          timeout, max_in_flight):
+        """Returns a callback that submits 'callback' to the
+        process pool (see register_callback()).
+        """
+        slots = threading.BoundedSemaphore(max_in_flight) \
+            if max_in_flight else None
+
+        def submit(notif_type, data):
+            """Executes 'callback' on the process pool."""
+            if slots is not None:
+                slots.acquire()
+            try:
+                future = self._get_process_pool().submit(
+                    callback, notif_type, data)
+            except Exception:
+                if slots is not None:
+                    slots.release()
+                raise
+            # The first of the result and the timeout wins
+            completed = threading.Lock()
+
+            def complete(result=None, error=None):
+                """Queues on_complete() on the notification thread."""
+                if not completed.acquire(False):
+                    return
+                if error is not None:
+                    LOG.debug("Error: %s", str(error))
+                if on_complete is not None and sid in self.sessions:
+                    self.sessions[sid].queue_completion(
+                        on_complete, (notif_type, result, error))
+
+            timer = None
+            if timeout is not None:
+                timer = threading.Timer(timeout, complete, kwargs=dict(
+                    error=Flow.FlowTimeoutError(
+                        "Callback timed out after %s secs." % timeout)))
+                timer.daemon = True
+                timer.start()
+
+            def done(future):
+                """Releases the task slot and completes the task."""
+                if slots is not None:
+                    slots.release()
+                if timer is not None:
+                    timer.cancel()
+                try:
+                    result = future.result()
+                except Exception as error:
+                    complete(error=error)
+                else:
+                    complete(result=result)
+            future.add_done_callback(done)
+        # Named after 'callback' (e.g. for flow.profiling), like
+        # functools.wraps() but callables (e.g. functools.partial
+        # objects) may lack a name
+        name = getattr(callback, "__name__", type(callback).__name__)
+        submit.__name__ = name
+        submit.__qualname__ = getattr(callback, "__qualname__", name)
+        submit.__module__ = getattr(
+            callback, "__module__", type(callback).__module__)
+        submit.__doc__ = getattr(callback, "__doc__", None)
+        submit.__wrapped__ = callback
+        return submit
+
     def unregister_callback(self, notification_name, sid=0):
         """Unregisters a callback, this makes the Flow module
         to ignore notifications of this type.
@@ -535,6 +1427,32 @@ class Flow(object):
         sid = self._get_session_id(sid)
         self.sessions[sid].unregister_callback(notification_name)
 
+    def add_notification_listener(self, notification_name,
+                                  listener, sid=0):
+        """Adds a listener for a specific notification type.
+        Unlike callbacks, many listeners can be added for the same type
+        and they are executed on the notification thread as soon as the
+        notification arrives (they don't need process_notifications()),
+        so they must return quickly.
+        Arguments:
+        notification_name : string, type of the notification.
+        listener : function object, same signature as the callbacks.
+        sid : int, SessionID.
+        """
+        sid = self._get_session_id(sid)
+        self.sessions[sid].add_listener(notification_name, listener)
+
+    def remove_notification_listener(self, notification_name,
+                                     listener, sid=0):
+        """Removes a listener added with add_notification_listener().
+        Arguments:
+        notification_name : string, type of the notification.
+        listener : function object.
+        sid : int, SessionID.
+        """
+        sid = self._get_session_id(sid)
+        self.sessions[sid].remove_listener(notification_name, listener)
+
     def process_one_notification(self, timeout_secs=0.05, sid=0):
         """Processes a single notification.
         Returns 'True' if a notification was processed, 'False'
@@ -584,16 +1502,38 @@ class Flow(object):
         while self._loop_process_notifications:
             self.sessions[sid].consume_notification(timeout_secs)
 
-    def new_session(self, timeout=None):
-        """Creates a new session.
+    def new_session(self, timeout=None, priority=None):
+        """Creates a new session, or returns one of the spare
+        sessions created during startup.
         Returns an integer representing a SessionID.
         """
+        with self._spare_sessions_lock:
+            if self._spare_sessions:
+                return self._spare_sessions.pop(0)
+        return self._create_session(timeout=timeout, priority=priority)
+
+    def _create_session(self, timeout=None, priority=None):
+        """Creates a new session with the NewSession API."""
         response = self._run(
             method="NewSession",
             timeout=timeout,
+            priority=priority,
         )
-        sid = response["SessionID"]
-        self.sessions[sid] = self._Session(self, sid)
+        return self._add_session(response["SessionID"])
+
+    def _add_session(self, backend_sid):
+        """Adds a session object for the backend
+        session 'backend_sid', returns its SessionID.
+        """
+        with self._sessions_lock:
+            # After a backend restart, the SessionIDs of the new
+            # backend may be in use by the restored sessions
+            sid = backend_sid
+            while sid in self.sessions:
+                sid += 1
+            session = self._Session(self, sid)
+            session.backend_sid = backend_sid
+            self.sessions[sid] = session
         return sid
 
     def set_current_session(self, sid):
@@ -609,7 +1549,7 @@ class Flow(object):
         used by API calls."""
         return self._current_session
 
-    def start_up(self, username="", sid=0, timeout=None):
+    def start_up(self, username="", sid=0, timeout=None, priority=None):
         """Starts the flowapp instance (notification internal loop, etc)
         for an account that is already created and has a device already
         configured in the current device.
@@ -619,7 +1559,8 @@ class Flow(object):
         first local account on the current device.
         """
         if not username:
-            local_accounts = self.enumerate_local_accounts()
+            local_accounts = self.enumerate_local_accounts(
+                timeout=timeout, priority=priority)
             if local_accounts:
                 username = local_accounts[0]["username"]
         sid = self._get_session_id(sid)
@@ -629,8 +1570,9 @@ class Flow(object):
             Username=username,
             ServerURI=self.server_uri,
             timeout=timeout,
+            priority=priority,
         )
-        self.sessions[sid].start_notification_loop()
+        self.sessions[sid].start_notification_loop(username)
 
     @staticmethod
     def _gen_random_number(digits_count):
@@ -653,11 +1595,12 @@ class Flow(object):
             device_name="",
             phone_number="",
             platform=sys.platform,
-            os_release=platform_module.release(),
+            os_release=None,
             email_confirm_code="",
             totp_verifier="",
             sid=0,
-            timeout=None):
+            timeout=None,
+            priority=None):
         """Creates an account with the specified data.
         'phone_number', along with 'username' and 'server_uri'
         (these last two provided at 'start_up') must be unique.
@@ -679,14 +1622,15 @@ class Flow(object):
             Username=username,
             ServerURI=self.server_uri,
             Platform=platform,
-            OSRelease=os_release,
+            OSRelease=os_release or _default_os_release(),
             Password=password,
             TotpVerifier=totp_verifier,
             EmailConfirmCode=email_confirm_code,
             NotifyToken="",
             timeout=timeout,
+            priority=priority,
         )
-        self.sessions[sid].start_notification_loop()
+        self.sessions[sid].start_notification_loop(username)
 
     def create_dm_account(
             self,
@@ -696,10 +1640,11 @@ class Flow(object):
             device_name="",
             phone_number="",
             platform=sys.platform,
-            os_release=platform_module.release(),
+            os_release=None,
             totp_verifier="",
             sid=0,
-            timeout=None):
+            timeout=None,
+            priority=None):
         """Creates a directory management account with the specified data.
         This call also starts the notification loop for this session.
         If username is not provided, then it generates a random username, it
@@ -722,14 +1667,15 @@ class Flow(object):
             Username=username,
             ServerURI=self.server_uri,
             Platform=platform,
-            OSRelease=os_release,
+            OSRelease=os_release or _default_os_release(),
             Password=password,
             TotpVerifier=totp_verifier,
             DMK=dmk,
             NotifyToken="",
             timeout=timeout,
+            priority=priority,
         )
-        self.sessions[sid].start_notification_loop()
+        self.sessions[sid].start_notification_loop(username)
         return response
 
     def setup_ldap_account(
@@ -738,7 +1684,9 @@ class Flow(object):
             phone_number="",
             totp_verifier="",
             sid=0,
-            timeout=None):
+            timeout=None,
+            priority=None,
+            raw=False):
         """Setups an LDAP account with the specified data. 'phone_number',
         along with 'username' and 'server_uri' (these last two provided at
         'start_up') must be unique.
@@ -757,6 +1705,8 @@ class Flow(object):
             ServerURI=self.server_uri,
             TotpVerifier=totp_verifier,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
     def create_ldap_device(self,
@@ -764,9 +1714,10 @@ class Flow(object):
                            ldap_password,
                            device_name="",
                            platform=sys.platform,
-                           os_release=platform_module.release(),
+                           os_release=None,
                            sid=0,
-                           timeout=None):
+                           timeout=None,
+                           priority=None):
         """Creates a new device for an existing LDAPed account,
         similar to 'create_device' in terms of parameters.
         It also starts the notification loop (like 'create_device').
@@ -783,10 +1734,11 @@ class Flow(object):
             DeviceName=device_name,
             LDAPPassword=ldap_password,
             Platform=platform,
-            OSRelease=os_release,
+            OSRelease=os_release or _default_os_release(),
             timeout=timeout,
+            priority=priority,
         )
-        self.sessions[sid].start_notification_loop()
+        self.sessions[sid].start_notification_loop(username)
         return response
 
     def create_device(self,
@@ -794,9 +1746,10 @@ class Flow(object):
                       password,
                       device_name="",
                       platform=sys.platform,
-                      os_release=platform_module.release(),
+                      os_release=None,
                       sid=0,
-                      timeout=None):
+                      timeout=None,
+                      priority=None):
         """CreateDevice creates a new device for an existing account,
         similar to CreateAccount in terms of parameters.
         It also starts the notification loop (like create_account).
@@ -813,40 +1766,49 @@ class Flow(object):
             DeviceName=device_name,
             Password=password,
             Platform=platform,
-            OSRelease=os_release,
+            OSRelease=os_release or _default_os_release(),
             timeout=timeout,
+            priority=priority,
         )
-        self.sessions[sid].start_notification_loop()
+        self.sessions[sid].start_notification_loop(username)
         return response
 
-    def account_id(self, sid=0, timeout=None):
+    def account_id(self, sid=0, timeout=None, priority=None, raw=False):
         """Returns the accountId for this account."""
         sid = self._get_session_id(sid)
         return self._run(
             method="AccountId",
             SessionID=sid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def build_number(self, sid=0, timeout=None):
+    def build_number(self, sid=0, timeout=None, priority=None, raw=False):
         """Returns the build number for the glue binary."""
         sid = self._get_session_id(sid)
         return self._run(
             method="BuildNumber",
             SessionID=sid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def keyring_fingerprint(self, sid=0, timeout=None):
+    def keyring_fingerprint(self, sid=0,
+                            timeout=None, priority=None, raw=False):
         """Returns the fingerprint of the last keyring on this account."""
         sid = self._get_session_id(sid)
         return self._run(
             method="KeyRingFingerprint",
             SessionID=sid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def new_org(self, name, discoverable=True, sid=0, timeout=None):
+    def new_org(self, name, discoverable=True, sid=0,
+                timeout=None, priority=None, raw=False):
         """Creates a new organization. Returns an 'Org' dict."""
         sid = self._get_session_id(sid)
         return self._run(
@@ -855,9 +1817,12 @@ class Flow(object):
             Name=name,
             Discoverable=discoverable,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def new_channel(self, oid, name, sid=0, timeout=None):
+    def new_channel(self, oid, name, sid=0,
+                    timeout=None, priority=None, raw=False):
         """Creates a new channel in a specific 'OrgID'.
         Returns a string that represents the `ChannelID` created.
         """
@@ -868,9 +1833,11 @@ class Flow(object):
             OrgID=oid,
             Name=name,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def payment_status(self, sid=0, timeout=None):
+    def payment_status(self, sid=0, timeout=None, priority=None, raw=False):
         """Returns the current payment status for the teams and account
         Returns a 'PaymentStatusResponse' dict.
         """
@@ -879,9 +1846,11 @@ class Flow(object):
             method="PaymentStatus",
             SessionID=sid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def enumerate_orgs(self, sid=0, timeout=None):
+    def enumerate_orgs(self, sid=0, timeout=None, priority=None, raw=False):
         """Lists all the orgs the caller is a member of.
         Returns array of 'Org' dicts.
         """
@@ -890,9 +1859,12 @@ class Flow(object):
             method="EnumerateOrgs",
             SessionID=sid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def enumerate_profiles(self, item, sid=0, timeout=None):
+    def enumerate_profiles(self, item, sid=0,
+                           timeout=None, priority=None, raw=False):
         """Lists all the profiles for the specified item.
         Returns array of 'Profile' dicts.
         """
@@ -902,9 +1874,12 @@ class Flow(object):
             SessionID=sid,
             Item=item,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def enumerate_org_members(self, oid, sid=0, timeout=None):
+    def enumerate_org_members(self, oid, sid=0,
+                              timeout=None, priority=None, raw=False):
         """Lists all members for an org and their state."""
         sid = self._get_session_id(sid)
         return self._run(
@@ -912,9 +1887,12 @@ class Flow(object):
             SessionID=sid,
             OrgID=oid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def enumerate_org_member_history(self, oid, sid=0, timeout=None):
+    def enumerate_org_member_history(self, oid, sid=0,
+                                     timeout=None, priority=None, raw=False):
         """Lists all member history for an org and their state.
         Returns an array of 'OrgMember' dicts.
         """
@@ -924,9 +1902,12 @@ class Flow(object):
             SessionID=sid,
             OrgID=oid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def enumerate_channels(self, oid, sid=0, timeout=None):
+    def enumerate_channels(self, oid, sid=0,
+                           timeout=None, priority=None, raw=False):
         """Lists the channels available for an 'OrgID'.
         Returns an array of 'Channel' dicts.
         """
@@ -936,9 +1917,12 @@ class Flow(object):
             SessionID=sid,
             OrgID=oid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def enumerate_channel_members(self, cid, sid=0, timeout=None):
+    def enumerate_channel_members(self, cid, sid=0,
+                                  timeout=None, priority=None, raw=False):
         """Lists the channel members for a given 'ChannelID'.
         Returns an array of 'ChannelMember' dicts.
         """
@@ -948,9 +1932,13 @@ class Flow(object):
             SessionID=sid,
             ChannelID=cid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def enumerate_channel_member_history(self, cid, sid=0, timeout=None):
+    def enumerate_channel_member_history(self, cid, sid=0,
+                                         timeout=None, priority=None,
+                                         raw=False):
         """Lists the channel member history for a given 'ChannelID'.
         Returns an array of 'ChannelMember' dicts.
         """
@@ -960,9 +1948,12 @@ class Flow(object):
             SessionID=sid,
             ChannelID=cid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def new_attachment(self, oid, file_path, sid=0, timeout=None):
+    def new_attachment(self, oid, file_path, sid=0,
+                       timeout=None, priority=None):
         """Returns an 'Attachment' dict ready to be used on send_message().
         file_path must be the absolute path.
         """
@@ -973,12 +1964,13 @@ class Flow(object):
             OrgID=oid,
             FilePath=file_path,
             timeout=timeout,
+            priority=priority,
         )
         file_basename = os.path.basename(file_path)
         return {"id": aid, "filename": file_basename}
 
     def start_attachment_download(
-            self, aid, oid, cid, mid, sid=0, timeout=None):
+            self, aid, oid, cid, mid, sid=0, timeout=None, priority=None):
         """Requests download of an attachment.
         Status will be reported on the notification channel.
         """
@@ -991,9 +1983,11 @@ class Flow(object):
             ChannelID=cid,
             MessageID=mid,
             timeout=timeout,
+            priority=priority,
         )
 
-    def update_attachment_path(self, aid, new_path, sid=0, timeout=None):
+    def update_attachment_path(self, aid, new_path, sid=0,
+                               timeout=None, priority=None):
         """Moves the attachment represented by the id
         specified to 'new_path', if it has completed
         uploading or downloading.
@@ -1005,9 +1999,11 @@ class Flow(object):
             AttachmentID=aid,
             NewPath=new_path,
             timeout=timeout,
+            priority=priority,
         )
 
-    def stored_attachment_path(self, oid, aid, sid=0, timeout=None):
+    def stored_attachment_path(self, oid, aid, sid=0,
+                               timeout=None, priority=None, raw=False):
         """Returns the path where the attachment has been
         stored when the download is complete."""
         sid = self._get_session_id(sid)
@@ -1017,10 +2013,13 @@ class Flow(object):
             OrgID=oid,
             AttachmentID=aid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
     def send_message(self, oid, cid, msg, attachments=None,
-                     other_data=None, sid=0, timeout=None):
+                     other_data=None, sid=0, timeout=None, priority=None,
+                     raw=False):
         """Sends a message to a channel this user is a member of.
         Returns a string that represents the 'MessageID'
         that has just been sent.
@@ -1035,8 +2034,85 @@ class Flow(object):
             OtherData=other_data,
             Attachments=attachments,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
+    def broadcast(self, targets, msg, attachments=None, other_data=None,
+                  max_workers=None, rate_limit=None, sid=0,
+                  timeout=None, priority=None):
+        """Sends the same message to many channels concurrently,
+        on a pool of at most 'max_workers' threads.
+        Arguments:
+        targets : iterable of (oid, cid) tuples.
+        msg : string, text of the message.
+        attachments : list of absolute file paths, each file is uploaded
+        once per org with new_attachment() and the resulting 'Attachment'
+        dicts are reused for all the targets in that org.
+        rate_limit : float, maximum amount of messages sent per second.
+        priority : string, scheduler priority class, 'bulk' by default.
+        Returns a dict that maps each (oid, cid) target to its 'MessageID'
+        string, or to the exception raised when sending to it.
+        """
+        sid = self._get_session_id(sid)
+        priority = priority or Scheduler.BULK
+        options = dict(sid=sid, timeout=timeout, priority=priority)
+        targets = list(targets)
+        results = {}
+
+        org_attachments = {}  # OrgID -> list of 'Attachment' dicts
+        if attachments:
+            oids = list(set(oid for oid, _ in targets))
+            calls = [(self._new_attachments, (oid, attachments), options)
+                     for oid in oids]
+            uploads = self._call_concurrently(calls, max_workers)
+            for oid, (result, exception) in zip(oids, uploads):
+                org_attachments[oid] = exception or result
+
+        send_message = self.send_message
+        if rate_limit:
+            send_message = self._throttled(
+                send_message, throttle.TokenBucket(rate_limit))
+
+        calls = []
+        pending_targets = []
+        for target in targets:
+            oid, cid = target
+            org_attachment_list = org_attachments.get(oid)
+            if isinstance(org_attachment_list, Exception):
+                results[target] = org_attachment_list
+                continue
+            calls.append((
+                send_message,
+                (oid, cid, msg, org_attachment_list, other_data),
+                options,
+            ))
+            pending_targets.append(target)
+        sends = self._call_concurrently(calls, max_workers)
+        for target, (result, exception) in zip(pending_targets, sends):
+            results[target] = exception or result
+        return results
+
+    @staticmethod
+    def _throttled(func, bucket):
+        """Returns a wrapper of 'func' that takes
+        a token from 'bucket' before each call.
+        """
+        def throttled_func(*args, **kwargs):
+            """Throttled call."""
+            bucket.acquire()
+            return func(*args, **kwargs)
+        return throttled_func
+
+    def _new_attachments(self, oid, file_paths, sid=0,
+                         timeout=None, priority=None):
+        """Returns a list of 'Attachment' dicts, one per file path."""
+        return [
+            self.new_attachment(oid, file_path, sid=sid,
+                                timeout=timeout, priority=priority)
+            for file_path in file_paths
+        ]
+
     def wait_for_notification(self, sid=0, timeout=None):
         """Returns the oldest unseen notification
         in the queue for this device.
@@ -1052,7 +2128,8 @@ class Flow(object):
             timeout=timeout,
         )
 
-    def enumerate_messages(self, oid, cid, filters=None, sid=0, timeout=None):
+    def enumerate_messages(self, oid, cid, filters=None, sid=0,
+                           timeout=None, priority=None, raw=False):
         """Lists all the messages for a channel.
         Returns an array of 'Message' dicts.
         """
@@ -1064,9 +2141,12 @@ class Flow(object):
             ChannelID=cid,
             Filters=filters,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def get_unread_count(self, oid, cid, sid=0, timeout=None):
+    def get_unread_count(self, oid, cid, sid=0,
+                         timeout=None, priority=None, raw=False):
         """Returns the amount of unread
         messages for a channel based on the known HWM.
         It will report up to 101 unread messages since
@@ -1080,9 +2160,12 @@ class Flow(object):
             OrgID=oid,
             ChannelID=cid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def search(self, oid, cid, search, sid=0, timeout=None):
+    def search(self, oid, cid, search, sid=0,
+               timeout=None, priority=None, raw=False):
         """Returns a list of 'message' notification dicts for
         all messages matching a search string."""
         sid = self._get_session_id(sid)
@@ -1093,9 +2176,11 @@ class Flow(object):
             ChannelID=cid,
             Search=search,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def get_channel(self, cid, sid=0, timeout=None):
+    def get_channel(self, cid, sid=0, timeout=None, priority=None, raw=False):
         """Returns all the metadata for a channel the user is a member of.
         Returns a 'Channel' dict.
         """
@@ -1105,9 +2190,11 @@ class Flow(object):
             SessionID=sid,
             ChannelID=cid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def new_org_join_request(self, oid, sid=0, timeout=None):
+    def new_org_join_request(self, oid, sid=0, timeout=None, priority=None):
         """Creates a new request to join an existing organization."""
         sid = self._get_session_id(sid)
         self._run(
@@ -1115,9 +2202,11 @@ class Flow(object):
             SessionID=sid,
             OrgID=oid,
             timeout=timeout,
+            priority=priority,
         )
 
-    def enumerate_org_join_requests(self, oid, sid=0, timeout=None):
+    def enumerate_org_join_requests(self, oid, sid=0,
+                                    timeout=None, priority=None, raw=False):
         """Lists all the join requests for an 'OrgID'.
         Returns an array of 'OrgJoinRequest' dicts.
         """
@@ -1127,10 +2216,12 @@ class Flow(object):
             SessionID=sid,
             OrgID=oid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
     def org_add_member(self, oid, account_id,
-                       member_state, sid=0, timeout=None):
+                       member_state, sid=0, timeout=None, priority=None):
         """Adds a member to an organization, assuming the user has
         the proper permissions.
         'member_state' argument valid values are
@@ -1144,10 +2235,11 @@ class Flow(object):
             MemberAccountID=account_id,
             MemberState=member_state,
             timeout=timeout,
+            priority=priority,
         )
 
     def channel_add_member(self, oid, cid, account_id,
-                           member_state, sid=0, timeout=None):
+                           member_state, sid=0, timeout=None, priority=None):
         """Adds the specified member to the channel as long as
         the requestor has the right permissions.
         """
@@ -1160,9 +2252,147 @@ class Flow(object):
             MemberAccountID=account_id,
             MemberState=member_state,
             timeout=timeout,
+            priority=priority,
         )
 
-    def new_direct_conversation(self, oid, account_id, sid=0, timeout=None):
+    def reconcile_membership(self, desired, max_workers=None,
+                             dry_run=False, sid=0,
+                             timeout=None, priority=None):
+        """Brings org and channel membership in line with 'desired'.
+        Current membership is read with enumerate_org_members() and
+        enumerate_channel_members(), and only the org_add_member(),
+        set_org_member_state(), channel_add_member() and
+        new_channel_member_state() calls that are needed are executed,
+        concurrently on at most 'max_workers' threads.
+        Org operations run before channel operations; the channel
+        operations of an account whose org operation failed are skipped.
+        Arguments:
+        desired : iterable of (oid, cid, account_id, member_state) tuples.
+        A tuple with cid=None sets the org membership of the account,
+        accounts that only appear on channel tuples are added to the
+        org as members ('m') if needed.
+        max_workers : int, maximum number of concurrent API calls.
+        dry_run : bool, if True the operations are computed but not run.
+        priority : string, scheduler priority class, 'bulk' by default.
+        Returns a 'ReconcileReport' dict with the 'planned', 'applied',
+        'failed' and 'skipped' operation dicts and the 'unchanged' count.
+        """
+        sid = self._get_session_id(sid)
+        priority = priority or Scheduler.BULK
+        org_desired = {}  # OrgID -> {AccountID -> MemberState}
+        channel_desired = {}  # (OrgID, ChannelID) -> {AccountID -> State}
+        for oid, cid, account_id, member_state in desired:
+            org_members = org_desired.setdefault(oid, {})
+            if cid is None:
+                org_members[account_id] = member_state
+            else:
+                org_members.setdefault(account_id, None)
+                channel_desired.setdefault(
+                    (oid, cid), {})[account_id] = member_state
+
+        # Fetch current membership of all the involved orgs and channels
+        oids = list(org_desired.keys())
+        channel_keys = list(channel_desired.keys())
+        options = dict(sid=sid, timeout=timeout, priority=priority)
+        calls = [(self.enumerate_org_members, (oid,), options)
+                 for oid in oids]
+        calls += [(self.enumerate_channel_members, (cid,), options)
+                  for _, cid in channel_keys]
+        members = []
+        for result, exception in self._call_concurrently(calls, max_workers):
+            if exception is not None:
+                raise exception
+            members.append(dict(
+                (member["accountId"], member["state"])
+                for member in result or []
+            ))
+        org_current = dict(zip(oids, members[:len(oids)]))
+        channel_current = dict(zip(channel_keys, members[len(oids):]))
+
+        unchanged = 0
+        org_ops = []
+        for oid, accounts in org_desired.items():
+            for account_id, member_state in accounts.items():
+                current_state = org_current[oid].get(account_id)
+                if current_state is None:
+                    org_ops.append(self._membership_op(
+                        "org_add_member", oid, None,
+                        account_id, member_state or "m"))
+                elif member_state and member_state != current_state:
+                    org_ops.append(self._membership_op(
+                        "set_org_member_state", oid, None,
+                        account_id, member_state))
+                else:
+                    unchanged += 1
+        channel_ops = []
+        for (oid, cid), accounts in channel_desired.items():
+            for account_id, member_state in accounts.items():
+                current_state = channel_current[(oid, cid)].get(account_id)
+                if current_state is None:
+                    channel_ops.append(self._membership_op(
+                        "channel_add_member", oid, cid,
+                        account_id, member_state))
+                elif member_state != current_state:
+                    channel_ops.append(self._membership_op(
+                        "new_channel_member_state", oid, cid,
+                        account_id, member_state))
+                else:
+                    unchanged += 1
+
+        report = dict(
+            planned=org_ops + channel_ops,
+            applied=[],
+            failed=[],
+            skipped=[],
+            unchanged=unchanged,
+        )
+        if dry_run:
+            return report
+
+        failed_accounts = set()
+        self._apply_membership_ops(org_ops, report, max_workers, options)
+        for op in report["failed"]:
+            failed_accounts.add((op["orgId"], op["accountId"]))
+        runnable_ops = []
+        for op in channel_ops:
+            if (op["orgId"], op["accountId"]) in failed_accounts:
+                report["skipped"].append(op)
+            else:
+                runnable_ops.append(op)
+        self._apply_membership_ops(runnable_ops, report, max_workers, options)
+        return report
+
+    @staticmethod
+    def _membership_op(name, oid, cid, account_id, member_state):
+        """Returns a membership operation dict for reconcile_membership()."""
+        return dict(
+            op=name,
+            orgId=oid,
+            channelId=cid,
+            accountId=account_id,
+            state=member_state,
+        )
+
+    def _apply_membership_ops(self, ops, report, max_workers, options):
+        """Runs the membership operation dicts concurrently and
+        records the outcome of each one on the 'report' dict.
+        """
+        calls = []
+        for op in ops:
+            args = (op["orgId"], op["accountId"], op["state"])
+            if op["channelId"] is not None:
+                args = (op["orgId"], op["channelId"],
+                        op["accountId"], op["state"])
+            calls.append((getattr(self, op["op"]), args, options))
+        results = self._call_concurrently(calls, max_workers)
+        for op, (_, exception) in zip(ops, results):
+            if exception is None:
+                report["applied"].append(op)
+            else:
+                report["failed"].append(dict(op, error=str(exception)))
+
+    def new_direct_conversation(self, oid, account_id, sid=0,
+                                timeout=None, priority=None, raw=False):
         """Creates a new channel to initiate a
         direct conversation with another user.
         Returns a 'ChannelID'.
@@ -1174,9 +2404,12 @@ class Flow(object):
             OrgID=oid,
             MemberID=account_id,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def get_peer(self, username, sid=0, timeout=None):
+    def get_peer(self, username, sid=0,
+                 timeout=None, priority=None, raw=False):
         """Returns all the metadata of a peer from username.
         Returns a 'Peer' dict.
         """
@@ -1186,9 +2419,12 @@ class Flow(object):
             SessionID=sid,
             PeerUsername=username,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def get_peer_from_id(self, account_id, sid=0, timeout=None):
+    def get_peer_from_id(self, account_id, sid=0,
+                         timeout=None, priority=None, raw=False):
         """Returns all the metadata of a peer from account id.
         Returns a 'Peer' dict.
         """
@@ -1198,18 +2434,70 @@ class Flow(object):
             SessionID=sid,
             PeerID=account_id,
             timeout=timeout,
-        )
+            priority=priority,
+            raw=raw,
+        )
+
+    def get_peers_from_ids(self, account_ids, use_cache=True,
+                           max_workers=None, sid=0,
+                           timeout=None, priority=None):
+        """Returns the metadata of many peers from their account ids.
+        Duplicated ids are resolved once, cached peers are returned
+        without calling the API (if 'use_cache' is True) and the
+        rest are resolved concurrently with get_peer_from_id(),
+        on a pool of at most 'max_workers' threads, with the 'bulk'
+        scheduler priority class unless 'priority' is provided.
+        Returns a dict that maps each account id to its 'Peer' dict,
+        or to the exception raised when resolving it.
+        """
+        sid = self._get_session_id(sid)
+        priority = priority or Scheduler.BULK
+        peers = {}
+        missing_ids = []
+        with self._peer_cache_lock:
+            for account_id in account_ids:
+                if account_id in peers:
+                    continue
+                if use_cache and account_id in self._peer_cache:
+                    peers[account_id] = self._peer_cache[account_id]
+                else:
+                    peers[account_id] = None
+                    missing_ids.append(account_id)
+        options = dict(sid=sid, timeout=timeout, priority=priority)
+        calls = [(self.get_peer_from_id, (account_id,), options)
+                 for account_id in missing_ids]
+        results = self._call_concurrently(calls, max_workers)
+        with self._peer_cache_lock:
+            for account_id, (peer, exception) in zip(missing_ids, results):
+                if exception is None:
+                    self._peer_cache[account_id] = peer
+                peers[account_id] = exception or peer
+        return peers
+
+    def clear_peer_cache(self, account_ids=None):
+        """Removes peers from the cache used by get_peers_from_ids().
+        If 'account_ids' is not provided, then the whole cache is cleared.
+        """
+        with self._peer_cache_lock:
+            if account_ids is None:
+                self._peer_cache.clear()
+            else:
+                for account_id in account_ids:
+                    self._peer_cache.pop(account_id, None)
 
-    def enumerate_local_accounts(self, timeout=None):
+    def enumerate_local_accounts(self, timeout=None, priority=None, raw=False):
         """Lists all the accounts configured locally (not the peers).
         Returns an array of 'AccountIdentifier' dicts.
         """
         return self._run(
             method="EnumerateLocalAccounts",
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def enumerate_peer_accounts(self, sid=0, timeout=None):
+    def enumerate_peer_accounts(self, sid=0,
+                                timeout=None, priority=None, raw=False):
         """Lists all the peer accounts.
         Returns an array of 'Peer' dicts.
         """
@@ -1218,6 +2506,8 @@ class Flow(object):
             method="EnumeratePeerAccounts",
             SessionID=sid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
     def new_org_member_state(self,
@@ -1225,7 +2515,9 @@ class Flow(object):
                              member_account_id,
                              member_state,
                              sid=0,
-                             timeout=None):
+                             timeout=None,
+                             priority=None,
+                             raw=False):
         """Use set_org_member_state to change the state of an
         existing member.
         Sets the Org member state for a given account.
@@ -1241,6 +2533,8 @@ class Flow(object):
             MemberAccountID=member_account_id,
             MemberState=member_state,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
     def set_org_member_state(self,
@@ -1248,7 +2542,9 @@ class Flow(object):
                              member_account_id,
                              member_state,
                              sid=0,
-                             timeout=None):
+                             timeout=None,
+                             priority=None,
+                             raw=False):
         """Sets the Org member state for a given account.
         'member_state' can be one of the following:
         'a' (admin), 'm' (member), 'o' (owner), 'b' (blocked).
@@ -1261,6 +2557,8 @@ class Flow(object):
             MemberAccountID=member_account_id,
             MemberState=member_state,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
     def new_channel_member_state(self,
@@ -1269,7 +2567,9 @@ class Flow(object):
                                  member_account_id,
                                  member_state,
                                  sid=0,
-                                 timeout=None):
+                                 timeout=None,
+                                 priority=None,
+                                 raw=False):
         """Sets the Channel member state for a given account.
         'member_state' can be one of the following:
         'a' (admin), 'm' (member), 'o' (owner), 'b' (blocked).
@@ -1283,9 +2583,11 @@ class Flow(object):
             MemberAccountID=member_account_id,
             MemberState=member_state,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def get_devices(self, sid=0, timeout=None):
+    def get_devices(self, sid=0, timeout=None, priority=None, raw=False):
         """Returns all devices associated to the current account.
         Returns a list of 'Device' dicts.
         """
@@ -1294,9 +2596,11 @@ class Flow(object):
             method="GetDevices",
             SessionID=sid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def get_org_types(self, sid=0, timeout=None):
+    def get_org_types(self, sid=0, timeout=None, priority=None, raw=False):
         """Returns the team types available.
         Returns a list of 'OrgType' dicts.
         """
@@ -1305,9 +2609,11 @@ class Flow(object):
             method="GetOrgTypes",
             SessionID=sid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def get_org_data(self, oid, sid=0, timeout=None):
+    def get_org_data(self, oid, sid=0, timeout=None, priority=None, raw=False):
         """Returns extra data for the specified org.
         Returns an 'OrgData' dict.
         """
@@ -1317,18 +2623,23 @@ class Flow(object):
             SessionID=sid,
             OrgID=oid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def device_id(self, sid=0, timeout=None):
+    def device_id(self, sid=0, timeout=None, priority=None, raw=False):
         """Returns the DeviceId of the current device."""
         sid = self._get_session_id(sid)
         return self._run(
             method="DeviceId",
             SessionID=sid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def start_d2d_rendezvous(self, sid=0, timeout=None):
+    def start_d2d_rendezvous(self, sid=0,
+                             timeout=None, priority=None, raw=False):
         """StartD2DRendezvous generates a 32 random bytes for usage as a
         rendezvous ID in device to device provsioning and a key pair for DH.
         It returns the 32 random bytes for them to be shared in some way
@@ -1340,9 +2651,11 @@ class Flow(object):
             method="StartD2DRendezvous",
             SessionID=sid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def provision_new_device(self, sid=0, timeout=None):
+    def provision_new_device(self, sid=0, timeout=None, priority=None):
         """ProvisionNewDevice pushes the provisioning payload for
         a new device to be created from it.
         Only the established device uses this after
@@ -1355,15 +2668,17 @@ class Flow(object):
             method="ProvisionNewDevice",
             SessionID=sid,
             timeout=timeout,
+            priority=priority,
         )
 
     def create_device_from_rendezvous(self,
                                       rendezvous_id,
                                       device_name="",
                                       platform=sys.platform,
-                                      os_release=platform_module.release(),
+                                      os_release=None,
                                       sid=0,
-                                      timeout=None):
+                                      timeout=None,
+                                      priority=None):
         """CreateDeviceFromRendezvous creates a new device by downloading a
         provisioning payload using the rendezvousID.
         Only the new device uses this method.
@@ -1379,18 +2694,20 @@ class Flow(object):
             RendezvousID=rendezvous_id,
             DeviceName=device_name,
             Platform=platform,
-            OSRelease=os_release,
+            OSRelease=os_release or _default_os_release(),
             timeout=timeout,
+            priority=priority,
         )
         self.sessions[sid].start_notification_loop()
 
-    def cancel_rendezvous(self, sid=0, timeout=None):
+    def cancel_rendezvous(self, sid=0, timeout=None, priority=None):
         """CancelRendezvous tries cancelling an ongoing rendezvous, if any."""
         sid = self._get_session_id(sid)
         self._run(
             method="CancelRendezvous",
             SessionID=sid,
             timeout=timeout,
+            priority=priority,
         )
 
     @staticmethod
@@ -1403,7 +2720,7 @@ class Flow(object):
         ))
         return content
 
-    def set_profile(self, item, content, sid=0, timeout=None):
+    def set_profile(self, item, content, sid=0, timeout=None, priority=None):
         """Sets the given item with content"""
         sid = self._get_session_id(sid)
         self._run(
@@ -1412,10 +2729,12 @@ class Flow(object):
             Content=content,
             Item=item,
             timeout=timeout,
+            priority=priority,
         )
 
     def change_username(self, username, password,
-                        email_confirm_code="", sid=0, timeout=None):
+                        email_confirm_code="", sid=0,
+                        timeout=None, priority=None):
         """Changes the username for the current account"""
         sid = self._get_session_id(sid)
         self._run(
@@ -1425,9 +2744,10 @@ class Flow(object):
             Password=password,
             EmailConfirmCode=email_confirm_code,
             timeout=timeout,
+            priority=priority,
         )
 
-    def change_password(self, password, sid=0, timeout=None):
+    def change_password(self, password, sid=0, timeout=None, priority=None):
         """Changes the password for the current account"""
         sid = self._get_session_id(sid)
         self._run(
@@ -1435,9 +2755,10 @@ class Flow(object):
             SessionID=sid,
             NewPassword=password,
             timeout=timeout,
+            priority=priority,
         )
 
-    def identifier(self, sid=0, timeout=None):
+    def identifier(self, sid=0, timeout=None, priority=None, raw=False):
         """Identifier returns the Username and ServerURI for this account.
         Returns an 'AccountIdentifier' dict.
         """
@@ -1446,15 +2767,19 @@ class Flow(object):
             method="Identifier",
             SessionID=sid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def peer_data(self, sid=0, timeout=None):
+    def peer_data(self, sid=0, timeout=None, priority=None, raw=False):
         """Returns 'Peer' dict for this account."""
         sid = self._get_session_id(sid)
         return self._run(
             method="PeerData",
             SessionID=sid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
     def verify_peer_keyring(self,
@@ -1463,7 +2788,9 @@ class Flow(object):
                             keyring_id,
                             verification_method,
                             sid=0,
-                            timeout=None):
+                            timeout=None,
+                            priority=None,
+                            raw=False):
         """Peer Key Verification for web of trust."""
         sid = self._get_session_id(sid)
         return self._run(
@@ -1474,9 +2801,12 @@ class Flow(object):
             PeerKeyRingID=keyring_id,
             VerificationMethod=verification_method,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def set_channel_read_hwm(self, oid, cid, mid, sid=0, timeout=None):
+    def set_channel_read_hwm(self, oid, cid, mid, sid=0,
+                             timeout=None, priority=None):
         """Sets a new HWM for an account in a channel."""
         sid = self._get_session_id(sid)
         self._run(
@@ -1486,10 +2816,12 @@ class Flow(object):
             ChannelID=cid,
             MessageID=mid,
             timeout=timeout,
+            priority=priority,
         )
 
     def set_channel_retention_policy(
-            self, oid, cid, cat, days, msgs, sid=0, timeout=None):
+            self, oid, cid, cat, days, msgs, sid=0,
+            timeout=None, priority=None):
         """Sets a new message retention policy for an account in a channel."""
         sid = self._get_session_id(sid)
         self._run(
@@ -1501,17 +2833,22 @@ class Flow(object):
             MaxDays=days,
             MaxMessages=msgs,
             timeout=timeout,
+            priority=priority,
         )
 
     def verification_hash(self,
                           sid=0,
-                          timeout=None):
+                          timeout=None,
+                          priority=None,
+                          raw=False):
         """Returns the verification hash for this account."""
         sid = self._get_session_id(sid)
         return self._run(
             method="VerificationHash",
             SessionID=sid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
     def peer_verification_hash(self,
@@ -1519,7 +2856,9 @@ class Flow(object):
                                fingerprint,
                                provided_hash,
                                sid=0,
-                               timeout=None):
+                               timeout=None,
+                               priority=None,
+                               raw=False):
         """Computes:
         hash(username + separator + serverURI + separator + fingerprint)
         for the specified account and compares it in constant time
@@ -1534,12 +2873,15 @@ class Flow(object):
             Fingerprint=fingerprint,
             ProvidedHash=provided_hash,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
     def confirm_email(self,
                       username,
                       sid=0,
-                      timeout=None):
+                      timeout=None,
+                      priority=None):
         """Sends a confirmation request to the server
         The server will email a confirm code to the specified address
         The caller should use the code as the 'email_confirm_code' argument
@@ -1552,13 +2894,15 @@ class Flow(object):
             Username=username,
             ServerURI=self.server_uri,
             timeout=timeout,
+            priority=priority,
         )
 
     def delete_channel(self,
                        oid,
                        cid,
                        sid=0,
-                       timeout=None):
+                       timeout=None,
+                       priority=None):
         """Removes a channel by banning all channel members."""
         sid = self._get_session_id(sid)
         self._run(
@@ -1567,10 +2911,12 @@ class Flow(object):
             OrgID=oid,
             ChannelID=cid,
             timeout=timeout,
+            priority=priority,
         )
 
     def fetch_ldap_public_key(
-            self, username, fingerprint, sid=0, timeout=None):
+            self, username, fingerprint, sid=0, timeout=None, priority=None,
+            raw=False):
         """Fetch the public key for the LDAP management
         account for the given username (assuming it's an email).
         """
@@ -1582,9 +2928,12 @@ class Flow(object):
             ServerURI=self.server_uri,
             Fingerprint=fingerprint,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def untrust_ldap_public_key(self, username, sid=0, timeout=None):
+    def untrust_ldap_public_key(self, username, sid=0,
+                                timeout=None, priority=None):
         """Marks as untrusted the public key for the LDAP management
         account for the given username (assuming it's an email).
         """
@@ -1595,6 +2944,7 @@ class Flow(object):
             Username=username,
             ServerURI=self.server_uri,
             timeout=timeout,
+            priority=priority,
         )
 
     def ldap_bind_response(self,
@@ -1602,7 +2952,9 @@ class Flow(object):
                            secure_exchange_token,
                            level2_secret,
                            sid=0,
-                           timeout=None):
+                           timeout=None,
+                           priority=None,
+                           raw=False):
         """Sends the LDAP bind result of the given user to the server.
         Arguments:
         - secure_exchange_token: string, this is the secure_exchange_token
@@ -1619,6 +2971,8 @@ class Flow(object):
             SecureExchangeToken=secure_exchange_token,
             Level2Secret=level2_secret,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
     def link_ldap_account(self,
@@ -1626,7 +2980,9 @@ class Flow(object):
                           secure_exchange_token,
                           level2_secret,
                           sid=0,
-                          timeout=None):
+                          timeout=None,
+                          priority=None,
+                          raw=False):
         """Sends the LDAP bind result of the given user to the server.
         Arguments:
         - secure_exchange_token: string, this is the secure_exchange_token
@@ -1643,12 +2999,16 @@ class Flow(object):
             SecureExchangeToken=secure_exchange_token,
             Level2Secret=level2_secret,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
     def link_to_ldap(self,
                      ldap_password,
                      sid=0,
-                     timeout=None):
+                     timeout=None,
+                     priority=None,
+                     raw=False):
         """Sends the LDAP credentials to the LDAP bot and flags the account as
         an LDAPd account on the server side.
         """
@@ -1658,20 +3018,27 @@ class Flow(object):
             SessionID=sid,
             LDAPPassword=ldap_password,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
     def ldaped(self,
                sid=0,
-               timeout=None):
+               timeout=None,
+               priority=None,
+               raw=False):
         """Returns whether the account is LDAPed or not."""
         sid = self._get_session_id(sid)
         return self._run(
             method="LDAPed",
             SessionID=sid,
             timeout=timeout,
+            priority=priority,
+            raw=raw,
         )
 
-    def set_account_lock(self, username, lock_type, sid=0, timeout=None):
+    def set_account_lock(self, username, lock_type, sid=0,
+                         timeout=None, priority=None):
         """Sets the lock type for the given account."""
         sid = self._get_session_id(sid)
         self._run(
@@ -1681,9 +3048,10 @@ class Flow(object):
             ServerURI=self.server_uri,
             LockType=lock_type,
             timeout=timeout,
+            priority=priority,
         )
 
-    def pause(self, sid=0, timeout=None):
+    def pause(self, sid=0, timeout=None, priority=None):
         """Disconnect from the notification service.
         Any existing already-in-progress
         request to the server may continue.
@@ -1693,15 +3061,17 @@ class Flow(object):
             method="Pause",
             SessionID=sid,
             timeout=timeout,
+            priority=priority,
         )
 
-    def resume(self, sid=0, timeout=None):
+    def resume(self, sid=0, timeout=None, priority=None):
         """Resume after a 'pause' operation."""
         sid = self._get_session_id(sid)
         self._run(
             method="Resume",
             SessionID=sid,
             timeout=timeout,
+            priority=priority,
         )
 
     def _close(self, sid=0):
@@ -0,0 +1,277 @@
+"""
+host.py
+Host for many bot accounts in a single process.
+"""
+
+import collections
+import threading
+import time
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+from concurrent import futures
+
+from .flow import LOG, _import_requests
+from .pool import AccountClient, FlowPool
+
+# Monotonic clock when available (Python 3.3+)
+_clock = getattr(time, "monotonic", time.time)
+
+
+class HostedAccount(AccountClient):
+    """AccountClient of a BotHost account. Besides routing the API calls,
+    it holds the account callbacks and its resource usage (see usage()).
+    """
+
+    def __init__(self, flow, sid, username):
+        AccountClient.__init__(self, flow, sid, username)
+        self.callbacks = {}  # Notification Name -> Function Object
+        self._listened = set()  # Notification names forwarded to the host
+        self._pending = collections.deque()  # Notifications to dispatch
+        self._dispatching = False
+        self._lock = threading.Lock()
+        self._usage = dict(
+            apiCalls=0,
+            apiErrors=0,
+            apiTime=0.0,
+            notifications=0,
+            callbacks=0,
+            callbackErrors=0,
+            callbackTime=0.0,
+        )
+
+    def _add_usage(self, **amounts):
+        """Adds 'amounts' to the usage counters."""
+        with self._lock:
+            for counter, amount in amounts.items():
+                self._usage[counter] += amount
+
+    def usage(self):
+        """Returns a dict with the resource usage of the account:
+        'apiCalls', 'apiErrors' and 'apiTime' (seconds) of the API calls
+        made on its session (through this object or through the Flow
+        object, except WaitForNotification), 'notifications' received,
+        'callbacks' executed, 'callbackErrors', 'callbackTime' (seconds)
+        and 'queued', the notifications waiting for a dispatch thread.
+        """
+        with self._lock:
+            usage = dict(self._usage)
+            usage["queued"] = len(self._pending)
+        return usage
+
+
+class BotHost(FlowPool):
+    """Runs many bot accounts in one process.
+    All the accounts share:
+    - the backends (see FlowPool), and thus the peer cache of the
+    backend where they are placed.
+    - a single keep-alive HTTP transport for the API requests.
+    - a pool of 'dispatch_workers' threads that execute the callbacks.
+    Callbacks can be registered for a single account or for all of them.
+    The callbacks of an account are executed one at a time and in order,
+    the callbacks of different accounts run concurrently.
+    Usage:
+    host = BotHost(dispatch_workers=8)
+    for username in usernames:
+        host.start_up(username)
+
+    @host.callback(Flow.MESSAGE_NOTIFICATION)
+    def on_message(account, notif_type, data):
+        ...
+    host.process_notifications()
+    """
+
+    _account_class = HostedAccount
+
+    DEFAULT_DISPATCH_WORKERS = 8
+
+    # Max. notifications of an account dispatched in a row, before
+    # giving the dispatch thread to other accounts
+    _MAX_DISPATCH_BATCH = 16
+
+    # Max. kept-alive connections to the backends
+    _MAX_CONNECTIONS = 256
+
+    def __init__(self, backends=1, dispatch_workers=None, **pool_args):
+        """Arguments:
+        backends : int, number of flowappglue backends.
+        dispatch_workers : int, number of threads that execute the
+        callbacks, defaults to DEFAULT_DISPATCH_WORKERS.
+        pool_args : kwargs, other FlowPool() arguments.
+        """
+        FlowPool.__init__(self, backends, **pool_args)
+        requests = _import_requests()
+        self._http_session = requests.Session()
+        self._http_session.mount("http://", requests.adapters.HTTPAdapter(
+            pool_maxsize=self._MAX_CONNECTIONS))
+        # Backend index -> (backend generation, accounts,
+        # dict of backend SessionID -> HostedAccount), see _account_of()
+        self._backend_sessions = {}
+        for index, flow in enumerate(self.flows):
+            flow.set_http_session(self._http_session)
+            self._add_usage_hooks(index, flow)
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=dispatch_workers or self.DEFAULT_DISPATCH_WORKERS)
+        self._closed = False
+
+    def _add_usage_hooks(self, index, flow):
+        """Meters the API calls made on the sessions of the accounts
+        of a backend, whichever object they are made through.
+        """
+        def after_response(method, params, result, latency):
+            """Adds a successful API call to the account usage."""
+            self._meter(index, flow, method, params, latency)
+
+        def on_error(method, params, error, latency):
+            """Adds a failed API call to the account usage."""
+            self._meter(index, flow, method, params, latency, error)
+        flow.add_hook("after_response", after_response)
+        flow.add_hook("on_error", on_error)
+
+    def _meter(self, index, flow, method, params, latency, error=None):
+        """Updates the API usage of the account of the request."""
+        if method == "WaitForNotification":
+            return
+        account = self._account_of(index, flow, params.get("SessionID"))
+        if account is None:
+            return
+        account._add_usage(
+            apiCalls=1, apiErrors=int(error is not None), apiTime=latency)
+
+    def _account_of(self, index, flow, backend_sid):
+        """Returns the HostedAccount of a backend SessionID, the map is
+        rebuilt when accounts are added or the backend restarts.
+        """
+        generation = flow._backend_generation
+        cached = self._backend_sessions.get(index)
+        if cached is None or cached[0] != generation \
+                or cached[1] != len(self._accounts):
+            accounts = self.accounts()
+            by_backend_sid = {}
+            for account in accounts:
+                session = flow.sessions.get(account.sid)
+                if account.flow is flow and session is not None:
+                    by_backend_sid[session.backend_sid] = account
+            cached = (generation, len(accounts), by_backend_sid)
+            self._backend_sessions[index] = cached
+        return cached[2].get(backend_sid)
+
+    def register_callback(self, notification_name, callback, username=None):
+        """Registers a callback for a notification type.
+        Arguments:
+        notification_name : string, type of the notification.
+        callback : function object, it receives the HostedAccount,
+        the notification type and its data.
+        username : string, account of the callback, if empty, then the
+        callback is registered for all the accounts (current and future
+        ones) that don't have their own callback for the notification.
+        """
+        if not username:
+            FlowPool.register_callback(self, notification_name, callback)
+            return
+        account = self.account(username)
+        with self._lock:
+            account.callbacks[notification_name] = callback
+        self._add_listener(account, notification_name)
+
+    def callback(self, notification_name, username=None):
+        """Decorator version of register_callback()."""
+        def decorator(func):
+            """Registers 'func' as callback."""
+            self.register_callback(notification_name, func, username)
+            return func
+        return decorator
+
+    def _add_listener(self, account, notification_name):
+        """Forwards the notifications of an account to the host queue,
+        once per notification type.
+        """
+        with self._lock:
+            if notification_name in account._listened:
+                return
+            account._listened.add(notification_name)
+        FlowPool._add_listener(self, account, notification_name)
+
+    def process_one_notification(self, timeout_secs=0.05):
+        """Hands a single notification of any account to the dispatch
+        threads. Returns 'True' if a notification was processed, 'False'
+        meaning no notification was available for processing.
+        """
+        try:
+            account, notif_type, data = self.notification_queue.get(
+                block=True, timeout=timeout_secs)
+        except Queue.Empty:
+            return False
+        with self._lock:
+            callback = account.callbacks.get(notif_type) or \
+                self._callbacks.get(notif_type)
+        if callback is None:
+            return True
+        with account._lock:
+            account._usage["notifications"] += 1
+            account._pending.append((callback, notif_type, data))
+            if account._dispatching:
+                return True
+            account._dispatching = True
+        self._submit_dispatch(account)
+        return True
+
+    def _submit_dispatch(self, account):
+        """Hands the pending callbacks of an account to a dispatch
+        thread, unless the host was terminated.
+        """
+        try:
+            if self._closed:
+                raise RuntimeError("BotHost terminated")
+            self._executor.submit(self._dispatch, account)
+        except RuntimeError:
+            with account._lock:
+                account._dispatching = False
+                pending = len(account._pending)
+            if pending:
+                LOG.warn(
+                    "Host terminated: %d notifications of '%s' "
+                    "not dispatched", pending, account.username)
+
+    def _dispatch(self, account):
+        """Executes the pending callbacks of an account,
+        runs on a dispatch thread.
+        """
+        for _ in range(self._MAX_DISPATCH_BATCH):
+            with account._lock:
+                if not account._pending:
+                    account._dispatching = False
+                    return
+                callback, notif_type, data = account._pending.popleft()
+            start = _clock()
+            try:
+                callback(account, notif_type, data)
+            except Exception as exception:
+                account._add_usage(callbackErrors=1)
+                LOG.debug("Error: %s", str(exception))
+            finally:
+                account._add_usage(callbacks=1, callbackTime=_clock() - start)
+        # Let the other accounts use the dispatch thread
+        self._submit_dispatch(account)
+
+    def stats(self):
+        """Returns a dict that maps each username to its
+        resource usage (see HostedAccount.usage()).
+        """
+        return dict(
+            (account.username, account.usage())
+            for account in self.accounts()
+        )
+
+    def terminate(self, timeout_secs=5):
+        """Stops the dispatch threads and shuts down the backends.
+        The notifications that were not dispatched are dropped, they are
+        counted as 'queued' in the usage of their accounts.
+        """
+        self._closed = True
+        self._executor.shutdown(wait=False)
+        FlowPool.terminate(self, timeout_secs)
+        self._http_session.close()
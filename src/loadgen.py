@@ -0,0 +1,451 @@
+"""
+loadgen.py
+Load generator: runs simulated bots on the fake backend (flow.fakeglue)
+to find how many bots one host can run before the notification lag or
+the API latency degrade.
+Each bot is a session with its own account, org and channel. A peer
+sends messages to every bot channel at a fixed rate, and the bots
+handle them with a callback that burns CPU and makes API calls.
+usage:
+python -m flow.loadgen [--bots N] [--rate MSGS] [--cpu-ms MS]
+                       [--rpc-mix METHOD:CALLS,...] [--duration SECS]
+                       [--find-saturation] [--max-bots N] [--output FILE]
+"""
+
+import argparse
+import json
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from . import fakeglue
+from .flow import Flow, LOG, _import_requests
+
+# Monotonic clock when available (Python 3.3+)
+_clock = getattr(time, "monotonic", time.time)
+
+_PEER_USERNAME = "loadgen-peer"
+
+
+def _percentiles(values):
+    """Returns a dict with the p50, p90, p99 and max of 'values'."""
+    if not values:
+        return dict(p50=0.0, p90=0.0, p99=0.0, max=0.0)
+    values = sorted(values)
+    last = len(values) - 1
+    return dict(
+        p50=values[int(0.5 * last)],
+        p90=values[int(0.9 * last)],
+        p99=values[int(0.99 * last)],
+        max=values[-1],
+    )
+
+
+def _burn_cpu(seconds):
+    """Keeps the CPU busy for 'seconds'."""
+    deadline = _clock() + seconds
+    while _clock() < deadline:
+        pass
+
+
+def _cpu_time():
+    """Returns the CPU seconds (user + system) used by this process."""
+    if resource is None:
+        return getattr(time, "process_time", lambda: 0.0)()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def parse_rpc_mix(spec):
+    """Parses a 'METHOD:CALLS,...' string into a dict, CALLS is the
+    (average, can be fractional) amount of calls per handled message.
+    """
+    rpc_mix = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        method, _, calls = item.partition(":")
+        if method not in LoadGenerator.RPC_METHODS:
+            raise ValueError("Unknown method '%s', use one of: %s." % (
+                method, ", ".join(sorted(LoadGenerator.RPC_METHODS))))
+        rpc_mix[method] = float(calls or 1)
+    return rpc_mix
+
+
+class _Bot(object):
+    """Simulated bot, a session with an account, an org and a channel."""
+
+    def __init__(self, generator, flow, sid, index):
+        self.generator = generator
+        self.flow = flow
+        self.sid = sid
+        self.username = "loadgen-bot-%d" % index
+        self.account_id = None
+        self.oid = None
+        self.cid = None
+        self._random = random.Random(index)
+
+    def setup(self):
+        """Starts the account and creates the org and channel."""
+        if self.sid != self.flow._get_session_id(0):
+            self.flow.start_up(self.username, sid=self.sid)
+        self.account_id = self.flow.account_id(sid=self.sid)
+        self.oid = self.flow.new_org(self.username, False, sid=self.sid)["id"]
+        self.cid = self.flow.new_channel(self.oid, "load", sid=self.sid)
+        self.flow.register_callback(
+            Flow.MESSAGE_NOTIFICATION, self.on_message, sid=self.sid)
+
+    def on_message(self, notif_type, data):
+        """Message callback: burns CPU and makes the API calls of the
+        RPC mix for each message from the peer.
+        """
+        generator = self.generator
+        for message in data.get("regularMessages", []):
+            if message["senderAccountId"] == self.account_id:
+                continue
+            generator.lags.append(time.time() - message["creationTime"])
+            if generator.cpu_cost:
+                _burn_cpu(generator.cpu_cost)
+            for method, calls in generator.rpc_mix.items():
+                count = int(calls)
+                if self._random.random() < calls - count:
+                    count += 1
+                for _ in range(count):
+                    self._call(method)
+            generator.handled.append(1)
+
+    def _call(self, method):
+        """Makes one API call of the RPC mix, timing it."""
+        start = _clock()
+        try:
+            if method == "SendMessage":
+                self.flow.send_message(
+                    self.oid, self.cid, "reply", sid=self.sid)
+            elif method == "EnumerateMessages":
+                self.flow.enumerate_messages(self.oid, self.cid, sid=self.sid)
+            elif method == "EnumerateChannels":
+                self.flow.enumerate_channels(self.oid, sid=self.sid)
+            elif method == "GetChannel":
+                self.flow.get_channel(self.cid, sid=self.sid)
+            elif method == "AccountId":
+                self.flow.account_id(sid=self.sid)
+        except Exception as exception:
+            LOG.debug("Error: %s", str(exception))
+            self.generator.rpc_errors.append(1)
+        self.generator.rpc_latencies.append(_clock() - start)
+
+    def consume(self, stop):
+        """Processes the notifications of the bot until 'stop' is set."""
+        while not stop.is_set():
+            self.flow.process_one_notification(0.1, sid=self.sid)
+
+
+class LoadGenerator(object):
+    """Runs load stages of N bots on the fake backend, and finds the
+    saturation point: the most bots for which the notification lag and
+    API latency stay under their limits, nothing is dropped and the
+    bots keep up with the offered message rate.
+    """
+
+    RPC_METHODS = frozenset((
+        "SendMessage",
+        "EnumerateMessages",
+        "EnumerateChannels",
+        "GetChannel",
+        "AccountId",
+    ))
+
+    # Share of the offered messages that must be handled
+    THROUGHPUT_TOLERANCE = 0.95
+
+    # Seconds to wait for the messages in flight at the end of a stage
+    _DRAIN_SECS = 2.0
+
+    def __init__(self, rate=1.0, cpu_cost=0.0, rpc_mix=None, duration=10.0,
+                 max_lag=1.0, max_rpc_latency=0.5, backend_latency=0.0):
+        """Arguments:
+        rate : float, messages per second sent to each bot.
+        cpu_cost : float, CPU seconds burnt per handled message.
+        rpc_mix : dict, API method -> calls per handled message
+        (see RPC_METHODS), defaults to one SendMessage.
+        duration : float, seconds of each stage.
+        max_lag : float, max. p99 notification lag (seconds from the
+        message creation until its callback).
+        max_rpc_latency : float, max. p99 API latency of the bots.
+        backend_latency : float, latency injected in the fake backend.
+        """
+        self.rate = rate
+        self.cpu_cost = cpu_cost
+        self.rpc_mix = dict(SendMessage=1.0) if rpc_mix is None else rpc_mix
+        self.duration = duration
+        self.max_lag = max_lag
+        self.max_rpc_latency = max_rpc_latency
+        self.backend_latency = backend_latency
+        self.lags = []
+        self.handled = []
+        self.rpc_latencies = []
+        self.rpc_errors = []
+
+    def _start_bots(self, flow, count):
+        """Returns 'count' bots, set up on sessions of 'flow'."""
+        sids = [flow._get_session_id(0)]
+        calls = [(flow.new_session, (), {}) for _ in range(count - 1)]
+        for sid, exception in Flow._call_concurrently(calls):
+            if exception is not None:
+                raise exception
+            sids.append(sid)
+        bots = [_Bot(self, flow, sid, index)
+                for index, sid in enumerate(sids)]
+        results = Flow._call_concurrently(
+            [(bot.setup, (), {}) for bot in bots])
+        for _, exception in results:
+            if exception is not None:
+                raise exception
+        return bots
+
+    def _send_messages(self, flow, bots, stop):
+        """Sends messages to the bots at the configured rate until 'stop'
+        is set. Returns the amount of messages sent.
+        """
+        # Imported here to keep 'import flow' fast
+        from concurrent import futures
+        interval = 1.0 / (self.rate * len(bots))
+        sent = 0
+        start = _clock()
+        with futures.ThreadPoolExecutor(min(32, len(bots))) as executor:
+            while not stop.is_set():
+                bot = bots[sent % len(bots)]
+                executor.submit(
+                    fakeglue.deliver_message, flow, bot.oid, bot.cid,
+                    "load", _PEER_USERNAME)
+                sent += 1
+                delay = start + sent * interval - _clock()
+                if delay > 0:
+                    stop.wait(delay)
+        return sent
+
+    def run_stage(self, bots):
+        """Runs 'bots' bots for the stage duration.
+        Returns a dict with the results of the stage.
+        """
+        self.lags = []
+        self.handled = []
+        self.rpc_latencies = []
+        self.rpc_errors = []
+        work_dir = tempfile.mkdtemp(prefix="flow-loadgen-")
+        flow = Flow(
+            username="loadgen-bot-0",
+            flowappglue=fakeglue.get_path(),
+            db_dir=work_dir,
+            schema_dir=work_dir,
+            attachment_dir=work_dir,
+        )
+        try:
+            requests = _import_requests()
+            http_session = requests.Session()
+            http_session.mount("http://", requests.adapters.HTTPAdapter(
+                pool_maxsize=bots + 32))
+            flow.set_http_session(http_session)
+            if self.backend_latency:
+                fakeglue.set_faults(flow, latency=self.backend_latency)
+            bot_list = self._start_bots(flow, bots)
+            stop_consumers = threading.Event()
+            consumers = []
+            for bot in bot_list:
+                consumer = threading.Thread(
+                    target=bot.consume, args=(stop_consumers,))
+                consumer.daemon = True
+                consumer.start()
+                consumers.append(consumer)
+            stop_sending = threading.Event()
+            timer = threading.Timer(self.duration, stop_sending.set)
+            cpu_start = _cpu_time()
+            start = _clock()
+            timer.start()
+            sent = self._send_messages(flow, bot_list, stop_sending)
+            elapsed = _clock() - start
+            drain_deadline = _clock() + self._DRAIN_SECS
+            while len(self.handled) < sent and _clock() < drain_deadline:
+                time.sleep(0.05)
+            cpu = _cpu_time() - cpu_start
+            threads = threading.active_count()
+            stop_consumers.set()
+            for consumer in consumers:
+                consumer.join()
+            dropped = sum(
+                flow.get_notification_stats(bot.sid)["dropped"]
+                for bot in bot_list)
+        finally:
+            flow.terminate()
+            shutil.rmtree(work_dir, ignore_errors=True)
+        handled = len(self.handled)
+        result = dict(
+            bots=bots,
+            offeredPerSec=self.rate * bots,
+            sent=sent,
+            handled=handled,
+            dropped=dropped,
+            handledPerSec=handled / elapsed,
+            rpcCalls=len(self.rpc_latencies),
+            rpcErrors=len(self.rpc_errors),
+            rpcPerSec=len(self.rpc_latencies) / elapsed,
+            lag=_percentiles(self.lags),
+            rpcLatency=_percentiles(self.rpc_latencies),
+            cpuSeconds=cpu,
+            cpuPercent=100.0 * cpu / (elapsed + self._DRAIN_SECS),
+            threads=threads,
+        )
+        if resource is not None:
+            # KB on Linux, bytes on macOS
+            result["maxRSS"] = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss
+        result["saturated"] = self._saturation_reasons(result)
+        return result
+
+    def _saturation_reasons(self, result):
+        """Returns the list of reasons why a stage is saturated,
+        empty if it is not.
+        """
+        reasons = []
+        if result["lag"]["p99"] > self.max_lag:
+            reasons.append("lag p99 %.3fs > %.3fs" % (
+                result["lag"]["p99"], self.max_lag))
+        if result["rpcLatency"]["p99"] > self.max_rpc_latency:
+            reasons.append("RPC latency p99 %.3fs > %.3fs" % (
+                result["rpcLatency"]["p99"], self.max_rpc_latency))
+        if result["dropped"]:
+            reasons.append("%d notifications dropped" % result["dropped"])
+        if result["handledPerSec"] < \
+                self.THROUGHPUT_TOLERANCE * result["offeredPerSec"]:
+            reasons.append("handled %.1f/s of %.1f/s offered" % (
+                result["handledPerSec"], result["offeredPerSec"]))
+        return reasons
+
+    def find_saturation(self, start=1, max_bots=1024, factor=2,
+                        on_stage=None):
+        """Finds the saturation point: grows the amount of bots by
+        'factor' from 'start' until a stage is saturated (or 'max_bots'),
+        then bisects between the last good and the first saturated
+        stages, down to a 10% gap.
+        'on_stage' is called with the result of each stage.
+        Returns a dict with 'saturationBots' (None if even 'start' bots
+        saturate), 'firstSaturatedBots' (None if 'max_bots' did not
+        saturate) and the results of the 'stages'.
+        """
+        stages = []
+
+        def run(bots):
+            result = self.run_stage(bots)
+            stages.append(result)
+            if on_stage is not None:
+                on_stage(result)
+            return not result["saturated"]
+
+        good, bad = None, None
+        bots = start
+        while bots <= max_bots:
+            if not run(bots):
+                bad = bots
+                break
+            good = bots
+            bots = int(bots * factor)
+        if good is not None and bad is not None:
+            while bad - good > max(1, good // 10):
+                middle = (good + bad) // 2
+                if run(middle):
+                    good = middle
+                else:
+                    bad = middle
+        return dict(
+            saturationBots=good,
+            firstSaturatedBots=bad,
+            stages=stages,
+        )
+
+
+def _print_stage(result):
+    """Prints a one line summary of a stage result to stderr."""
+    sys.stderr.write(
+        "%5d bots: %8.1f msgs/s (%.1f offered), lag p50/p99 %.3f/%.3fs, "
+        "rpc p50/p99 %.3f/%.3fs, cpu %.0f%%%s\n" % (
+            result["bots"],
+            result["handledPerSec"],
+            result["offeredPerSec"],
+            result["lag"]["p50"],
+            result["lag"]["p99"],
+            result["rpcLatency"]["p50"],
+            result["rpcLatency"]["p99"],
+            result["cpuPercent"],
+            " SATURATED: " + "; ".join(result["saturated"])
+            if result["saturated"] else "",
+        ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m flow.loadgen",
+        description="Runs simulated bots on the fake flowappglue backend.",
+    )
+    parser.add_argument("--bots", type=int, default=10,
+                        help="bots (start of the search with "
+                        "--find-saturation)")
+    parser.add_argument("--rate", type=float, default=1.0,
+                        help="messages per second per bot")
+    parser.add_argument("--cpu-ms", type=float, default=0.0,
+                        help="CPU milliseconds per handled message")
+    parser.add_argument("--rpc-mix", default="SendMessage:1",
+                        help="API calls per handled message, "
+                        "METHOD:CALLS,... (%s)" % ", ".join(
+                            sorted(LoadGenerator.RPC_METHODS)))
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="seconds per stage")
+    parser.add_argument("--backend-latency", type=float, default=0.0,
+                        help="seconds added to every API call")
+    parser.add_argument("--find-saturation", action="store_true")
+    parser.add_argument("--max-bots", type=int, default=1024)
+    parser.add_argument("--max-lag", type=float, default=1.0,
+                        help="saturation: p99 notification lag, seconds")
+    parser.add_argument("--max-rpc-latency", type=float, default=0.5,
+                        help="saturation: p99 API latency, seconds")
+    parser.add_argument("--output", help="JSON results file")
+    args = parser.parse_args(argv)
+    try:
+        rpc_mix = parse_rpc_mix(args.rpc_mix)
+    except ValueError as value_err:
+        parser.error(str(value_err))
+    generator = LoadGenerator(
+        rate=args.rate,
+        cpu_cost=args.cpu_ms / 1000.0,
+        rpc_mix=rpc_mix,
+        duration=args.duration,
+        max_lag=args.max_lag,
+        max_rpc_latency=args.max_rpc_latency,
+        backend_latency=args.backend_latency,
+    )
+    if args.find_saturation:
+        results = generator.find_saturation(
+            start=args.bots, max_bots=args.max_bots, on_stage=_print_stage)
+        sys.stderr.write("Saturation point: %s bots\n" % (
+            results["saturationBots"]))
+    else:
+        results = generator.run_stage(args.bots)
+        _print_stage(results)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
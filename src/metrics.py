@@ -0,0 +1,378 @@
+"""
+metrics.py
+Metrics of the Flow API requests, exportable in Prometheus text format.
+"""
+
+import bisect
+import os
+import threading
+
+# Atomic rename when available (Python 3.3+)
+_replace = getattr(os, "replace", os.rename)
+
+
+class RPCMetrics(object):
+    """Thread-safe per-method metrics of the API requests: amount of
+    calls, errors by exception class, latency histogram and request
+    and response bytes. Recording a request takes a lock and a bisect,
+    so it's cheap enough to be always on.
+    Usage:
+    flow.metrics.serve(9464)  # http://127.0.0.1:9464/metrics
+    flow.metrics.write_prometheus("/var/lib/prometheus/flow.prom")
+    """
+
+    # Upper bounds of the latency histogram buckets, in seconds
+    DEFAULT_BUCKETS = (
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+    )
+
+    class _Method(object):
+        """Internal class to hold the metrics of an API method."""
+
+        def __init__(self, buckets_count):
+            self.calls = 0
+            self.errors = {}  # Exception class name -> count
+            self.latency_sum = 0.0
+            # Count per bucket (not cumulative), the last one is +Inf
+            self.latency_counts = [0] * (buckets_count + 1)
+            self.request_bytes = 0
+            self.response_bytes = 0
+
+    def __init__(self, buckets=None, prefix="flow_rpc"):
+        """Arguments:
+        buckets : list of floats, upper bounds of the latency histogram
+        buckets (seconds), defaults to DEFAULT_BUCKETS.
+        prefix : string, prefix of the exported metric names.
+        """
+        self.buckets = tuple(sorted(buckets or self.DEFAULT_BUCKETS))
+        self.prefix = prefix
+        self._methods = {}  # Method name -> _Method
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def add_collector(self, collector):
+        """Adds a function that returns more metrics to export, as a list
+        of (name, type, description, labels dict, value) tuples.
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def remove_collector(self, collector):
+        """Removes a collector added with add_collector()."""
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def record(self, method, latency, request_bytes=0,
+               response_bytes=0, error=None):
+        """Records an API request.
+        Arguments:
+        method : string, API method name.
+        latency : float, seconds.
+        request_bytes, response_bytes : int, size of the bodies.
+        error : exception raised by the request, if any.
+        """
+        bucket = bisect.bisect_left(self.buckets, latency)
+        with self._lock:
+            method_metrics = self._methods.get(method)
+            if method_metrics is None:
+                method_metrics = self._Method(len(self.buckets))
+                self._methods[method] = method_metrics
+            method_metrics.calls += 1
+            method_metrics.latency_sum += latency
+            method_metrics.latency_counts[bucket] += 1
+            method_metrics.request_bytes += request_bytes
+            method_metrics.response_bytes += response_bytes
+            if error is not None:
+                name = type(error).__name__
+                method_metrics.errors[name] = \
+                    method_metrics.errors.get(name, 0) + 1
+
+    def reset(self):
+        """Drops all the recorded metrics."""
+        with self._lock:
+            self._methods = {}
+
+    def snapshot(self):
+        """Returns a dict that maps each API method name to a dict with
+        its 'calls', 'errors' (dict, exception class name -> count),
+        'latencySum' (seconds), 'latencyBuckets' (list of cumulative
+        (upper bound, count) tuples, the last bound is float("inf")),
+        'requestBytes' and 'responseBytes'.
+        """
+        bounds = self.buckets + (float("inf"),)
+        snapshot = {}
+        with self._lock:
+            for method, method_metrics in self._methods.items():
+                cumulative = 0
+                latency_buckets = []
+                for bound, count in zip(
+                        bounds, method_metrics.latency_counts):
+                    cumulative += count
+                    latency_buckets.append((bound, cumulative))
+                snapshot[method] = dict(
+                    calls=method_metrics.calls,
+                    errors=dict(method_metrics.errors),
+                    latencySum=method_metrics.latency_sum,
+                    latencyBuckets=latency_buckets,
+                    requestBytes=method_metrics.request_bytes,
+                    responseBytes=method_metrics.response_bytes,
+                )
+        return snapshot
+
+    def to_prometheus(self):
+        """Returns the metrics in Prometheus text exposition format."""
+        snapshot = sorted(self.snapshot().items())
+        prefix = self.prefix
+        lines = []
+
+        def header(name, metric_type, description):
+            """Adds the HELP and TYPE lines of a metric."""
+            lines.append("# HELP %s_%s %s" % (prefix, name, description))
+            lines.append("# TYPE %s_%s %s" % (prefix, name, metric_type))
+
+        header("calls_total", "counter", "API requests.")
+        for method, values in snapshot:
+            lines.append('%s_calls_total{method="%s"} %d' % (
+                prefix, method, values["calls"]))
+        header("errors_total", "counter",
+               "API requests that failed, by exception class.")
+        for method, values in snapshot:
+            for error, count in sorted(values["errors"].items()):
+                lines.append(
+                    '%s_errors_total{method="%s",error="%s"} %d' % (
+                        prefix, method, error, count))
+        header("latency_seconds", "histogram", "API request latency.")
+        for method, values in snapshot:
+            for bound, count in values["latencyBuckets"]:
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(
+                    '%s_latency_seconds_bucket{method="%s",le="%s"} %d' % (
+                        prefix, method, le, count))
+            lines.append('%s_latency_seconds_sum{method="%s"} %r' % (
+                prefix, method, values["latencySum"]))
+            lines.append('%s_latency_seconds_count{method="%s"} %d' % (
+                prefix, method, values["calls"]))
+        header("request_bytes_total", "counter", "API request bytes.")
+        for method, values in snapshot:
+            lines.append('%s_request_bytes_total{method="%s"} %d' % (
+                prefix, method, values["requestBytes"]))
+        header("response_bytes_total", "counter", "API response bytes.")
+        for method, values in snapshot:
+            lines.append('%s_response_bytes_total{method="%s"} %d' % (
+                prefix, method, values["responseBytes"]))
+        with self._lock:
+            collectors = list(self._collectors)
+        # Metric name -> (type, description, list of samples)
+        families = {}
+        for collector in collectors:
+            for name, metric_type, description, labels, value \
+                    in collector():
+                families.setdefault(
+                    name, (metric_type, description, []))[2].append(
+                    (labels, value))
+        for name, (metric_type, description, samples) in \
+                sorted(families.items()):
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            for labels, value in samples:
+                lines.append("%s{%s} %r" % (name, ",".join(
+                    '%s="%s"' % label for label in sorted(labels.items())
+                ), value))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Writes the metrics in Prometheus text format to 'path'
+        (e.g. for the node_exporter textfile collector).
+        The file is replaced atomically.
+        """
+        tmp_path = "%s.tmp" % path
+        with open(tmp_path, "w") as metrics_file:
+            metrics_file.write(self.to_prometheus())
+        _replace(tmp_path, path)
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serves the metrics in Prometheus text format over HTTP on a
+        daemon thread. Returns the HTTP server, call its shutdown()
+        method to stop serving.
+        """
+        # Imported here, they are only needed to serve the metrics
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+        except ImportError:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            """Serves the metrics on GET requests."""
+
+            def do_GET(self):
+                body = metrics.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header(
+                    "Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer((host, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+class NotificationStats(object):
+    """Thread-safe stats of the notification pipeline of a session:
+    WaitForNotification calls, received change batches, changes queued
+    for the callbacks and dropped (queue full), queued errors, dispatch
+    lag (from enqueue to callback) and callback duration.
+    Completions (on_complete() of the "process" callbacks, queued with
+    the changes) have their own counters, so that 'queued' changes are
+    'dispatched', 'dropped' or still in the queue.
+    """
+
+    # (snapshot key, metric name, type, description)
+    PROMETHEUS_METRICS = (
+        ("waitCalls", "wait_calls_total", "counter",
+         "WaitForNotification calls."),
+        ("waitErrors", "wait_errors_total", "counter",
+         "WaitForNotification calls that failed."),
+        ("batches", "batches_total", "counter",
+         "Change batches received."),
+        ("changes", "changes_total", "counter", "Changes received."),
+        ("maxBatchSize", "max_batch_size", "gauge",
+         "Largest change batch received."),
+        ("queued", "queued_total", "counter",
+         "Changes queued for the callbacks."),
+        ("dropped", "dropped_total", "counter",
+         "Changes dropped because the queue was full."),
+        ("errors", "errors_total", "counter",
+         "Notification errors queued."),
+        ("errorsDropped", "errors_dropped_total", "counter",
+         "Notification errors dropped because the queue was full."),
+        ("queueDepth", "queue_depth", "gauge",
+         "Changes waiting in the queue."),
+        ("dispatched", "dispatched_total", "counter",
+         "Changes dispatched to the callbacks."),
+        ("completions", "completions_total", "counter",
+         "Completions of process callbacks queued."),
+        ("completionsDropped", "completions_dropped_total", "counter",
+         "Completions dropped because the queue was full."),
+        ("completionsDispatched", "completions_dispatched_total", "counter",
+         "Completions of process callbacks executed."),
+        ("dispatchLagSum", "dispatch_lag_seconds_sum", "counter",
+         "Total seconds from enqueue to dispatch."),
+        ("dispatchLagMax", "dispatch_lag_seconds_max", "gauge",
+         "Max. seconds from enqueue to dispatch."),
+        ("lastDispatchLag", "last_dispatch_lag_seconds", "gauge",
+         "Seconds from enqueue to dispatch of the last change."),
+        ("callbackErrors", "callback_errors_total", "counter",
+         "Callbacks that raised an exception."),
+        ("callbackTimeSum", "callback_seconds_sum", "counter",
+         "Total seconds spent in the callbacks."),
+        ("callbackTimeMax", "callback_seconds_max", "gauge",
+         "Max. seconds spent in a callback."),
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = dict(
+            waitCalls=0,
+            waitErrors=0,
+            batches=0,
+            changes=0,
+            maxBatchSize=0,
+            queued=0,
+            dropped=0,
+            errors=0,
+            errorsDropped=0,
+            dispatched=0,
+            completions=0,
+            completionsDropped=0,
+            completionsDispatched=0,
+            dispatchLagSum=0.0,
+            dispatchLagMax=0.0,
+            lastDispatchLag=0.0,
+            callbackErrors=0,
+            callbackTimeSum=0.0,
+            callbackTimeMax=0.0,
+        )
+
+    def record_wait(self, batch_size=0, error=None):
+        """Records a WaitForNotification call and
+        the size of the change batch received.
+        """
+        with self._lock:
+            stats = self._stats
+            stats["waitCalls"] += 1
+            if error is not None:
+                stats["waitErrors"] += 1
+                return
+            stats["batches"] += 1
+            stats["changes"] += batch_size
+            stats["maxBatchSize"] = max(stats["maxBatchSize"], batch_size)
+
+    def record_queued(self, completion=False):
+        """Records a change (or a 'completion') queued for the callbacks.
+        """
+        with self._lock:
+            self._stats["completions" if completion else "queued"] += 1
+
+    def record_dropped(self, completion=False):
+        """Records a change (or a 'completion') dropped from
+        the queue to make room.
+        """
+        with self._lock:
+            self._stats[
+                "completionsDropped" if completion else "dropped"] += 1
+
+    def record_error(self, dropped=False):
+        """Records a queued notification error,
+        'dropped' if the oldest one was dropped to make room.
+        """
+        with self._lock:
+            self._stats["errors"] += 1
+            if dropped:
+                self._stats["errorsDropped"] += 1
+
+    def record_dispatch(self, lag, duration, error=None, completion=False):
+        """Records the execution of a callback (or a 'completion'): 'lag'
+        is the time since the change was queued, 'duration' the time
+        spent in the callback.
+        """
+        with self._lock:
+            stats = self._stats
+            stats["completionsDispatched" if completion else
+                  "dispatched"] += 1
+            stats["dispatchLagSum"] += lag
+            stats["dispatchLagMax"] = max(stats["dispatchLagMax"], lag)
+            stats["lastDispatchLag"] = lag
+            stats["callbackTimeSum"] += duration
+            stats["callbackTimeMax"] = max(stats["callbackTimeMax"], duration)
+            if error is not None:
+                stats["callbackErrors"] += 1
+
+    def snapshot(self, queue_depth=0):
+        """Returns a dict with the stats (see PROMETHEUS_METRICS),
+        'queueDepth' is set to 'queue_depth'.
+        """
+        with self._lock:
+            snapshot = dict(self._stats)
+        snapshot["queueDepth"] = queue_depth
+        return snapshot
+
+    @classmethod
+    def samples(cls, snapshot, labels, prefix="flow_notification"):
+        """Returns the samples of a snapshot in the format of the
+        RPCMetrics collectors, with 'labels' (dict) added.
+        """
+        return [
+            ("%s_%s" % (prefix, name), metric_type, description,
+             labels, snapshot[key])
+            for key, name, metric_type, description in cls.PROMETHEUS_METRICS
+        ]
@@ -0,0 +1,355 @@
+"""
+models.py
+Compact records for the main entities of the API responses (see
+Flow.set_response_models()).
+Records use __slots__ instead of a per-instance dict, and intern their
+ids, so that caching many messages or members takes less memory. They
+support the read/write dict-style access of the plain dicts, and keep
+the keys that are not fields in an extra dict.
+Records are mappings (isinstance(record, Mapping) is True) but not
+dicts, use to_dict() or json_default() to encode them as JSON:
+json.dumps(flow.enumerate_messages(oid, cid), default=json_default)
+"""
+
+try:
+    from sys import intern as _intern
+except ImportError:
+    from __builtin__ import intern as _intern  # Python 2
+
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping  # Python 2
+
+
+def intern_id(value):
+    """Returns the interned version of an id string."""
+    if not isinstance(value, str):
+        try:
+            # unicode on Python 2, ids are ASCII
+            value = str(value)
+        except (UnicodeError, TypeError):
+            return value
+    return _intern(value)
+
+
+class Record(object):
+    """Base class of the records. Subclasses list the keys of their
+    entity in __slots__ (JSON keys are the slot names) and the ids to
+    intern in ID_FIELDS.
+    """
+
+    __slots__ = ("_extra",)
+
+    ID_FIELDS = ()
+
+    def __init__(self, data=None, **fields):
+        """Arguments:
+        data : dict, decoded JSON of the entity.
+        fields : more keys and values of the entity.
+        """
+        self._extra = None
+        if data:
+            self.update(data)
+        if fields:
+            self.update(fields)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Returns the record of a decoded JSON dict."""
+        return cls(data)
+
+    def update(self, data=None, **fields):
+        """Sets the keys and values of the dict 'data'
+        and of the keyword arguments.
+        """
+        for key, value in (data or {}).items():
+            self[key] = value
+        for key, value in fields.items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        if key in self.__slots__:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.__slots__ and key != "_extra":
+            if key in self.ID_FIELDS and value is not None:
+                value = intern_id(value)
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.__slots__ and key != "_extra":
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    _MISSING = object()
+
+    def pop(self, key, default=_MISSING):
+        try:
+            value = self[key]
+        except KeyError:
+            if default is self._MISSING:
+                raise
+            return default
+        del self[key]
+        return value
+
+    def setdefault(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def keys(self):
+        keys = [key for key in self.__slots__
+                if key != "_extra" and hasattr(self, key)]
+        if self._extra:
+            keys.extend(self._extra)
+        return keys
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def to_dict(self):
+        """Returns the entity as a plain dict, e.g. to encode it
+        as JSON.
+        """
+        return dict(self.items())
+
+    copy = to_dict
+
+    def __eq__(self, other):
+        if isinstance(other, Mapping):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self._extra = None
+        self.update(state)
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.to_dict())
+
+
+# Records support the Mapping API, without its __dict__ (the ABCs
+# have no __slots__ on Python 2)
+MutableMapping.register(Record)
+
+
+def json_default(value):
+    """'default' function of json.dumps() that encodes the records
+    as plain dicts (RecordLists are lists already).
+    """
+    if isinstance(value, Record):
+        return value.to_dict()
+    raise TypeError(
+        "Object of type %s is not JSON serializable" % type(value).__name__)
+
+
+class Org(Record):
+    """'Org' dict."""
+    __slots__ = ("id", "name", "discoverable", "creatorAccountId")
+    ID_FIELDS = ("id", "creatorAccountId")
+
+
+class Channel(Record):
+    """'Channel' dict."""
+    __slots__ = ("id", "orgId", "name", "creatorAccountId")
+    ID_FIELDS = ("id", "orgId", "creatorAccountId")
+
+
+class Message(Record):
+    """'Message' dict."""
+    __slots__ = (
+        "id",
+        "orgId",
+        "channelId",
+        "senderAccountId",
+        "text",
+        "otherData",
+        "attachments",
+        "creationTime",
+    )
+    ID_FIELDS = ("id", "orgId", "channelId", "senderAccountId")
+
+
+class Peer(Record):
+    """'Peer' dict."""
+    __slots__ = ("accountId", "username")
+    ID_FIELDS = ("accountId",)
+
+
+class Member(Record):
+    """'OrgMember' and 'ChannelMember' dicts."""
+    __slots__ = ("accountId", "state", "orgId", "channelId")
+    ID_FIELDS = ("accountId", "orgId", "channelId")
+
+
+class RecordList(list):
+    """List of decoded JSON dicts that are converted to records
+    (of class 'model') when they are first accessed. Every access
+    (indexing, iteration, slicing, pop(), copy()...) returns records.
+    """
+
+    __slots__ = ("model",)
+
+    def __init__(self, items=(), model=Record):
+        list.__init__(self, items)
+        self.model = model
+
+    def _wrap(self, item):
+        if type(item) is dict:
+            return self.model.from_dict(item)
+        return item
+
+    def _items(self):
+        """Returns the items as a plain list, without converting them."""
+        return list.__getitem__(self, slice(None))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return RecordList(list.__getitem__(self, index), self.model)
+        item = list.__getitem__(self, index)
+        if type(item) is dict:
+            item = self.model.from_dict(item)
+            list.__setitem__(self, index, item)
+        return item
+
+    def __getslice__(self, start, stop):
+        # Python 2 slicing
+        return self[max(start, 0):max(stop, 0)]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __reversed__(self):
+        for index in range(len(self) - 1, -1, -1):
+            yield self[index]
+
+    def pop(self, index=-1):
+        return self._wrap(list.pop(self, index))
+
+    def copy(self):
+        return RecordList(self._items(), self.model)
+
+    __copy__ = copy
+
+    def __add__(self, other):
+        return RecordList(self._items() + list(other), self.model)
+
+    def __mul__(self, count):
+        return RecordList(self._items() * count, self.model)
+
+    __rmul__ = __mul__
+
+    def to_list(self):
+        """Returns the entities as a list of plain dicts."""
+        return [
+            item.to_dict() if isinstance(item, Record) else item
+            for item in self._items()
+        ]
+
+    def __reduce__(self):
+        return (RecordList, (self._items(), self.model))
+
+
+# API method -> record class of its result
+RESPONSE_MODELS = {
+    "NewOrg": Org,
+    "EnumerateOrgs": Org,
+    "GetChannel": Channel,
+    "EnumerateChannels": Channel,
+    "EnumerateMessages": Message,
+    "GetPeer": Peer,
+    "GetPeerFromID": Peer,
+    "EnumeratePeerAccounts": Peer,
+    "EnumerateOrgMembers": Member,
+    "EnumerateChannelMembers": Member,
+}
+
+# Notification type -> record class of the lists in its data
+NOTIFICATION_MODELS = {
+    "message": Message,
+}
+
+
+def wrap(model, value):
+    """Returns 'value' (a decoded JSON dict or list of dicts) as records
+    of class 'model', lists are converted lazily.
+    """
+    if isinstance(value, dict):
+        return model.from_dict(value)
+    if isinstance(value, list):
+        return RecordList(value, model)
+    return value
+
+
+def wrap_response(method, result):
+    """Returns the result of an API method as records,
+    if the method has a model.
+    """
+    model = RESPONSE_MODELS.get(method)
+    return result if model is None else wrap(model, result)
+
+
+def wrap_notification(notif_type, data):
+    """Returns the data of a notification with its lists of entities
+    as records, if the notification type has a model.
+    """
+    model = NOTIFICATION_MODELS.get(notif_type)
+    if model is None or not isinstance(data, dict):
+        return data
+    return dict(
+        (key, RecordList(value, model) if isinstance(value, list) else value)
+        for key, value in data.items()
+    )
@@ -0,0 +1,296 @@
+"""
+pool.py
+Pool of flowappglue backends.
+"""
+
+import os
+import bisect
+import hashlib
+import inspect
+import functools
+import threading
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+from . import definitions
+from .flow import Flow, LOG
+
+
+class _HashRing(object):
+    """Consistent hashing ring of backend indexes."""
+
+    def __init__(self, size, replicas):
+        """Arguments:
+        size : int, number of backends.
+        replicas : int, number of points of each backend on the ring.
+        """
+        points = sorted(
+            (self._hash("%d-%d" % (index, replica)), index)
+            for index in range(size)
+            for replica in range(replicas)
+        )
+        self._hashes = [point_hash for point_hash, _ in points]
+        self._indexes = [index for _, index in points]
+
+    @staticmethod
+    def _hash(key):
+        """Returns the position of 'key' on the ring."""
+        return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+    def get(self, key):
+        """Returns the backend index for 'key'."""
+        position = bisect.bisect(self._hashes, self._hash(key))
+        return self._indexes[position % len(self._indexes)]
+
+
+class AccountClient(object):
+    """Routes the Flow API calls of an account to the backend
+    and session where the account was placed by a FlowPool.
+    Every Flow method that has a 'sid' argument is available
+    with the session already bound, e.g.:
+    account = pool.start_up("bot1")
+    account.send_message(oid, cid, "hi")
+    """
+
+    def __init__(self, flow, sid, username):
+        """Arguments:
+        flow : Flow instance of the backend.
+        sid : int, SessionID of the account.
+        username : string.
+        """
+        self.flow = flow
+        self.sid = sid
+        self.username = username
+
+    def __getattr__(self, name):
+        attr = getattr(self.flow, name)
+        if not callable(attr) or not _has_sid_argument(attr):
+            return attr
+        bound = functools.partial(attr, sid=self.sid)
+        # Cache it, __getattr__ is not called for existing attributes
+        setattr(self, name, bound)
+        return bound
+
+    def __repr__(self):
+        return "<AccountClient username=%r sid=%r>" % (
+            self.username, self.sid)
+
+
+def _has_sid_argument(func):
+    """Returns whether 'func' has a 'sid' argument."""
+    try:
+        return "sid" in inspect.signature(func).parameters
+    except AttributeError:
+        # Python 2
+        return "sid" in inspect.getargspec(func).args
+
+
+class FlowPool(object):
+    """Pool of Flow instances, each one with its own flowappglue
+    backend, so that the accounts of an application are spread
+    over many backend processes (and cores).
+    Accounts are placed on the backends by consistent hashing of the
+    username, each one on its own session. Notification callbacks
+    registered on the pool are executed for all the accounts from
+    a single dispatch loop, process_notifications().
+    Usage:
+    pool = FlowPool(4)
+    for username in usernames:
+        pool.start_up(username)
+
+    @pool.callback(Flow.MESSAGE_NOTIFICATION)
+    def on_message(account, notif_type, data):
+        ...
+    pool.process_notifications()
+    """
+
+    _MAX_QUEUE_SIZE = 1024
+
+    # Class of the objects returned for the started accounts
+    _account_class = AccountClient
+
+    def __init__(self, size, db_dir=None, attachment_dir=None,
+                 replicas=64, **flow_args):
+        """Starts 'size' backends concurrently.
+        Arguments:
+        size : int, number of backends.
+        db_dir : string, base directory, backend N uses the
+        'backend-N' sub-directory.
+        attachment_dir : string, base attachment directory, backend N
+        uses the 'backend-N' sub-directory.
+        replicas : int, number of points of each backend on the
+        consistent hashing ring.
+        flow_args : kwargs, other Flow() arguments.
+        """
+        db_dir = db_dir or definitions.get_default_db_path()
+        attachment_dir = attachment_dir or \
+            definitions.get_default_attachment_path()
+        self._ring = _HashRing(size, replicas)
+        self._lock = threading.Lock()
+        self._accounts = {}  # Username -> AccountClient
+        self._free_sessions = {}  # Backend index -> unused SessionID
+        self._callbacks = {}  # Notification Name -> Function Object
+        self.notification_queue = Queue.Queue()
+        self._loop_process_notifications = False
+        calls = []
+        for index in range(size):
+            backend_db_dir = os.path.join(db_dir, "backend-%d" % index)
+            Flow._check_file_exists(backend_db_dir, True)
+            backend_args = dict(flow_args)
+            backend_args.update(
+                db_dir=backend_db_dir,
+                attachment_dir=os.path.join(
+                    attachment_dir, "backend-%d" % index),
+            )
+            calls.append((Flow, (), backend_args))
+        self.flows = []
+        exception = None
+        for flow, flow_err in Flow._call_concurrently(calls, size):
+            if flow_err is not None:
+                exception = flow_err
+            else:
+                self.flows.append(flow)
+        if exception is not None:
+            self.terminate()
+            raise exception
+        for index, flow in enumerate(self.flows):
+            self._free_sessions[index] = flow.get_current_session()
+
+    def backend_for(self, username):
+        """Returns the Flow instance where 'username' is placed."""
+        return self.flows[self._ring.get(username)]
+
+    def account(self, username):
+        """Returns the AccountClient of an account that was started
+        with start_up(), create_account() or create_device().
+        """
+        return self._accounts[username]
+
+    def accounts(self):
+        """Returns the list of AccountClient of the pool."""
+        with self._lock:
+            return list(self._accounts.values())
+
+    def start_up(self, username, timeout=None):
+        """Starts an account already configured in its backend
+        (see Flow.start_up()). Returns its AccountClient.
+        """
+        return self._start("start_up", username, timeout=timeout)
+
+    def create_account(self, username, password, **kwargs):
+        """Creates an account on its backend (see Flow.create_account()).
+        Returns its AccountClient.
+        """
+        return self._start("create_account", username, password, **kwargs)
+
+    def create_device(self, username, password, **kwargs):
+        """Creates a device for an account on its backend
+        (see Flow.create_device()). Returns its AccountClient.
+        """
+        return self._start("create_device", username, password, **kwargs)
+
+    def _start(self, method, username, *args, **kwargs):
+        """Places the account on a backend session and
+        executes the 'method' that starts it.
+        """
+        with self._lock:
+            if username in self._accounts:
+                raise Flow.FlowError(
+                    "Account '%s' already started." % username)
+            index = self._ring.get(username)
+            flow = self.flows[index]
+            sid = self._free_sessions.pop(index, None)
+        if sid is None:
+            sid = flow.new_session()
+        try:
+            getattr(flow, method)(username, *args, sid=sid, **kwargs)
+        except Exception:
+            with self._lock:
+                self._free_sessions.setdefault(index, sid)
+            raise
+        account = self._account_class(flow, sid, username)
+        with self._lock:
+            self._accounts[username] = account
+            callbacks = list(self._callbacks)
+        for notification_name in callbacks:
+            self._add_listener(account, notification_name)
+        return account
+
+    def _add_listener(self, account, notification_name):
+        """Forwards the notifications of an account to the pool queue."""
+        def listener(notif_type, data):
+            """Queues the notification on the pool queue."""
+            # This check should leave the queue with
+            # an approximate size of _MAX_QUEUE_SIZE
+            if self.notification_queue.qsize() > self._MAX_QUEUE_SIZE:
+                _, ignored_type, _ = self.notification_queue.get()
+                LOG.warn(
+                    "Pool notification queue is full: "
+                    "ignoring notification '%s'", ignored_type)
+            self.notification_queue.put((account, notif_type, data))
+        account.flow.add_notification_listener(
+            notification_name, listener, sid=account.sid)
+
+    def register_callback(self, notification_name, callback):
+        """Registers a callback for a notification type on all the
+        accounts of the pool (current and future ones).
+        The callback receives the AccountClient of the account that
+        got the notification, the notification type and its data.
+        """
+        with self._lock:
+            first_registration = notification_name not in self._callbacks
+            self._callbacks[notification_name] = callback
+            accounts = list(self._accounts.values())
+        if first_registration:
+            for account in accounts:
+                self._add_listener(account, notification_name)
+
+    def callback(self, notification_name):
+        """Decorator version of register_callback()."""
+        def decorator(func):
+            """Registers 'func' as callback."""
+            self.register_callback(notification_name, func)
+            return func
+        return decorator
+
+    def process_one_notification(self, timeout_secs=0.05):
+        """Processes a single notification of any account of the pool.
+        Returns 'True' if a notification was processed, 'False'
+        meaning no notification was available for processing.
+        """
+        try:
+            account, notif_type, data = self.notification_queue.get(
+                block=True, timeout=timeout_secs)
+        except Queue.Empty:
+            return False
+        with self._lock:
+            callback = self._callbacks.get(notif_type)
+        if callback is not None:
+            try:
+                callback(account, notif_type, data)
+            except Exception as exception:
+                LOG.debug("Error: %s", str(exception))
+        return True
+
+    def set_processing_notifications(self, value=True):
+        """Sets whether to continue processing the notifications
+        (see Flow.set_processing_notifications()).
+        """
+        self._loop_process_notifications = value
+
+    def process_notifications(self, timeout_secs=0.05):
+        """Loop to process the notifications of all the accounts."""
+        self._loop_process_notifications = True
+        while self._loop_process_notifications:
+            self.process_one_notification(timeout_secs)
+
+    def terminate(self, timeout_secs=5):
+        """Shuts down all the backends of the pool."""
+        calls = [(flow.terminate, (timeout_secs,), {})
+                 for flow in self.flows]
+        for _, exception in Flow._call_concurrently(calls, len(calls)):
+            if exception is not None:
+                LOG.warn("Error terminating backend: %s", exception)
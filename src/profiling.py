@@ -0,0 +1,245 @@
+"""
+profiling.py
+Slow-callback profiler and watchdog.
+"""
+
+import collections
+import cProfile
+import heapq
+import itertools
+import pstats
+import sys
+import threading
+import time
+import traceback
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from .flow import LOG
+
+# Monotonic clock when available (Python 3.3+)
+_clock = getattr(time, "monotonic", time.time)
+
+
+def _callback_name(callback):
+    """Returns a readable name of a callback function."""
+    name = getattr(callback, "__qualname__", None) or \
+        getattr(callback, "__name__", None) or repr(callback)
+    module = getattr(callback, "__module__", None)
+    return "%s.%s" % (module, name) if module else name
+
+
+class CallbackProfiler(object):
+    """Times the notification callbacks of a Flow object (through its
+    hooks, see Flow.add_hook()) and keeps the top-K slowest callbacks per
+    notification type.
+    A watchdog thread samples the stack of the callbacks that run for
+    more than 'threshold' seconds, while they are still running. After a
+    slow callback, the next 'profile_next' callbacks are run under
+    cProfile.
+    Usage:
+    profiler = CallbackProfiler(flow, threshold=0.5, profile_next=5)
+    profiler.start()
+    ...
+    profiler.slowest(Flow.MESSAGE_NOTIFICATION)
+    """
+
+    DEFAULT_TOP_K = 10
+
+    # Max. cProfile reports kept
+    _MAX_PROFILES = 32
+
+    def __init__(self, flow, threshold=1.0, profile_next=0, top_k=None,
+                 watchdog_interval=None):
+        """Arguments:
+        flow : Flow instance.
+        threshold : float, seconds after which a callback is slow.
+        profile_next : int, amount of callbacks profiled with cProfile
+        after a slow one.
+        top_k : int, slowest callbacks kept per notification type,
+        defaults to DEFAULT_TOP_K.
+        watchdog_interval : float, seconds between watchdog checks,
+        defaults to half the threshold.
+        """
+        self.flow = flow
+        self.threshold = threshold
+        self.profile_next = profile_next
+        self.top_k = top_k or self.DEFAULT_TOP_K
+        self.watchdog_interval = watchdog_interval or threshold / 2.0
+        self._lock = threading.Lock()
+        # Thread ident -> dict of the running callback
+        self._running = {}
+        # Notification type -> min-heap of (duration, seq, record)
+        self._slowest = {}
+        # Notification type -> dict(calls, totalTime, maxTime, slow)
+        self._totals = {}
+        self._profiles = collections.deque(maxlen=self._MAX_PROFILES)
+        self._profile_remaining = 0
+        self._seq = itertools.count()
+        self._stop = threading.Event()
+        self._watchdog = None
+
+    def start(self):
+        """Starts timing the callbacks and the watchdog thread."""
+        self._stop.clear()
+        self.flow.add_hook("on_callback", self._on_callback)
+        self.flow.add_hook("after_callback", self._after_callback)
+        self._watchdog = threading.Thread(target=self._watchdog_loop)
+        self._watchdog.daemon = True
+        self._watchdog.start()
+
+    def stop(self):
+        """Stops timing the callbacks."""
+        self.flow.remove_hook("on_callback", self._on_callback)
+        self.flow.remove_hook("after_callback", self._after_callback)
+        self._stop.set()
+        if self._watchdog is not None:
+            self._watchdog.join()
+            self._watchdog = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _on_callback(self, sid, change):
+        if "callback" in change:
+            callback = change["callback"]
+        else:
+            session = self.flow.sessions.get(sid)
+            callback = session.callbacks.get(change["type"]) \
+                if session is not None else None
+        running = dict(
+            type=change["type"],
+            callback=_callback_name(callback),
+            sid=sid,
+            start=time.time(),
+            started=_clock(),
+            stack=None,
+            profile=None,
+        )
+        with self._lock:
+            if self._profile_remaining > 0:
+                self._profile_remaining -= 1
+                running["profile"] = cProfile.Profile()
+            self._running[threading.current_thread().ident] = running
+        if running["profile"] is not None:
+            running["profile"].enable()
+
+    def _after_callback(self, sid, change, duration, error):
+        with self._lock:
+            running = self._running.pop(
+                threading.current_thread().ident, None)
+        if running is None:
+            return
+        profile = running["profile"]
+        if profile is not None:
+            profile.disable()
+            self._add_profile(running, duration, profile)
+        # The watchdog may still be reading 'running', keep a copy
+        running = dict(
+            (key, value) for key, value in running.items()
+            if key not in ("started", "profile"))
+        running["duration"] = duration
+        running["error"] = None if error is None else \
+            "%s: %s" % (type(error).__name__, error)
+        slow = duration >= self.threshold
+        with self._lock:
+            totals = self._totals.setdefault(running["type"], dict(
+                calls=0, totalTime=0.0, maxTime=0.0, slow=0))
+            totals["calls"] += 1
+            totals["totalTime"] += duration
+            totals["maxTime"] = max(totals["maxTime"], duration)
+            heap = self._slowest.setdefault(running["type"], [])
+            item = (duration, next(self._seq), running)
+            if len(heap) < self.top_k:
+                heapq.heappush(heap, item)
+            elif duration > heap[0][0]:
+                heapq.heapreplace(heap, item)
+            if slow:
+                totals["slow"] += 1
+                if self.profile_next and not self._profile_remaining:
+                    self._profile_remaining = self.profile_next
+        if slow:
+            LOG.warn("Slow callback %s for '%s': %.3fs",
+                     running["callback"], running["type"], duration)
+
+    def _add_profile(self, running, duration, profile):
+        """Keeps the report of a profiled callback."""
+        report = StringIO()
+        stats = pstats.Stats(profile, stream=report)
+        stats.sort_stats("cumulative").print_stats(25)
+        with self._lock:
+            self._profiles.append(dict(
+                type=running["type"],
+                callback=running["callback"],
+                start=running["start"],
+                duration=duration,
+                report=report.getvalue(),
+            ))
+
+    def _watchdog_loop(self):
+        """Samples the stack of the callbacks running for
+        longer than the threshold.
+        """
+        while not self._stop.wait(self.watchdog_interval):
+            now = _clock()
+            frames = None
+            with self._lock:
+                running = list(self._running.items())
+            for ident, callback in running:
+                if callback["stack"] is not None or \
+                        now - callback["started"] < self.threshold:
+                    continue
+                if frames is None:
+                    frames = sys._current_frames()
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                callback["stack"] = "".join(traceback.format_stack(frame))
+                LOG.warn(
+                    "Callback %s for '%s' running for %.3fs:\n%s",
+                    callback["callback"], callback["type"],
+                    now - callback["started"], callback["stack"])
+
+    def slowest(self, notif_type=None):
+        """Returns the slowest callbacks, slowest first, as a list of
+        dicts with 'type', 'callback' (name), 'sid', 'start' (epoch
+        seconds), 'duration' (seconds), 'error' and 'stack' (sampled by
+        the watchdog if the callback ran for longer than the threshold).
+        If 'notif_type' is empty, then returns a dict that maps each
+        notification type to its slowest callbacks.
+        """
+        with self._lock:
+            if notif_type:
+                return [record for _, _, record in sorted(
+                    self._slowest.get(notif_type, []), reverse=True)]
+            return dict(
+                (name, [record for _, _, record in sorted(
+                    heap, reverse=True)])
+                for name, heap in self._slowest.items()
+            )
+
+    def stats(self):
+        """Returns a dict that maps each notification type to a dict
+        with the amount of 'calls', 'totalTime', 'maxTime' and the
+        amount of 'slow' callbacks.
+        """
+        with self._lock:
+            return dict(
+                (name, dict(totals))
+                for name, totals in self._totals.items()
+            )
+
+    def profiles(self):
+        """Returns the cProfile reports of the profiled callbacks, as a
+        list of dicts with 'type', 'callback', 'start', 'duration'
+        and 'report' (pstats text, sorted by cumulative time).
+        """
+        with self._lock:
+            return list(self._profiles)
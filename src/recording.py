@@ -0,0 +1,355 @@
+"""
+recording.py
+Record the API traffic and notifications of a Flow object, and replay
+the recordings on the fake backend (flow.fakeglue) for load testing.
+Recordings are JSON lines (gzip compressed if the file name ends with
+'.gz'), with short keys to keep them compact:
+{"k": "h", "version": 1, "start": epoch seconds}  header
+{"k": "c", "t": offset, "m": method, "s": sid, "p": params,
+ "l": latency, "r": result or "e": error}  API call
+{"k": "n", "t": offset, "s": sid, "n": type, "d": data}  notification
+Offsets and latencies are in seconds, 's' is the backend SessionID.
+"""
+
+import gzip
+import json
+import threading
+import time
+
+from .flow import LOG
+
+# Monotonic clock when available (Python 3.3+)
+_clock = getattr(time, "monotonic", time.time)
+
+RECORDING_VERSION = 1
+
+
+def _open(path, mode):
+    """Opens a recording file, gzip compressed if it ends with '.gz'."""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "b")
+    return open(path, mode + "b")
+
+
+def read_recording(path):
+    """Returns the list of entries (dicts) of a recording file."""
+    entries = []
+    with _open(path, "r") as recording:
+        for line in recording:
+            line = line.decode("utf-8").strip()
+            if line:
+                entries.append(json.loads(line))
+    if not entries or entries[0].get("k") != "h":
+        raise ValueError("'%s' is not a recording." % path)
+    return entries
+
+
+class Recorder(object):
+    """Records the API calls (with their responses and latency) and the
+    notifications of Flow objects, through their hooks (see
+    Flow.add_hook()).
+    Secrets are redacted: values of the keys that contain one of the
+    'redacted_patterns' (in the params, results and notification data)
+    are replaced by REDACTED. With redact_text=True, message texts are
+    replaced by 'x' characters, keeping their length.
+    Usage:
+    recorder = Recorder("traffic.jsonl.gz")
+    recorder.install(flow)
+    ...
+    recorder.close()
+    """
+
+    REDACTED = "<redacted>"
+
+    # Matched case-insensitively anywhere in the keys, e.g. 'password'
+    # covers Password, NewPassword and LDAPPassword
+    DEFAULT_REDACTED_PATTERNS = (
+        "password",
+        "secret",
+        "token",
+        "dmk",
+        "totp",
+        "recoverykey",
+        "emailconfirmcode",
+    )
+
+    # Long polls, the notifications are recorded instead
+    DEFAULT_IGNORED_METHODS = ("WaitForNotification",)
+
+    def __init__(self, path, redacted_patterns=None, redact_text=False,
+                 record_results=True, ignored_methods=None):
+        """Arguments:
+        path : string, recording file, '.gz' for gzip compression.
+        redacted_patterns : list of strings, the values of the keys that
+        contain any of them (case-insensitively) are redacted, defaults
+        to DEFAULT_REDACTED_PATTERNS.
+        redact_text : bool, replace the text of the messages.
+        record_results : bool, record the result of the API calls,
+        replays return them.
+        ignored_methods : list of API method names that are not recorded,
+        defaults to DEFAULT_IGNORED_METHODS.
+        """
+        self.redacted_patterns = tuple(
+            pattern.lower() for pattern in (
+                self.DEFAULT_REDACTED_PATTERNS
+                if redacted_patterns is None else redacted_patterns))
+        self.redact_text = redact_text
+        self.record_results = record_results
+        self.ignored_methods = frozenset(
+            self.DEFAULT_IGNORED_METHODS
+            if ignored_methods is None else ignored_methods)
+        self._lock = threading.Lock()
+        self._file = _open(path, "w")
+        self._start = _clock()
+        self._write(dict(k="h", version=RECORDING_VERSION, start=time.time()))
+        self._hooks = (
+            ("after_response", self._after_response),
+            ("on_error", self._on_error),
+            ("on_notification", self._on_notification),
+        )
+        self._flows = []
+
+    def install(self, flow):
+        """Starts recording a Flow object."""
+        for name, hook in self._hooks:
+            flow.add_hook(name, hook)
+        self._flows.append(flow)
+
+    def uninstall(self, flow):
+        """Stops recording a Flow object."""
+        for name, hook in self._hooks:
+            flow.remove_hook(name, hook)
+        self._flows.remove(flow)
+
+    def close(self):
+        """Stops recording all the Flow objects and closes the file."""
+        for flow in list(self._flows):
+            self.uninstall(flow)
+        with self._lock:
+            self._file.close()
+
+    def _is_secret(self, key):
+        """Whether the value of 'key' must be redacted."""
+        key = key.lower()
+        return any(pattern in key for pattern in self.redacted_patterns)
+
+    def _redact(self, value):
+        """Returns a copy of 'value' with the secrets redacted."""
+        if isinstance(value, dict):
+            redacted = {}
+            for key, item in value.items():
+                if self._is_secret(key):
+                    redacted[key] = self.REDACTED
+                elif self.redact_text and key.lower() == "text" \
+                        and isinstance(item, type(u"")):
+                    redacted[key] = "x" * len(item)
+                else:
+                    redacted[key] = self._redact(item)
+            return redacted
+        if isinstance(value, list):
+            return [self._redact(item) for item in value]
+        return value
+
+    def _write(self, entry):
+        line = (json.dumps(entry, separators=(",", ":")) + "\n")
+        line = line.encode("utf-8")
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line)
+
+    def _record_call(self, method, params, latency, result=None,
+                     error=None):
+        if method in self.ignored_methods:
+            return
+        params = dict(params)
+        entry = dict(
+            k="c",
+            t=_clock() - latency - self._start,
+            m=method,
+            s=params.pop("SessionID", None),
+            p=self._redact(params),
+            l=latency,
+        )
+        if error is not None:
+            entry["e"] = str(error)
+        elif self.record_results:
+            entry["r"] = self._redact(result)
+        self._write(entry)
+
+    def _after_response(self, method, params, result, latency):
+        if isinstance(result, memoryview) and self.record_results:
+            # raw=True request, the result is the response body
+            result = json.loads(result.tobytes().decode("utf-8")).get(
+                "result")
+        self._record_call(method, params, latency, result=result)
+
+    def _on_error(self, method, params, error, latency):
+        self._record_call(method, params, latency, error=error)
+
+    def _on_notification(self, sid, change):
+        offset = _clock() - self._start
+        sid = self._backend_sid(sid)
+        self._write(dict(
+            k="n",
+            t=offset,
+            s=sid,
+            n=change.get("type"),
+            d=self._redact(change.get("data")),
+        ))
+
+    def _backend_sid(self, sid):
+        """Returns the backend SessionID of a session handle, so
+        that notifications and API calls use the same ids.
+        """
+        for flow in self._flows:
+            session = flow.sessions.get(sid)
+            if session is not None:
+                return session.backend_sid
+        return sid
+
+
+class Replayer(object):
+    """Replays a recording on a Flow object started on the fake
+    backend (flow.fakeglue), at 'speed' times the recorded rate.
+    The recorded API calls are sent at their recorded offsets, from a
+    pool of threads, and the backend returns the recorded responses
+    (see FakeBackend.rpc_FakeSetCannedResponses). The recorded
+    notifications are queued on the backend at their offsets, so they
+    go through the notification thread, the queue and the callbacks of
+    the Flow object as live traffic would.
+    Usage:
+    flow = Flow(flowappglue=fakeglue.get_path(), ...)
+    # register the callbacks
+    stats = Replayer("traffic.jsonl.gz", flow, speed=10).replay()
+    flow.get_notification_stats()
+    """
+
+    DEFAULT_WORKERS = 16
+
+    def __init__(self, path, flow, speed=1.0, sessions=None, workers=None):
+        """Arguments:
+        path : string, recording file.
+        flow : Flow instance, started on the fake backend.
+        speed : float, replay rate multiplier.
+        sessions : dict, recorded SessionID -> SessionID of 'flow',
+        the sessions not in it are replayed on the current session.
+        workers : int, max. API calls in flight,
+        defaults to DEFAULT_WORKERS.
+        """
+        self.flow = flow
+        self.speed = float(speed)
+        self.sessions = sessions or {}
+        self.workers = workers or self.DEFAULT_WORKERS
+        entries = read_recording(path)
+        # Control methods of the fake backend are not replayed
+        self.entries = sorted(
+            (entry for entry in entries[1:]
+             if entry["k"] == "n"
+             or (entry["k"] == "c" and not entry["m"].startswith("Fake"))),
+            key=lambda entry: entry["t"],
+        )
+        self.duration = self.entries[-1]["t"] if self.entries else 0.0
+        self._lock = threading.Lock()
+        self._call_errors = 0
+
+    def _session(self, recorded_sid):
+        return self.flow._get_session_id(self.sessions.get(recorded_sid, 0))
+
+    def _canned_responses(self):
+        """Returns the recorded responses, by method."""
+        responses = {}
+        for entry in self.entries:
+            if entry["k"] != "c":
+                continue
+            if "e" in entry:
+                response = dict(error=entry["e"])
+            else:
+                response = dict(result=entry.get("r"))
+            responses.setdefault(entry["m"], []).append(response)
+        return responses
+
+    def _call(self, entry):
+        """Sends a recorded API call."""
+        try:
+            self.flow._run(
+                method=entry["m"],
+                SessionID=self._session(entry["s"]),
+                **entry["p"]
+            )
+        except Exception as exception:
+            if "e" not in entry:
+                LOG.debug("Replay of '%s' failed: %s", entry["m"], exception)
+                with self._lock:
+                    self._call_errors += 1
+
+    def _notify(self, entries):
+        """Queues recorded notifications of a session on the backend."""
+        self.flow._run(
+            method="FakeNotify",
+            SessionID=self._session(entries[0]["s"]),
+            Changes=[
+                dict(type=entry["n"], data=entry["d"]) for entry in entries
+            ],
+        )
+
+    def replay(self, loops=1):
+        """Replays the recording 'loops' times, blocks until all the API
+        calls are done. Returns a dict with the amount of 'calls',
+        'callErrors' (errors that were not recorded), 'notifications',
+        the 'duration' of the replay and the 'lateness' (seconds) of the
+        entries w.r.t. their schedule, with its 'p50', 'p99' and 'max'
+        (lateness grows when the replay cannot keep up with 'speed').
+        """
+        # Imported here to keep 'import flow' fast
+        from concurrent import futures
+        responses = self._canned_responses()
+        self.flow._run(method="FakeSetCannedResponses", Responses=responses)
+        calls = notifications = 0
+        lateness = []
+        self._call_errors = 0
+        start = _clock()
+        try:
+            with futures.ThreadPoolExecutor(self.workers) as executor:
+                for loop in range(loops):
+                    batch = []
+                    for index, entry in enumerate(self.entries):
+                        due = start + (
+                            loop * self.duration + entry["t"]) / self.speed
+                        delay = due - _clock()
+                        if delay > 0:
+                            time.sleep(delay)
+                        lateness.append(max(0.0, -delay))
+                        if entry["k"] == "c":
+                            executor.submit(self._call, entry)
+                            calls += 1
+                            continue
+                        # Notifications of a session that are due are
+                        # sent together, as the backend batches them
+                        batch.append(entry)
+                        notifications += 1
+                        following = self.entries[index + 1] \
+                            if index + 1 < len(self.entries) else None
+                        if following is None or following["k"] != "n" \
+                           or following["s"] != entry["s"] \
+                           or start + (loop * self.duration + following[
+                               "t"]) / self.speed > _clock():
+                            self._notify(batch)
+                            batch = []
+        finally:
+            self.flow._run(
+                method="FakeSetCannedResponses",
+                Responses=dict((method, []) for method in responses),
+            )
+        lateness.sort()
+        return dict(
+            calls=calls,
+            callErrors=self._call_errors,
+            notifications=notifications,
+            duration=_clock() - start,
+            lateness=dict(
+                p50=lateness[len(lateness) // 2] if lateness else 0.0,
+                p99=lateness[int(0.99 * (len(lateness) - 1))]
+                if lateness else 0.0,
+                max=lateness[-1] if lateness else 0.0,
+            ),
+        )
@@ -0,0 +1,170 @@
+"""
+scheduler.py
+Client-side scheduler for the Flow API requests.
+"""
+
+import collections
+import threading
+import time
+
+from . import throttle
+
+# Monotonic clock when available (Python 3.3+)
+_clock = getattr(time, "monotonic", time.time)
+
+
+class Scheduler(object):
+    """Schedules API requests by priority class.
+    Each class has its own concurrency limit and optional token bucket
+    rate limit, and all classes share a total concurrency limit.
+    When requests of many classes are waiting for a free slot, the
+    classes are served in the order they were defined (by default:
+    interactive, bulk, background). Requests of the same class are
+    served first-come, first-served.
+    Usage:
+    flow.set_scheduler(Scheduler())
+    flow.enumerate_org_members(oid, priority=Scheduler.BULK)
+    """
+
+    # Default priority classes
+    INTERACTIVE = "interactive"
+    BULK = "bulk"
+    BACKGROUND = "background"
+
+    # Class name -> dict(max_concurrency=int, rate=float, burst=float)
+    DEFAULT_CLASSES = collections.OrderedDict([
+        (INTERACTIVE, dict(max_concurrency=None, rate=None, burst=None)),
+        (BULK, dict(max_concurrency=4, rate=None, burst=None)),
+        (BACKGROUND, dict(max_concurrency=1, rate=None, burst=None)),
+    ])
+
+    DEFAULT_MAX_CONCURRENCY = 8
+
+    class _Class(object):
+        """Internal class to hold the state of a priority class."""
+
+        def __init__(self, name, max_concurrency=None,
+                     rate=None, burst=None):
+            self.name = name
+            self.max_concurrency = max_concurrency
+            self.bucket = throttle.TokenBucket(rate, burst) \
+                if rate else None
+            self.waiting = collections.deque()  # Waiting request tickets
+            self.running = 0
+            self.calls = 0
+            self.wait_time = 0.0
+            self.max_wait_time = 0.0
+
+        def has_slot(self):
+            """Returns whether a request of this class can run now."""
+            if self.max_concurrency is not None \
+               and self.running >= self.max_concurrency:
+                return False
+            return self.bucket is None or self.bucket.wait_time() == 0
+
+    def __init__(self, classes=None, max_concurrency=None,
+                 default_class=None):
+        """Arguments:
+        classes : list of (name, options dict) tuples (or an ordered
+        dict), from highest to lowest priority. The options are
+        'max_concurrency' (int), 'rate' (requests per second) and
+        'burst'. Defaults to DEFAULT_CLASSES.
+        max_concurrency : int, total concurrency limit,
+        defaults to DEFAULT_MAX_CONCURRENCY.
+        default_class : string, class of the requests without a
+        (known) priority hint, defaults to the first class.
+        """
+        if classes is None:
+            classes = self.DEFAULT_CLASSES
+        if isinstance(classes, dict):
+            classes = list(classes.items())
+        self._classes = collections.OrderedDict(
+            (name, self._Class(name, **options))
+            for name, options in classes
+        )
+        self.max_concurrency = max_concurrency or \
+            self.DEFAULT_MAX_CONCURRENCY
+        self.default_class = default_class or list(self._classes)[0]
+        self._running = 0
+        self._cond = threading.Condition()
+
+    def _higher_class_ready(self, request_class):
+        """Returns whether a class with higher priority than
+        'request_class' has requests that could run now.
+        """
+        for priority_class in self._classes.values():
+            if priority_class is request_class:
+                return False
+            if priority_class.waiting and priority_class.has_slot():
+                return True
+        return False
+
+    def acquire(self, priority=None):
+        """Blocks until a request of class 'priority' can run.
+        Every acquire() must be followed by a release().
+        Returns the seconds the request waited in the queue.
+        """
+        request_class = self._get_class(priority)
+        ticket = object()
+        start = _clock()
+        with self._cond:
+            request_class.waiting.append(ticket)
+            while True:
+                wait = None
+                if request_class.waiting[0] is ticket \
+                   and self._running < self.max_concurrency \
+                   and not self._higher_class_ready(request_class):
+                    concurrency = request_class.max_concurrency
+                    if concurrency is None \
+                       or request_class.running < concurrency:
+                        bucket = request_class.bucket
+                        wait = bucket.try_acquire() if bucket else 0
+                        if wait == 0:
+                            break
+                self._cond.wait(wait)
+            request_class.waiting.popleft()
+            request_class.running += 1
+            self._running += 1
+            waited = _clock() - start
+            request_class.calls += 1
+            request_class.wait_time += waited
+            request_class.max_wait_time = max(
+                request_class.max_wait_time, waited)
+            self._cond.notify_all()
+        return waited
+
+    def release(self, priority=None):
+        """Releases the slot taken with acquire()."""
+        request_class = self._get_class(priority)
+        with self._cond:
+            request_class.running -= 1
+            self._running -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        """Returns a dict that maps each class name to a dict with the
+        amount of requests 'waiting' and 'running', the amount of
+        'calls' scheduled, and their total, average and max. queue wait
+        time in seconds ('waitTime', 'avgWaitTime', 'maxWaitTime').
+        """
+        with self._cond:
+            return dict(
+                (name, dict(
+                    waiting=len(priority_class.waiting),
+                    running=priority_class.running,
+                    calls=priority_class.calls,
+                    waitTime=priority_class.wait_time,
+                    avgWaitTime=(
+                        priority_class.wait_time / priority_class.calls
+                        if priority_class.calls else 0.0),
+                    maxWaitTime=priority_class.max_wait_time,
+                ))
+                for name, priority_class in self._classes.items()
+            )
+
+    def _get_class(self, priority):
+        """Returns the _Class for a priority hint,
+        unknown hints get the default class.
+        """
+        return self._classes.get(priority) or \
+            self._classes[self.default_class]
@@ -0,0 +1,69 @@
+"""
+throttle.py
+Rate limiting helpers.
+"""
+
+import threading
+import time
+
+# Monotonic clock when available (Python 3.3+)
+_clock = getattr(time, "monotonic", time.time)
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket rate limiter.
+    Tokens are added at 'rate' tokens per second,
+    up to 'capacity' tokens (the allowed burst).
+    """
+
+    def __init__(self, rate, capacity=None):
+        """Arguments:
+        rate : float, tokens added per second.
+        capacity : float, maximum amount of tokens,
+        if not provided it defaults to 'rate' (min. 1).
+        """
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self._tokens = self.capacity
+        self._last = _clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        """Adds the tokens generated since the last refill."""
+        now = _clock()
+        self._tokens = min(
+            self.capacity,
+            self._tokens + (now - self._last) * self.rate,
+        )
+        self._last = now
+
+    def wait_time(self, tokens=1):
+        """Returns the seconds to wait until 'tokens' are
+        available (0 if they are), without taking them.
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+    def try_acquire(self, tokens=1):
+        """Takes 'tokens' from the bucket if available.
+        Returns 0 if the tokens were taken, otherwise
+        returns the seconds to wait until they become available.
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        """Blocks until 'tokens' could be taken from the bucket."""
+        wait = self.try_acquire(tokens)
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.try_acquire(tokens)
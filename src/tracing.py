@@ -0,0 +1,142 @@
+"""
+tracing.py
+In-process tracing of the Flow API requests and notifications.
+"""
+
+import json
+import random
+import threading
+import time
+
+
+class Tracer(object):
+    """Records spans built from the Flow hooks (see Flow.add_hook())
+    and writes them, one JSON object per line, to a file.
+    A received notification is the root span of a trace, its callback is
+    a child span and the API requests made inside the callback are
+    children of the callback span. API requests made outside of a
+    callback are root spans.
+    Each span is a dict with 'traceId', 'spanId', 'parentId', 'kind'
+    ('notification', 'callback' or 'rpc'), 'name' (notification type or
+    API method), 'sid', 'start' (epoch seconds), 'duration' (seconds)
+    and 'error' (None or the exception class and message).
+    Usage:
+    tracer = Tracer("trace.jsonl")
+    tracer.install(flow)
+    ...
+    tracer.close()
+    """
+
+    # Long polls, they would only add noise
+    DEFAULT_IGNORED_METHODS = ("WaitForNotification",)
+
+    def __init__(self, path, ignored_methods=None):
+        """Arguments:
+        path : string, JSONL file, spans are appended to it.
+        ignored_methods : list of API method names that are not traced,
+        defaults to DEFAULT_IGNORED_METHODS.
+        """
+        self.ignored_methods = frozenset(
+            self.DEFAULT_IGNORED_METHODS
+            if ignored_methods is None else ignored_methods)
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+        # Per thread: current callback span and API request span
+        self._local = threading.local()
+        self._hooks = (
+            ("before_request", self._before_request),
+            ("after_response", self._after_response),
+            ("on_error", self._on_error),
+            ("on_notification", self._on_notification),
+            ("on_callback", self._on_callback),
+            ("after_callback", self._after_callback),
+        )
+        self._flows = []
+
+    def install(self, flow):
+        """Starts tracing a Flow object."""
+        for name, hook in self._hooks:
+            flow.add_hook(name, hook)
+        self._flows.append(flow)
+
+    def uninstall(self, flow):
+        """Stops tracing a Flow object."""
+        for name, hook in self._hooks:
+            flow.remove_hook(name, hook)
+        self._flows.remove(flow)
+
+    def close(self):
+        """Stops tracing all the Flow objects and closes the file."""
+        for flow in list(self._flows):
+            self.uninstall(flow)
+        with self._lock:
+            self._file.close()
+
+    @staticmethod
+    def _new_id():
+        """Returns a random 64-bit hex id."""
+        return "%016x" % random.getrandbits(64)
+
+    def _start(self, kind, name, sid, parent=None):
+        """Returns a new span, child of 'parent' if provided."""
+        return dict(
+            traceId=parent["traceId"] if parent else self._new_id(),
+            spanId=self._new_id(),
+            parentId=parent["spanId"] if parent else None,
+            kind=kind,
+            name=name,
+            sid=sid,
+            start=time.time(),
+            duration=0.0,
+            error=None,
+        )
+
+    def _write(self, span, duration=None, error=None):
+        """Finishes a span and writes it to the file."""
+        if duration is not None:
+            span["duration"] = duration
+        if error is not None:
+            span["error"] = "%s: %s" % (type(error).__name__, error)
+        line = json.dumps(span) + "\n"
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line)
+
+    def _before_request(self, method, params):
+        if method in self.ignored_methods:
+            return
+        self._local.request = self._start(
+            "rpc", method, params.get("SessionID"),
+            getattr(self._local, "callback", None))
+
+    def _end_request(self, method, latency, error=None):
+        """Writes the span of the API request of the current thread."""
+        span = getattr(self._local, "request", None)
+        if span is None or span["name"] != method:
+            return
+        self._local.request = None
+        self._write(span, latency, error)
+
+    def _after_response(self, method, params, result, latency):
+        self._end_request(method, latency)
+
+    def _on_error(self, method, params, error, latency):
+        self._end_request(method, latency, error)
+
+    def _on_notification(self, sid, change):
+        span = self._start("notification", change.get("type"), sid)
+        # Links the callback span to this one
+        change["traceSpan"] = dict(
+            traceId=span["traceId"], spanId=span["spanId"])
+        self._write(span)
+
+    def _on_callback(self, sid, change):
+        self._local.callback = self._start(
+            "callback", change.get("type"), sid, change.get("traceSpan"))
+
+    def _after_callback(self, sid, change, duration, error):
+        span = getattr(self._local, "callback", None)
+        if span is None:
+            return
+        self._local.callback = None
+        self._write(span, duration, error)
@@ -0,0 +1,235 @@
+"""
+workers.py
+Worker processes that share the notifications of an account.
+"""
+
+import collections
+import multiprocessing
+import signal
+import zlib
+
+from .flow import Flow, LOG
+from .pool import AccountClient
+
+
+def _channel_id(item):
+    """Returns the ChannelID of a notification item, if any."""
+    if isinstance(item, dict):
+        return item.get("channelId")
+    return None
+
+
+def _split_by_channel(data):
+    """Splits the data of a notification by ChannelID, keeping the order
+    of the items of each channel. Returns a list of (ChannelID, data)
+    tuples, ChannelID is None for data not related to a channel.
+    """
+    if isinstance(data, list):
+        groups = collections.OrderedDict()
+        for item in data:
+            groups.setdefault(_channel_id(item), []).append(item)
+        return list(groups.items())
+    if isinstance(data, dict) and _channel_id(data) is None:
+        # e.g. 'message' notifications, a dict of lists of messages
+        groups = collections.OrderedDict()
+        for key, value in data.items():
+            if not isinstance(value, list):
+                continue
+            for item in value:
+                cid = _channel_id(item)
+                if cid not in groups:
+                    groups[cid] = dict(
+                        (k, [] if isinstance(v, list) else v)
+                        for k, v in data.items()
+                    )
+                groups[cid][key].append(item)
+        if groups:
+            return list(groups.items())
+    return [(_channel_id(data), data)]
+
+
+def _worker_main(queue, callbacks, backend_port, backend_token,
+                 backend_sid, username):
+    """Worker process: executes the callbacks for the notifications
+    received on 'queue', until it gets None.
+    The API calls are sent to the session of the parent process on its
+    backend. Items with a None type carry the (port, token, SessionID)
+    of the backend after it was restarted (see Flow(auto_restart=True)).
+    """
+    # The parent stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    flow = Flow(backend_port=backend_port, backend_token=backend_token,
+                backend_sid=backend_sid)
+    sid = flow.get_current_session()
+    client = AccountClient(flow, sid, username)
+    try:
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            notif_type, data = item
+            if notif_type is None:
+                flow._port, flow._token, backend_sid = data
+                flow.sessions[sid].backend_sid = backend_sid
+                continue
+            try:
+                callbacks[notif_type](client, notif_type, data)
+            except Exception as exception:
+                LOG.debug("Error: %s", str(exception))
+    finally:
+        flow.terminate()
+
+
+def _default_start_method():
+    """Returns the start method of the workers, forking a process
+    that runs threads (those of the Flow object) is not safe.
+    """
+    if not hasattr(multiprocessing, "get_all_start_methods"):
+        return None  # Python 2
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return "forkserver"
+    return "spawn"
+
+
+class WorkerPool(object):
+    """Pool of worker processes that execute the callbacks of a session,
+    so that CPU-bound callbacks are not limited to one core.
+    The parent process keeps running the notification thread of the
+    session and fans the notifications out to the workers, partitioned
+    by ChannelID: all the notifications of a channel are handled, in
+    order, by the same worker. Notifications not related to a channel
+    are partitioned by type.
+    Callbacks receive an AccountClient (bound to the session, and
+    attached to the backend of the parent) instead of the Flow object.
+    They must be registered before start() and be module-level
+    functions: the workers are not forked from the parent, which runs
+    the threads of the Flow object, they are started with the
+    'forkserver' or 'spawn' multiprocessing start methods.
+    Usage:
+    workers = WorkerPool(flow, 4)
+
+    @workers.callback(Flow.MESSAGE_NOTIFICATION)
+    def on_message(account, notif_type, data):
+        ...
+    workers.start()
+    """
+
+    # Max. notifications queued per worker, when full the
+    # notification thread blocks until the worker catches up
+    _MAX_QUEUE_SIZE = 1024
+
+    def __init__(self, flow, workers=None, sid=0, start_method=None):
+        """Arguments:
+        flow : Flow instance that owns the session.
+        workers : int, number of worker processes,
+        defaults to the number of CPUs.
+        sid : int, SessionID (started account).
+        start_method : string, multiprocessing start method of the
+        workers, defaults to 'forkserver' where available, else 'spawn'
+        (Python 2 only supports the default, 'fork' on Unix).
+        """
+        self.flow = flow
+        self.sid = flow._get_session_id(sid)
+        self.workers = workers or multiprocessing.cpu_count()
+        self.start_method = start_method or _default_start_method()
+        # Backend generation the workers were given, see _forward()
+        self._generation = None
+        self._callbacks = {}  # Notification Name -> Function Object
+        self._queues = []
+        self._processes = []
+        self.forwarded = [0] * self.workers  # Notifications per worker
+
+    def register_callback(self, notification_name, callback):
+        """Registers a callback to be executed on the workers for
+        a notification type. The callback receives an AccountClient,
+        the notification type and its data.
+        """
+        if self._processes:
+            raise Flow.FlowError(
+                "Callbacks must be registered before start().")
+        self._callbacks[notification_name] = callback
+
+    def callback(self, notification_name):
+        """Decorator version of register_callback()."""
+        def decorator(func):
+            """Registers 'func' as callback."""
+            self.register_callback(notification_name, func)
+            return func
+        return decorator
+
+    def start(self):
+        """Starts the worker processes and the forwarding
+        of the notifications.
+        """
+        session = self.flow.sessions[self.sid]
+        context = multiprocessing.get_context(self.start_method) \
+            if hasattr(multiprocessing, "get_context") else multiprocessing
+        self._generation = self.flow._backend_generation
+        for _ in range(self.workers):
+            queue = context.Queue(self._MAX_QUEUE_SIZE)
+            process = context.Process(
+                target=_worker_main,
+                args=(
+                    queue,
+                    self._callbacks,
+                    self.flow._port,
+                    self.flow._token,
+                    session.backend_sid,
+                    session.username,
+                ),
+            )
+            process.daemon = True
+            process.start()
+            self._queues.append(queue)
+            self._processes.append(process)
+        for notification_name in self._callbacks:
+            self.flow.add_notification_listener(
+                notification_name, self._forward, sid=self.sid)
+
+    def _worker_index(self, key):
+        """Returns the worker for a partition key."""
+        key_hash = zlib.crc32(key.encode("utf-8")) & 0xffffffff
+        return key_hash % self.workers
+
+    def _forward(self, notif_type, data):
+        """Notification listener: sends the notification
+        (split by channel) to the workers.
+        """
+        generation = self.flow._backend_generation
+        if generation != self._generation:
+            # Restarted backend, with a new address and session
+            self._generation = generation
+            backend = (self.flow._port, self.flow._token,
+                       self.flow.sessions[self.sid].backend_sid)
+            for queue in self._queues:
+                queue.put((None, backend))
+        for cid, channel_data in _split_by_channel(data):
+            index = self._worker_index(cid or notif_type)
+            self._queues[index].put((notif_type, channel_data))
+            self.forwarded[index] += 1
+
+    def stop(self, timeout_secs=5):
+        """Stops forwarding notifications and stops the workers
+        once they handled the notifications already forwarded.
+        Workers still running after 'timeout_secs' are terminated.
+        """
+        for notification_name in self._callbacks:
+            self.flow.remove_notification_listener(
+                notification_name, self._forward, sid=self.sid)
+        for queue in self._queues:
+            queue.put(None)
+        for process in self._processes:
+            process.join(timeout_secs)
+            if process.is_alive():
+                LOG.warn("Worker %d did not stop, terminating it",
+                         process.pid)
+                process.terminate()
+        self._queues = []
+        self._processes = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
@@ -0,0 +1,58 @@
+"""
+conftest.py
+Fixtures of the tests, they run against the in-memory fake backend
+(flow.fakeglue). The flow module is imported from src/ if it's not
+installed (setup.py maps the package to that directory).
+"""
+
+import os
+import sys
+
+import pytest
+
+try:
+    import flow as _package  # noqa: F401
+except ImportError:
+    import importlib.util
+    _SRC = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), "src")
+    _spec = importlib.util.spec_from_file_location(
+        "flow", os.path.join(_SRC, "__init__.py"),
+        submodule_search_locations=[_SRC])
+    _package = importlib.util.module_from_spec(_spec)
+    sys.modules["flow"] = _package
+    _spec.loader.exec_module(_package)
+
+from flow import Flow, fakeglue  # noqa: E402
+
+
+def start_flow(directory, username="alice", **flow_args):
+    """Returns a Flow started on the fake backend,
+    with its files in 'directory'.
+    """
+    directory = str(directory)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return Flow(
+        username=username,
+        flowappglue=fakeglue.get_path(),
+        db_dir=directory,
+        schema_dir=directory,
+        attachment_dir=directory,
+        **flow_args
+    )
+
+
+@pytest.fixture
+def flow(tmpdir):
+    """Flow object of 'alice' on the fake backend."""
+    flow = start_flow(tmpdir.join("alice"))
+    yield flow
+    flow.terminate()
+
+
+@pytest.fixture
+def org(flow):
+    """(OrgID, ChannelID) of a new org and channel of 'alice'."""
+    oid = flow.new_org("org", False)["id"]
+    return oid, flow.new_channel(oid, "channel")
@@ -0,0 +1,174 @@
+"""
+test_attachments.py
+Tests of the attachment managers and index of flow.attachments.
+"""
+
+import os
+import threading
+
+import pytest
+
+from flow import Flow
+from flow.attachments import AttachmentIndex, DownloadManager, UploadManager
+
+
+def _write_files(tmpdir, count, prefix="file"):
+    paths = []
+    for index in range(count):
+        path = tmpdir.join("%s%d.txt" % (prefix, index))
+        path.write("contents %d" % index)
+        paths.append(str(path))
+    return paths
+
+
+def _notify(flow, changes):
+    """Queues notifications on the current session of the fake backend."""
+    flow._run(method="FakeNotify", SessionID=flow.get_current_session(),
+              Changes=changes)
+
+
+def _registered_only(flow, aid):
+    """Replaces new_attachment() with one that registers 'aid' without
+    uploading, its outcome is then injected with _notify().
+    """
+    def new_attachment(oid, file_path, **kwargs):
+        return dict(id=aid, filename=os.path.basename(file_path))
+    flow.new_attachment = new_attachment
+
+
+def test_upload_manager_resolves_on_upload_complete(flow, org, tmpdir):
+    oid, cid = org
+    paths = _write_files(tmpdir, 5)
+    with UploadManager(flow, max_workers=3) as manager:
+        uploads = manager.upload(oid, paths)
+        attachments = [upload.result(5) for upload in uploads]
+        stats = manager.stats()
+    assert [attachment["filename"] for attachment in attachments] == \
+        [os.path.basename(path) for path in paths]
+    assert len(set(attachment["id"] for attachment in attachments)) == 5
+    assert stats["inFlight"] == 0 and stats["failed"] == 0
+    assert stats["completed"] == 5
+    assert stats["bytes"] == sum(os.path.getsize(path) for path in paths)
+    mid = flow.send_message(oid, cid, "files", attachments=attachments)
+    assert mid
+
+
+def test_upload_manager_fails_on_upload_error(flow, org, tmpdir):
+    oid, _ = org
+    _registered_only(flow, "failing")
+    with UploadManager(flow) as manager:
+        upload = manager.submit(oid, _write_files(tmpdir, 1)[0])
+        _notify(flow, [dict(type=Flow.UPLOAD_ERROR_NOTIFICATION,
+                            data=dict(attachmentId="failing", error="boom"))])
+        with pytest.raises(Flow.FlowError) as error:
+            upload.result(5)
+        assert str(error.value) == "boom"
+        assert manager.stats()["failed"] == 1
+
+
+def test_upload_manager_fails_on_unknown_file(flow, org, tmpdir):
+    oid, _ = org
+    with UploadManager(flow) as manager:
+        upload = manager.submit(oid, str(tmpdir.join("missing.txt")))
+        with pytest.raises(Flow.FlowError):
+            upload.result(5)
+        assert manager.stats()["inFlight"] == 0
+
+
+def _message_with_attachments(flow, org, tmpdir, count):
+    oid, cid = org
+    paths = _write_files(tmpdir, count, prefix="upload")
+    with UploadManager(flow) as manager:
+        attachments = [upload.result(5)
+                       for upload in manager.upload(oid, paths)]
+    mid = flow.send_message(oid, cid, "files", attachments=attachments)
+    return mid, [attachment["id"] for attachment in attachments]
+
+
+def test_download_manager_limits_started_downloads(flow, org, tmpdir):
+    oid, cid = org
+    mid, aids = _message_with_attachments(flow, org, tmpdir, 3)
+    target_dir = tmpdir.mkdir("target")
+    release = threading.Event()
+    start_download = flow.start_attachment_download
+
+    def blocked_start_download(*args, **kwargs):
+        release.wait(5)
+        return start_download(*args, **kwargs)
+    flow.start_attachment_download = blocked_start_download
+    with DownloadManager(flow, max_in_flight=1,
+                         target_dir=str(target_dir)) as manager:
+        downloads = [manager.submit(aid, oid, cid, mid) for aid in aids]
+        assert manager.stats() == dict(
+            queued=2, inFlight=1, completed=0, failed=0)
+        # Already queued
+        assert manager.submit(aids[0], oid, cid, mid) is downloads[0]
+        release.set()
+        paths = [download.result(5) for download in downloads]
+        assert manager.stats() == dict(
+            queued=0, inFlight=0, completed=3, failed=0)
+    for aid, path in zip(aids, paths):
+        assert os.path.dirname(path) == str(target_dir)
+        assert flow.stored_attachment_path(oid, aid) == path
+    assert sorted(open(path).read() for path in paths) == \
+        ["contents 0", "contents 1", "contents 2"]
+
+
+def test_download_manager_fails_on_unknown_attachment(flow, org):
+    oid, cid = org
+    with DownloadManager(flow) as manager:
+        download = manager.submit("unknown", oid, cid, "mid")
+        with pytest.raises(Flow.FlowError):
+            download.result(5)
+        assert manager.stats()["failed"] == 1
+
+
+def test_attachment_index_skips_repeated_uploads(flow, org, tmpdir):
+    oid, _ = org
+    index_path = str(tmpdir.join("index.json"))
+    path, copy_path = _write_files(tmpdir, 1) + [str(tmpdir.join("copy"))]
+    with open(copy_path, "w") as copy_file:
+        copy_file.write(open(path).read())
+    index = AttachmentIndex(flow, index_path)
+    attachment = index.new_attachment(oid, path)
+    # Waits for the upload of the same contents to complete
+    copy = index.new_attachment(oid, copy_path, timeout=5)
+    index.close()
+    assert copy["id"] == attachment["id"] and copy["filename"] == "copy"
+    assert len(index) == 1
+
+    # Persisted entries are checked with the backend
+    index = AttachmentIndex(flow, index_path)
+    assert index.lookup(oid, path)["id"] == attachment["id"]
+    index.close()
+    with open(index_path) as index_file:
+        stale = index_file.read().replace(attachment["id"], "unknown")
+    with open(index_path, "w") as index_file:
+        index_file.write(stale)
+    index = AttachmentIndex(flow, index_path)
+    assert index.lookup(oid, path) is None
+    assert len(index) == 0
+    index.close()
+
+
+def test_attachment_index_drops_failed_uploads(flow, org, tmpdir):
+    oid, _ = org
+    path = _write_files(tmpdir, 1)[0]
+    _registered_only(flow, "failing")
+    index = AttachmentIndex(flow)
+    index.new_attachment(oid, path)
+    results = []
+
+    def wait_for_upload():
+        try:
+            results.append(index.new_attachment(oid, path, timeout=5))
+        except Flow.FlowError as flow_err:
+            results.append(flow_err)
+    waiter = threading.Thread(target=wait_for_upload)
+    waiter.start()
+    _notify(flow, [dict(type=Flow.UPLOAD_ERROR_NOTIFICATION,
+                        data=dict(attachmentId="failing", error="boom"))])
+    waiter.join(5)
+    index.close()
+    assert len(results) == 1 and isinstance(results[0], Flow.FlowError)
+    assert len(index) == 0
@@ -0,0 +1,116 @@
+"""
+test_bulk.py
+Tests of the bulk APIs: reconcile_membership() and broadcast().
+"""
+
+import time
+
+from flow import Flow
+
+
+def _new_account(flow, username):
+    """Creates an account on a new session of the backend of 'flow',
+    returns its AccountID.
+    """
+    sid = flow.new_session()
+    flow.create_account(username, "password", sid=sid)
+    return flow.account_id(sid=sid)
+
+
+def _states(members):
+    return dict((member["accountId"], member["state"]) for member in members)
+
+
+def test_reconcile_membership_runs_only_needed_operations(flow, org):
+    oid, cid = org
+    bob = _new_account(flow, "bob")
+    carol = _new_account(flow, "carol")
+    flow.org_add_member(oid, carol, "m")
+    desired = [
+        (oid, None, carol, "a"),  # state change
+        (oid, cid, bob, "m"),  # org and channel add
+    ]
+    report = flow.reconcile_membership(desired)
+    assert sorted(op["op"] for op in report["applied"]) == [
+        "channel_add_member", "org_add_member", "set_org_member_state"]
+    assert report["failed"] == [] and report["skipped"] == []
+    org_states = _states(flow.enumerate_org_members(oid))
+    assert org_states[bob] == "m" and org_states[carol] == "a"
+    assert _states(flow.enumerate_channel_members(cid))[bob] == "m"
+
+    # Already reconciled
+    report = flow.reconcile_membership(desired)
+    assert report["planned"] == [] and report["unchanged"] == 3
+
+
+def test_reconcile_membership_dry_run(flow, org):
+    oid, cid = org
+    bob = _new_account(flow, "bob")
+    report = flow.reconcile_membership([(oid, cid, bob, "m")], dry_run=True)
+    assert [op["op"] for op in report["planned"]] == [
+        "org_add_member", "channel_add_member"]
+    assert report["applied"] == []
+    assert bob not in _states(flow.enumerate_org_members(oid))
+
+
+def test_reconcile_membership_skips_channel_ops_of_failed_accounts(flow, org):
+    oid, cid = org
+    report = flow.reconcile_membership([(oid, cid, "unknown", "m")])
+    assert [op["op"] for op in report["failed"]] == ["org_add_member"]
+    assert "unknown" in report["failed"][0]["error"]
+    assert [op["op"] for op in report["skipped"]] == ["channel_add_member"]
+    assert report["applied"] == []
+
+
+def test_broadcast_sends_to_every_target(flow, org):
+    oid, cid = org
+    other_cid = flow.new_channel(oid, "other")
+    results = flow.broadcast([(oid, cid), (oid, other_cid)], "hello")
+    assert set(results) == set([(oid, cid), (oid, other_cid)])
+    for (_, target_cid), mid in results.items():
+        messages = flow.enumerate_messages(oid, target_cid)
+        assert [(message["id"], message["text"]) for message in messages] \
+            == [(mid, "hello")]
+
+
+def test_broadcast_reports_failed_targets(flow, org):
+    oid, cid = org
+    results = flow.broadcast([(oid, cid), (oid, "unknown")], "hello")
+    assert not isinstance(results[(oid, cid)], Exception)
+    assert isinstance(results[(oid, "unknown")], Flow.FlowError)
+
+
+def test_broadcast_uploads_attachments_once_per_org(flow, org, tmpdir):
+    oid, cid = org
+    other_cid = flow.new_channel(oid, "other")
+    file_path = tmpdir.join("report.txt")
+    file_path.write("report")
+    uploads = []
+    new_attachment = flow.new_attachment
+
+    def counting_new_attachment(*args, **kwargs):
+        uploads.append(args)
+        return new_attachment(*args, **kwargs)
+    flow.new_attachment = counting_new_attachment
+    results = flow.broadcast(
+        [(oid, cid), (oid, other_cid)], "report",
+        attachments=[str(file_path)])
+    assert len(uploads) == 1
+    aids = set()
+    for _, target_cid in results:
+        for message in flow.enumerate_messages(oid, target_cid):
+            aids.update(
+                attachment["id"] for attachment in message["attachments"])
+    assert len(aids) == 1
+
+
+def test_broadcast_rate_limit(flow, org):
+    oid, _ = org
+    targets = [(oid, flow.new_channel(oid, "c%d" % index))
+               for index in range(6)]
+    start = time.time()
+    results = flow.broadcast(targets, "hello", rate_limit=4)
+    assert not any(isinstance(result, Exception)
+                   for result in results.values())
+    # A burst of 'rate_limit' messages, then one every 1/4 secs.
+    assert time.time() - start >= 0.2
@@ -0,0 +1,74 @@
+"""
+test_models.py
+Tests of the flow.models records returned with set_response_models().
+"""
+
+import copy
+import json
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping  # Python 2
+
+from flow import models
+
+
+def _send_messages(flow, org, count):
+    oid, cid = org
+    for index in range(count):
+        flow.send_message(oid, cid, "message %d" % index)
+
+
+def test_messages_round_trip_through_json(flow, org):
+    _send_messages(flow, org, 3)
+    plain = flow.enumerate_messages(*org)
+    flow.set_response_models(True)
+    messages = flow.enumerate_messages(*org)
+    assert isinstance(messages, models.RecordList)
+    encoded = json.dumps(messages, default=models.json_default)
+    assert json.loads(encoded) == plain
+    # After the records were created
+    assert all(isinstance(message, models.Message) for message in messages)
+    encoded = json.dumps(messages, default=models.json_default)
+    assert json.loads(encoded) == plain
+    assert json.loads(json.dumps(messages.to_list())) == plain
+
+
+def test_org_record_is_a_mapping(flow):
+    flow.set_response_models(True)
+    org = flow.new_org("org", False)
+    assert isinstance(org, models.Org)
+    assert isinstance(org, Mapping)
+    assert json.loads(json.dumps(org, default=models.json_default)) == \
+        org.to_dict()
+    assert dict(org) == org.to_dict()
+    assert org.copy() == org
+
+
+def test_record_list_returns_records():
+    data = [dict(id="%032x" % index, text=str(index)) for index in range(4)]
+    records = models.RecordList([dict(item) for item in data],
+                                models.Message)
+    accessors = (
+        lambda: records[0],
+        lambda: records[1:3][0],
+        lambda: list(reversed(records))[0],
+        lambda: records.copy()[0],
+        lambda: copy.copy(records)[0],
+        lambda: (records + [dict(data[0])])[-1],
+        lambda: (records * 2)[-1],
+        lambda: records.pop(),
+    )
+    for accessor in accessors:
+        assert isinstance(accessor(), models.Message)
+    assert records.to_list() == data[:3]
+
+
+def test_record_dict_methods():
+    message = models.Message(dict(id="a", text="hi", color="red"))
+    assert message.pop("color") == "red"
+    assert message.pop("color", None) is None
+    assert message.setdefault("text", "other") == "hi"
+    message.update(text="bye")
+    assert message == dict(id="a", text="bye")
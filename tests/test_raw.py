@@ -0,0 +1,34 @@
+"""
+test_raw.py
+Tests of the raw=True API requests, that return the undecoded body.
+"""
+
+import json
+
+import pytest
+
+from flow import Flow
+
+
+def test_raw_response_is_the_undecoded_body(flow, org):
+    oid, _ = org
+    body = flow.enumerate_orgs(raw=True)
+    assert isinstance(body, memoryview)
+    response = json.loads(body.tobytes().decode("utf-8"))
+    assert response["error"] == ""
+    assert response["result"] == flow.enumerate_orgs()
+    assert [org_["id"] for org_ in response["result"]] == [oid]
+
+
+def test_raw_request_raises_on_error(flow):
+    with pytest.raises(Flow.FlowError) as error:
+        flow.enumerate_org_members("unknown", raw=True)
+    assert "unknown" in str(error.value)
+
+
+def test_raw_request_ignores_response_models(flow, org):
+    flow.set_response_models(True)
+    body = flow.enumerate_channels(org[0], raw=True)
+    assert isinstance(body, memoryview)
+    channels = json.loads(body.tobytes().decode("utf-8"))["result"]
+    assert [channel["id"] for channel in channels] == [org[1]]
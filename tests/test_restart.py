@@ -0,0 +1,63 @@
+"""
+test_restart.py
+Tests of Flow(auto_restart=True), killing the fake backend.
+"""
+
+import threading
+import time
+
+import pytest
+
+from conftest import start_flow
+from flow import Flow
+
+
+@pytest.fixture
+def restarting_flow(tmpdir):
+    flow = start_flow(tmpdir.join("alice"), auto_restart=True)
+    yield flow
+    flow.terminate()
+
+
+def _kill_backend(flow):
+    """Kills the backend and waits until it's restarted."""
+    generation = flow._backend_generation
+    flow._flowappglue.kill()
+    deadline = time.time() + 10
+    while flow._backend_generation == generation:
+        assert time.time() < deadline, "backend not restarted"
+        time.sleep(0.05)
+
+
+def test_backend_is_restarted(restarting_flow):
+    flow = restarting_flow
+    sid = flow.get_current_session()
+    _kill_backend(flow)
+    assert flow.backend_restarts == 1
+    assert flow._flowappglue.poll() is None
+    # Same SessionID, the account was started again on the new
+    # backend (the fake backend starts with no data)
+    assert flow.get_current_session() == sid
+    assert flow.account_id()
+    assert flow.new_org("org", False)["id"]
+
+
+def test_notifications_resume_after_restart(restarting_flow):
+    flow = restarting_flow
+    received = threading.Event()
+    flow.add_notification_listener(
+        Flow.ORG_NOTIFICATION, lambda notif_type, data: received.set())
+    _kill_backend(flow)
+    flow.new_org("org", False)
+    assert received.wait(5)
+    stats = flow.get_notification_stats()
+    # The restart is not reported as notification errors
+    assert stats["errors"] == 0
+
+
+def test_backend_is_not_restarted_by_default(flow):
+    flow._flowappglue.kill()
+    flow._flowappglue.wait()
+    with pytest.raises(Flow.FlowError):
+        flow.account_id(timeout=2)
+    assert flow.backend_restarts == 0